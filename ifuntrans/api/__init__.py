@@ -9,8 +9,12 @@ from fastapi_limiter.depends import RateLimiter
 from loguru import logger
 from pydantic import BaseModel
 
-from ifuntrans.api.constants import LANG_EN_TO_CODE
+from ifuntrans.cache import translation_cache
+from ifuntrans.engines import engine_registry
+from ifuntrans.http_client import close_http_client, init_http_client
+from ifuntrans.languages import LANG_EN_TO_CODE
 from ifuntrans.metadata import __version__, contact, license_info, title
+from ifuntrans.router import route_counters
 
 
 class IfunTransModel(BaseModel):
@@ -70,6 +74,16 @@ def get_lang_codes_zh():
     return LANG_EN_TO_CODE
 
 
+def get_cache_stats():
+    """get translation cache hit/miss statistics"""
+    return translation_cache.stats()
+
+
+def get_route_stats():
+    """get the number of segments and characters sent to each translation route"""
+    return route_counters.stats()
+
+
 def create_app():
     """create the FastAPI app"""
     # app object
@@ -89,12 +103,26 @@ def create_app():
         redis_host = os.getenv("REDIS_HOST", "localhost")
         redis_client = redis.from_url("redis://{}:6379".format(redis_host), encoding="utf8", decode_responses=True)
         await FastAPILimiter.init(redis_client)
+        await init_http_client()
+        await engine_registry.warm_up()
+        # values of the translation cache are compressed bytes, so the responses should not be decoded
+        translation_cache.set_redis(redis.from_url("redis://{}:6379".format(redis_host)))
+
+    @app.on_event("shutdown")
+    async def shutdown():
+        """shutdown event"""
+        await close_http_client()
+        if translation_cache.redis is not None:
+            await translation_cache.redis.close()
+            translation_cache.set_redis(None)
 
     app.exception_handler(Exception)(custom_exception_handler)
     app.middleware("http")(redirect_trailing_slash)
     app.get("/", summary="SwaggerUI (当前页面)")(home)
     app.get("/lang_codes_en", summary="获取所有支持的语言代码（英语版本）")(get_lang_codes_en)
     app.get("/lang_codes_zh", summary="获取所有支持的语言代码（中文版本）")(get_lang_codes_zh)
+    app.get("/cache_stats", summary="获取翻译缓存命中统计")(get_cache_stats)
+    app.get("/route_stats", summary="获取翻译路由统计")(get_route_stats)
 
     translate_func = translate.translate
     app.post(
@@ -1,272 +1,2 @@
-LANG_EN_TO_CODE = {
-    "afrikaans": "af",
-    "albanian": "sq",
-    "amharic": "am",
-    "arabic": "ar",
-    "armenian": "hy",
-    "assamese": "as",
-    "aymara": "ay",
-    "azerbaijani": "az",
-    "bambara": "bm",
-    "basque": "eu",
-    "belarusian": "be",
-    "bengali": "bn",
-    "bhojpuri": "bho",
-    "bosnian": "bs",
-    "bulgarian": "bg",
-    "catalan": "ca",
-    "cebuano": "ceb",
-    "chichewa": "ny",
-    "chinese (simplified)": "zh-CN",
-    "chinese (traditional)": "zh-TW",
-    "corsican": "co",
-    "croatian": "hr",
-    "czech": "cs",
-    "danish": "da",
-    "dhivehi": "dv",
-    "dogri": "doi",
-    "dutch": "nl",
-    "english": "en",
-    "esperanto": "eo",
-    "estonian": "et",
-    "ewe": "ee",
-    "filipino": "tl",
-    "finnish": "fi",
-    "french": "fr",
-    "frisian": "fy",
-    "galician": "gl",
-    "georgian": "ka",
-    "german": "de",
-    "greek": "el",
-    "guarani": "gn",
-    "gujarati": "gu",
-    "haitian creole": "ht",
-    "hausa": "ha",
-    "hawaiian": "haw",
-    "hebrew": "iw",
-    "hindi": "hi",
-    "hmong": "hmn",
-    "hungarian": "hu",
-    "icelandic": "is",
-    "igbo": "ig",
-    "ilocano": "ilo",
-    "indonesian": "id",
-    "irish": "ga",
-    "italian": "it",
-    "japanese": "ja",
-    "javanese": "jw",
-    "kannada": "kn",
-    "kazakh": "kk",
-    "khmer": "km",
-    "kinyarwanda": "rw",
-    "konkani": "gom",
-    "korean": "ko",
-    "krio": "kri",
-    "kurdish (kurmanji)": "ku",
-    "kurdish (sorani)": "ckb",
-    "kyrgyz": "ky",
-    "lao": "lo",
-    "latin": "la",
-    "latvian": "lv",
-    "lingala": "ln",
-    "lithuanian": "lt",
-    "luganda": "lg",
-    "luxembourgish": "lb",
-    "macedonian": "mk",
-    "maithili": "mai",
-    "malagasy": "mg",
-    "malay": "ms",
-    "malayalam": "ml",
-    "maltese": "mt",
-    "maori": "mi",
-    "marathi": "mr",
-    "meiteilon (manipuri)": "mni-Mtei",
-    "mizo": "lus",
-    "mongolian": "mn",
-    "myanmar": "my",
-    "nepali": "ne",
-    "norwegian": "no",
-    "odia (oriya)": "or",
-    "oromo": "om",
-    "pashto": "ps",
-    "persian": "fa",
-    "polish": "pl",
-    "portuguese": "pt",
-    "punjabi": "pa",
-    "quechua": "qu",
-    "romanian": "ro",
-    "russian": "ru",
-    "samoan": "sm",
-    "sanskrit": "sa",
-    "scots gaelic": "gd",
-    "sepedi": "nso",
-    "serbian": "sr",
-    "sesotho": "st",
-    "shona": "sn",
-    "sindhi": "sd",
-    "sinhala": "si",
-    "slovak": "sk",
-    "slovenian": "sl",
-    "somali": "so",
-    "spanish": "es",
-    "sundanese": "su",
-    "swahili": "sw",
-    "swedish": "sv",
-    "tajik": "tg",
-    "tamil": "ta",
-    "tatar": "tt",
-    "telugu": "te",
-    "thai": "th",
-    "tigrinya": "ti",
-    "tsonga": "ts",
-    "turkish": "tr",
-    "turkmen": "tk",
-    "twi": "ak",
-    "ukrainian": "uk",
-    "urdu": "ur",
-    "uyghur": "ug",
-    "uzbek": "uz",
-    "vietnamese": "vi",
-    "welsh": "cy",
-    "xhosa": "xh",
-    "yiddish": "yi",
-    "yoruba": "yo",
-    "zulu": "zu",
-}
-
-
-LANG_ZH_TO_CODE = {
-    "阿非卡语": "af",
-    "阿尔巴尼亚语": "sq",
-    "阿姆哈拉语": "am",
-    "阿拉伯语": "ar",
-    "亚美尼亚语": "hy",
-    "阿萨姆语": "as",
-    "艾马拉语": "ay",
-    "阿塞拜疆语": "az",
-    "班巴拉语": "bm",
-    "巴斯克语": "eu",
-    "白俄罗斯语": "be",
-    "孟加拉语": "bn",
-    "博杰普尔语": "bho",
-    "波斯尼亚语": "bs",
-    "保加利亚语": "bg",
-    "加泰罗尼亚语": "ca",
-    "宿务语": "ceb",
-    "奇切瓦语": "ny",
-    "中文（简体）": "zh-CN",
-    "中文（繁体）": "zh-TW",
-    "科西嘉语": "co",
-    "克罗地亚语": "hr",
-    "捷克语": "cs",
-    "丹麦语": "da",
-    "迪维希语": "dv",
-    "多格里语": "doi",
-    "荷兰语": "nl",
-    "英语": "en",
-    "世界语": "eo",
-    "爱沙尼亚语": "et",
-    "埃维语": "ee",
-    "菲律宾语": "tl",
-    "芬兰语": "fi",
-    "法语": "fr",
-    "弗里西语": "fy",
-    "加利西亚语": "gl",
-    "格鲁吉亚语": "ka",
-    "德语": "de",
-    "希腊语": "el",
-    "瓜拉尼语": "gn",
-    "古吉拉特语": "gu",
-    "海地克里奥尔语": "ht",
-    "豪萨语": "ha",
-    "夏威夷语": "haw",
-    "希伯来语": "iw",
-    "印地语": "hi",
-    "苗语": "hmn",
-    "匈牙利语": "hu",
-    "冰岛语": "is",
-    "伊博语": "ig",
-    "伊洛卡诺语": "ilo",
-    "印度尼西亚语": "id",
-    "爱尔兰语": "ga",
-    "意大利语": "it",
-    "日语": "ja",
-    "爪哇语": "jw",
-    "卡纳达语": "kn",
-    "哈萨克语": "kk",
-    "高棉语": "km",
-    "基尼亚尔万达语": "rw",
-    "孔卡尼语": "gom",
-    "韩语": "ko",
-    "克里奥尔语": "kri",
-    "库尔德语（库尔曼吉）": "ku",
-    "库尔德语（索拉尼）": "ckb",
-    "吉尔吉斯语": "ky",
-    "老挝语": "lo",
-    "拉丁语": "la",
-    "拉脱维亚语": "lv",
-    "林加拉语": "ln",
-    "立陶宛语": "lt",
-    "卢干达语": "lg",
-    "卢森堡语": "lb",
-    "马其顿语": "mk",
-    "迈蒂利语": "mai",
-    "马拉加斯语": "mg",
-    "马来语": "ms",
-    "马拉雅拉姆语": "ml",
-    "马耳他语": "mt",
-    "毛利语": "mi",
-    "马拉提语": "mr",
-    "曼尼普里语": "mni-Mtei",
-    "米佐语": "lus",
-    "蒙古语": "mn",
-    "缅甸语": "my",
-    "尼泊尔语": "ne",
-    "挪威语": "no",
-    "奥利亚语": "or",
-    "奥罗莫语": "om",
-    "普什图语": "ps",
-    "波斯语": "fa",
-    "波兰语": "pl",
-    "葡萄牙语": "pt",
-    "旁遮普语": "pa",
-    "克丘亚语": "qu",
-    "罗马尼亚语": "ro",
-    "俄语": "ru",
-    "萨摩亚语": "sm",
-    "梵文": "sa",
-    "苏格兰盖尔语": "gd",
-    "塞普勒语": "nso",
-    "塞尔维亚语": "sr",
-    "塞索托语": "st",
-    "绍纳语": "sn",
-    "信德语": "sd",
-    "僧伽罗语": "si",
-    "斯洛伐克语": "sk",
-    "斯洛文尼亚语": "sl",
-    "索马里语": "so",
-    "西班牙语": "es",
-    "巽他语": "su",
-    "斯瓦希里语": "sw",
-    "瑞典语": "sv",
-    "塔吉克语": "tg",
-    "泰米尔语": "ta",
-    "塔塔尔语": "tt",
-    "泰卢固语": "te",
-    "泰语": "th",
-    "提格利尼亚语": "ti",
-    "聪加语": "ts",
-    "土耳其语": "tr",
-    "土库曼语": "tk",
-    "茨维语": "ak",
-    "乌克兰语": "uk",
-    "乌尔都语": "ur",
-    "维吾尔语": "ug",
-    "乌兹别克语": "uz",
-    "越南语": "vi",
-    "威尔士语": "cy",
-    "科萨语": "xh",
-    "意第绪语": "yi",
-    "约鲁巴语": "yo",
-    "祖鲁语": "zu",
-}
+# The language tables live in ifuntrans.languages, so the translators can use them without the API app
+from ifuntrans.languages import LANG_EN_TO_CODE, LANG_ZH_TO_CODE  # noqa: F401
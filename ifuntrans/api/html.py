@@ -2,7 +2,7 @@ import re
 
 from bs4 import BeautifulSoup, Comment
 
-from ifuntrans.async_translators.google import batch_translate_texts
+from ifuntrans.engines import get_engine
 from ifuntrans.lang_detection import single_detection
 
 NON_TRANSLATEABLE_TAGS = [
@@ -44,7 +44,7 @@ async def translate_html(html_content: str, source_language: str, target_languag
     extract_text(soup)
     if source_language == "auto":
         source_language = await single_detection("".join(all_text))
-    translations = await batch_translate_texts(all_text, source_language, target_language)
+    translations = await get_engine("google").batch_translate_texts(all_text, source_language, target_language)
 
     def replace_text(node):
         if (
@@ -1,16 +1,18 @@
+import asyncio
 import re
 import tempfile
 from functools import partial
-from typing import Optional, Tuple, Union
+from typing import Callable, Optional, Tuple, Union
 
-import httpx
 import langcodes
 import numpy as np
 import pandas as pd
+from loguru import logger
 
+from ifuntrans.http_client import get_http_client
 from ifuntrans.lang_detection import single_detection
-from ifuntrans.tm import TranslationMemory
-from ifuntrans.translate import translate
+from ifuntrans.tm import create_tm_from_excel
+from ifuntrans.translate import translate_multi
 from ifuntrans.utils import IFUN_CALLBACK_URL, S3_DEFAULT_BUCKET, S3Client, get_s3_key_from_id
 
 
@@ -56,6 +58,7 @@ async def translate_excel(
     source_column: int = 1,
     sheet_name: Union[int, str] = 0,
     tm_file: Optional[str] = None,
+    progress_callback: Optional[Callable[[int, int], None]] = None,
 ):
     df, from_lang = await read_excel(file_path, source_column, sheet_name)
     source = (
@@ -68,9 +71,10 @@ async def translate_excel(
     )
     to_langs_list = to_langs.split(",")
 
-    tm = TranslationMemory(langs=to_langs_list, tm_path=tm_file)
+    tm = await create_tm_from_excel(tm_file) if tm_file else None
 
     lang2translations = {}
+    lang2names = {}
     for lang in to_langs_list:
         language_name = langcodes.get(lang).language_name()
         territory_name = langcodes.get(lang).territory_name()
@@ -78,9 +82,17 @@ async def translate_excel(
             language_name += f" ({territory_name})"
 
         if language_name in df.columns:
-            translations = df[language_name].tolist()
+            lang2translations[language_name] = df[language_name].tolist()
         else:
-            translations = await translate(source, from_lang, lang, tm=tm)
+            lang2names[lang] = language_name
+
+    # all the missing languages are translated at once, the source is sent once for all of them
+    if lang2names:
+        translations = await translate_multi(
+            source, from_lang, list(lang2names.keys()), tm=tm, progress_callback=progress_callback
+        )
+        for lang, language_name in lang2names.items():
+            lang2translations[language_name] = translations[lang]
 
     # save to excel
     writer = pd.ExcelWriter(saved_path, engine="openpyxl")
@@ -98,20 +110,42 @@ async def translate_excel(
 
 async def callback(task_id: str, status: int, message: str) -> None:
     # status 1: success, 2: failed, 3: in progress
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            IFUN_CALLBACK_URL,
-            json={
-                "id": task_id,
-                "status": status,
-                "message": message,
-                "translateTarget": get_s3_key_from_id(task_id),
-            },
-        )
-        response.raise_for_status()
+    response = await get_http_client().post(
+        IFUN_CALLBACK_URL,
+        json={
+            "id": task_id,
+            "status": status,
+            "message": message,
+            "translateTarget": get_s3_key_from_id(task_id),
+        },
+    )
+    response.raise_for_status()
+
+
+async def _report_progress(task_id: str, message: str) -> None:
+    try:
+        await callback(task_id, 3, message)
+    except Exception as e:
+        logger.warning(f"Failed to report progress of task {task_id}: {e}")
 
 
 async def translate_s3_excel_task(task_id: str, file_name: str, to_langs: str):
+    reported = {"percent": 0}
+    reporting_tasks = set()
+
+    def report_progress(finished: int, total: int):
+        # report at most once every 10 percent
+        percent = finished * 100 // max(total, 1) // 10 * 10
+        if percent > reported["percent"]:
+            reported["percent"] = percent
+            task = asyncio.create_task(_report_progress(task_id, f"In progress... {percent}%"))
+            reporting_tasks.add(task)
+            task.add_done_callback(reporting_tasks.discard)
+
+    async def finish_reporting():
+        # the progress must not arrive after the final status and overwrite it
+        await asyncio.gather(*reporting_tasks)
+
     async with S3Client() as s3_client:
         with tempfile.NamedTemporaryFile(suffix=".xlsx") as temp_file:
             try:
@@ -119,13 +153,15 @@ async def translate_s3_excel_task(task_id: str, file_name: str, to_langs: str):
                 await callback(task_id, 3, "In progress...")
 
                 # translate
-                await translate_excel(temp_file.name, temp_file.name, to_langs)
+                await translate_excel(temp_file.name, temp_file.name, to_langs, progress_callback=report_progress)
 
                 # upload file
                 s3_file_key = get_s3_key_from_id(task_id)
                 await s3_client.upload_file(temp_file.name, S3_DEFAULT_BUCKET, s3_file_key)
 
+                await finish_reporting()
                 await callback(task_id, 1, "Success")
             except Exception as e:
+                await finish_reporting()
                 await callback(task_id, 2, str(e))
                 raise e
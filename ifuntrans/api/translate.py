@@ -3,23 +3,13 @@ from typing import Annotated, Optional
 import fastapi
 import pydantic
 
-import ifuntrans.async_translators as translators
 from ifuntrans.api import IfunTransModel
 from ifuntrans.api.html import translate_html
 from ifuntrans.api.localization import translate_s3_excel_task
+from ifuntrans.engines import engine_registry, get_engine
 from ifuntrans.lang_detection import single_detection
 from ifuntrans.utils import get_s3_key_from_id
 
-SUPPORTED_ENGINES = {
-    "google": "Google翻译",
-    # "deepl": "DeepL",
-    # "baidu": "百度翻译",
-    # "tencent": "腾讯翻译君",
-    # "microsoft": "微软Bing翻译",
-    # "yandex": "Yandex",
-    "chatgpt": "ChatGPT",
-}
-
 
 class TranslationRequest(IfunTransModel):
     """model for a base request that require a source & target language and a text to translate"""
@@ -56,7 +46,7 @@ class TranslationRequest(IfunTransModel):
             return "google"
         if not engine:
             return "google"
-        if engine not in SUPPORTED_ENGINES:
+        if engine not in engine_registry:
             return "google"
         return engine
 
@@ -100,7 +90,7 @@ async def translate(
         sourceLan = request.sourceLan
         if sourceLan == "auto":
             sourceLan = await single_detection(request.translateSource)
-        engine = getattr(translators, request.engine)
+        engine = get_engine(request.engine)
         translation = await engine.translate_text(request.translateSource, sourceLan, request.targetLan)
         return TranslationResponse(
             data=translation,
@@ -1,2 +1 @@
-import ifuntrans.async_translators.chatgpt as chatgpt
-import ifuntrans.async_translators.google as google
+"""Translation engines, registered in `ifuntrans.engines`"""
@@ -1,32 +1,130 @@
 import asyncio
+import collections
+import functools
+import itertools
+import json
 import os
 import re
 import typing
-from itertools import chain
-from typing import Dict, Iterable, List, Optional, Tuple
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple
 
 import langcodes
 import openai
 from loguru import logger
-from more_itertools import windowed
 
 from ifuntrans.async_translators.google import batch_translate_texts as google_batch_translate_texts
-from ifuntrans.tokenizer import tokenizer
+from ifuntrans.cache import translation_cache
+from ifuntrans.placeholder import dedup_texts
+from ifuntrans.ratelimit import AdaptiveRateLimiter, parse_retry_after
+from ifuntrans.tokenizer import estimate_token_length, token_length, token_lengths
 
 if typing.TYPE_CHECKING:
     from ifuntrans.tm import TranslationMemory
 
 
-if os.environ.get("USE_GPT4", None):
-    AZURE_OPENAI_ENDPOINT = os.environ["AZURE_OPENAI_GPT4_ENDPOINT"]
-    AZURE_OPENAI_API_KEY = os.environ["AZURE_OPENAI_GPT4_API_KEY"]
-    DEPLOYMENT_ID = os.environ["DEPLOYMENT_ID_GPT4"]
-    logger.info("Use GPT4")
-else:
-    AZURE_OPENAI_ENDPOINT = os.environ["AZURE_OPENAI_ENDPOINT"]
-    AZURE_OPENAI_API_KEY = os.environ["AZURE_OPENAI_API_KEY"]
-    DEPLOYMENT_ID = os.environ["DEPLOYMENT_ID"]
-    logger.info("Use GPT3.5")
+MAX_LENGTH = 500
+LENGTH_RATIO_TOLERANCE = 2.5
+CONTEXT_SAFETY_MARGIN = 256  # tokens reserved for the chat format overhead and estimation errors
+MESSAGE_OVERHEAD_TOKENS = 4  # tokens of the chat format per message
+
+# How many more tokens a translation takes than its source, by target language
+TARGET_TOKEN_INFLATION = {
+    "en": 1.0,
+    "zh": 1.3,
+    "ja": 1.5,
+    "ko": 1.8,
+    "ru": 1.8,
+    "ar": 2.0,
+    "th": 3.0,
+    "hi": 3.0,
+    "my": 4.0,
+}
+DEFAULT_TARGET_TOKEN_INFLATION = 1.5
+# Output protocol of the model: "lines" is one translation per line, "jsonl" is JSON lines keyed by the sentence IDs
+OUTPUT_PROTOCOL = os.environ.get("CHATGPT_OUTPUT_PROTOCOL", "lines")
+JSONL_SEGMENT_OVERHEAD_TOKENS = 12  # tokens of {"id": ..., "text": ...} around a sentence
+# Stream the completions, and abort them as soon as the answers diverge from the source sentences
+STREAM = os.environ.get("CHATGPT_STREAM", "0") not in ("0", "false", "False", "")
+RUNAWAY_TOKEN_RATIO = 2.0  # streamed answers are capped at this ratio of the expected length
+# A streamed answer is a runaway once it has this many lines (or invalid JSON lines) more than the sentences, at
+# least RUNAWAY_MIN_EXTRA_LINES. A few are left to the parser, e.g. a preamble that the alignment can skip.
+RUNAWAY_EXTRA_LINE_RATIO = 0.25
+RUNAWAY_MIN_EXTRA_LINES = 3
+# Cluster segments sharing TM terms into the same chunks, so the glossary of each prompt is small
+GROUP_BY_TERMS = os.environ.get("CHATGPT_GROUP_BY_TERMS", "0") not in ("0", "false", "False", "")
+
+CHATGPT_MAX_CONCURRENCY = int(os.environ.get("CHATGPT_MAX_CONCURRENCY", 10))
+# How many times the failed sentences of a chunk are split and retried before they go to the fallback
+CHATGPT_MAX_BISECT_DEPTH = int(os.environ.get("CHATGPT_MAX_BISECT_DEPTH", 3))
+
+
+class ModelTier(object):
+    """An Azure OpenAI deployment, with its context size and its own rate limiter."""
+
+    def __init__(
+        self,
+        name: str,
+        endpoint: str,
+        api_key: str,
+        deployment_id: str,
+        context_size: int,
+        max_output_tokens: int = 4096,
+        rpm: int = 0,
+        tpm: int = 0,
+    ):
+        self.name = name
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.deployment_id = deployment_id
+        self.context_size = context_size
+        self.max_output_tokens = max_output_tokens
+        self.limiter = AdaptiveRateLimiter(rpm, tpm, max_concurrency=CHATGPT_MAX_CONCURRENCY)
+
+    @property
+    def request_kwargs(self) -> Dict[str, str]:
+        return {"deployment_id": self.deployment_id, "api_base": self.endpoint, "api_key": self.api_key}
+
+
+def _load_model_tiers() -> Dict[str, ModelTier]:
+    """The configured deployments. Quota of a deployment is in RPM and TPM, 0 means unlimited."""
+    tiers = {}
+    if os.environ.get("AZURE_OPENAI_ENDPOINT"):
+        tiers["gpt-3.5"] = ModelTier(
+            "gpt-3.5",
+            os.environ["AZURE_OPENAI_ENDPOINT"],
+            os.environ["AZURE_OPENAI_API_KEY"],
+            os.environ["DEPLOYMENT_ID"],
+            context_size=int(os.environ.get("CHATGPT_CONTEXT_SIZE", 4096)),
+            max_output_tokens=int(os.environ.get("CHATGPT_MAX_OUTPUT_TOKENS", 4096)),
+            rpm=int(os.environ.get("AZURE_OPENAI_RPM", 0)),
+            tpm=int(os.environ.get("AZURE_OPENAI_TPM", 0)),
+        )
+    if os.environ.get("AZURE_OPENAI_GPT4_ENDPOINT"):
+        tiers["gpt-4"] = ModelTier(
+            "gpt-4",
+            os.environ["AZURE_OPENAI_GPT4_ENDPOINT"],
+            os.environ["AZURE_OPENAI_GPT4_API_KEY"],
+            os.environ["DEPLOYMENT_ID_GPT4"],
+            context_size=int(os.environ.get("CHATGPT_GPT4_CONTEXT_SIZE", 128000)),
+            max_output_tokens=int(os.environ.get("CHATGPT_GPT4_MAX_OUTPUT_TOKENS", 4096)),
+            rpm=int(os.environ.get("AZURE_OPENAI_GPT4_RPM", 0)),
+            tpm=int(os.environ.get("AZURE_OPENAI_GPT4_TPM", 0)),
+        )
+    return tiers
+
+
+MODEL_TIERS = _load_model_tiers()
+DEFAULT_TIER = "gpt-4" if os.environ.get("USE_GPT4", None) else "gpt-3.5"
+if DEFAULT_TIER not in MODEL_TIERS:
+    raise KeyError(f"Azure OpenAI deployment of {DEFAULT_TIER} is not configured")
+logger.info(f"Use {DEFAULT_TIER}")
+
+AZURE_OPENAI_ENDPOINT = MODEL_TIERS[DEFAULT_TIER].endpoint
+AZURE_OPENAI_API_KEY = MODEL_TIERS[DEFAULT_TIER].api_key
+DEPLOYMENT_ID = MODEL_TIERS[DEFAULT_TIER].deployment_id
+CONTEXT_SIZE = MODEL_TIERS[DEFAULT_TIER].context_size
+MAX_OUTPUT_TOKENS = MODEL_TIERS[DEFAULT_TIER].max_output_tokens
+chatgpt_limiter = MODEL_TIERS[DEFAULT_TIER].limiter
 
 # OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
 # openai.api_key = os.environ["OPENAI_API_KEY"]
@@ -36,7 +134,23 @@ openai.api_key = AZURE_OPENAI_API_KEY
 openai.api_base = AZURE_OPENAI_ENDPOINT
 openai.api_version = "2023-05-15"
 
-MAX_LENGTH = 500
+
+def get_model_tier(name: Optional[str] = None) -> ModelTier:
+    """Get the deployment of the tier, the default one if `name` is None."""
+    if name is None:
+        return MODEL_TIERS[DEFAULT_TIER]
+    if name not in MODEL_TIERS:
+        raise ValueError(f"Unknown or not configured model tier {name}. Available: {list(MODEL_TIERS)}")
+    return MODEL_TIERS[name]
+
+
+CHATGPT_TERMS_PROMPT = (
+    "Please translate these terms. And all translations must follow these terms. {src_lang} Source: \n"
+)
+CHATGPT_EXAMPLES_PROMPT = (
+    "Please translate these sentences. They are similar to the ones to translate, for reference only. "
+    "{src_lang} Source: \n"
+)
 
 CHATGPT_DOC_TRANSLATE_PROMPT = """
 {instructions}
@@ -48,25 +162,217 @@ You will be provided with sentences, and your task is to translate it into {tgt_
 4. Please keep the unicode character representation of roman numerals in translations. e.g.: Ⅰ Ⅱ Ⅲ Ⅳ Ⅴ Ⅵ Ⅶ Ⅷ Ⅸ Ⅹ
 """  # TODO: Dynamic load abbreviations from database
 
+CHATGPT_JSONL_TRANSLATE_PROMPT = """
+{instructions}
+You will be provided with sentences in JSON lines, each line is {{"id": <id>, "text": <sentence>}}, and your task is to translate the sentences into {tgt_lang}.
 
-async def create_chat_completion(order: int, messages: List[Dict[str, str]]):
+1. Please output one JSON object per line in the form of {{"id": <id>, "translation": <translation>}}, with the id of the input sentence. Line breaks in translations must be escaped as \\n.
+2. Please do not add or remove any punctuation marks or any numbers. For example, [color=#fcc44d] <br> etc.
+3. Please don't do any explaining.
+4. Please keep the unicode character representation of roman numerals in translations. e.g.: Ⅰ Ⅱ Ⅲ Ⅳ Ⅴ Ⅵ Ⅶ Ⅷ Ⅸ Ⅹ
+"""
+
+CHATGPT_MULTI_TRANSLATE_PROMPT = """
+{instructions}
+You will be provided with sentences, and your task is to translate it into each of these languages: {tgt_langs}.
+{input_format}
+1. Please output a block for each language. A block starts with a line of "### <language code>", followed by {output_format}.
+2. Please do not add or remove any punctuation marks or any numbers. For example, [color=#fcc44d] <br> etc.
+3. Please don't do any explaining.
+4. Please keep the unicode character representation of roman numerals in translations. e.g.: Ⅰ Ⅱ Ⅲ Ⅳ Ⅴ Ⅵ Ⅶ Ⅷ Ⅸ Ⅹ
+"""
+MULTI_INPUT_FORMATS = {
+    "lines": "",
+    "jsonl": 'The sentences are in JSON lines, each line is {"id": <id>, "text": <sentence>}.\n',
+}
+MULTI_OUTPUT_FORMATS = {
+    "lines": "the translations in the same order as the input sentences (one translation per line)",
+    "jsonl": 'one JSON object per line in the form of {"id": <id>, "translation": <translation>}',
+}
+CHATGPT_MULTI_TERMS_PROMPT = "Please translate these terms. And all translations must follow these terms.\n"
+CHATGPT_MULTI_EXAMPLES_PROMPT = "Translations of sentences similar to the ones to translate, for reference only.\n"
+
+
+def _estimate_tokens(messages: List[Dict[str, str]]) -> int:
+    """Estimate the total tokens of a request. The completion is about as long as the last message."""
+    prompt_tokens = sum(token_length(m["content"]) for m in messages)
+    return prompt_tokens + token_length(messages[-1]["content"])
+
+
+class _AnswerMonitor(object):
+    """
+    Watch a streamed answer and report as soon as it clearly runs away from the source sentences: far more lines
+    than sentences, or many invalid JSON lines. A preamble or a stray line is left to the parser, which can still
+    align the translations around it.
+    """
+
+    def __init__(self, src: List[str], protocol: str = OUTPUT_PROTOCOL):
+        self.num_lines = sum(s.count("\n") + 1 for s in src)
+        self.max_extra_lines = max(RUNAWAY_MIN_EXTRA_LINES, int(self.num_lines * RUNAWAY_EXTRA_LINE_RATIO))
+        self.parser = _JsonLinesParser(len(src)) if protocol == "jsonl" else None
+        self._buffer = ""
+        self._num_answer_lines = 0
+
+    def feed(self, delta: str) -> Optional[str]:
+        """Feed a piece of the answer, return the reason if the answer diverges."""
+        if self.parser is not None:
+            self.parser.feed(delta)
+            return "invalid JSON lines" if self.parser.num_invalid_lines > self.max_extra_lines else None
+
+        self._buffer += delta
+        *lines, self._buffer = self._buffer.split("\n")
+        for line in lines:
+            if not line.strip():
+                continue
+            self._num_answer_lines += 1
+            if self._num_answer_lines > self.num_lines + self.max_extra_lines:
+                return "more lines than sentences"
+        return None
+
+
+async def _stream_chat_completion(messages: List[Dict[str, str]], monitor: _AnswerMonitor, **kwargs) -> str:
+    """Stream the completion into the monitor, and abort it as soon as the answer diverges."""
+    chunks = await openai.ChatCompletion.acreate(messages=messages, timeout=30, temperature=0.0, stream=True, **kwargs)
+    content = ""
+    try:
+        async for chunk in chunks:
+            # Azure sends the results of the content filter in chunks without choices
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.get("content") or ""
+            content += delta
+            reason = monitor.feed(delta)
+            if reason:
+                logger.warning(f"ChatGPT answer diverged: {reason}. Abort the completion.")
+                break
+    finally:
+        await chunks.aclose()
+    return content
+
+
+async def create_chat_completion(
+    order: int,
+    messages: List[Dict[str, str]],
+    estimated_tokens: Optional[int] = None,
+    max_tokens: Optional[int] = None,
+    monitor: Optional[Callable[[], _AnswerMonitor]] = None,
+    tier: Optional[str] = None,
+):
+    """
+    With `monitor`, the completion is streamed into a new monitor of each try. It is aborted as soon as the
+    answer diverges, and the partial answer is returned.
+    `tier` is the model tier to call, the default one if None.
+    """
+    model_tier = get_model_tier(tier)
+    limiter = model_tier.limiter
+    if estimated_tokens is None:
+        estimated_tokens = _estimate_tokens(messages)
+    kwargs = dict(model_tier.request_kwargs)
+    if max_tokens is not None:
+        kwargs["max_tokens"] = max_tokens
+    response = ""
     for _ in range(3):
+        await limiter.acquire(estimated_tokens)
         try:
-            chat_completion_resp = await openai.ChatCompletion.acreate(
-                messages=messages, timeout=30, deployment_id=DEPLOYMENT_ID, temperature=0.0
-            )
-            response = chat_completion_resp.choices[0].message.content
-            break
+            if monitor is None:
+                chat_completion_resp = await openai.ChatCompletion.acreate(
+                    messages=messages, timeout=30, temperature=0.0, **kwargs
+                )
+                content = chat_completion_resp.choices[0].message.content
+                usage = getattr(chat_completion_resp, "usage", None)
+                used_tokens = usage.total_tokens if usage else None
+            else:
+                content = await _stream_chat_completion(messages, monitor(), **kwargs)
+                used_tokens = None  # streamed responses don't report the usage
         except openai.error.RateLimitError as e:
-            logger.warning(f"ChatGPT RateLimitError: {e}. Sleep 60s")
-            await asyncio.sleep(60)
-            response = ""
+            logger.warning(f"ChatGPT RateLimitError: {e}. Retry after {parse_retry_after(e.headers)}s")
+            limiter.on_rate_limited(e.headers)
+            continue
         except Exception as e:
             logger.warning(f"ChatGPT failed {type(e)}: {e}")
-            response = ""
+            continue
+        finally:
+            limiter.release()
+
+        limiter.on_success(estimated_tokens, used_tokens)
+        response = content
+        break
     return order, response
 
 
+class _CompletionPool(object):
+    """
+    Pool of workers running chat completions, a new request starts as soon as any worker is free.
+    Requests can be submitted while the pool is running, and other coroutines (e.g. fallbacks) can run
+    along with them. Results of both come out of `results()` as (order, result) when they finish.
+    """
+
+    def __init__(self, num_workers: int = CHATGPT_MAX_CONCURRENCY):
+        self.num_workers = num_workers
+        self._pending: typing.Deque[Tuple[int, List[Dict[str, str]], int, Dict[str, typing.Any]]] = collections.deque()
+        self._results: asyncio.Queue = asyncio.Queue()
+        self._tasks: typing.Set[asyncio.Task] = set()
+        self._num_running_workers = 0
+        self._unfinished = 0
+
+    def submit(self, requests: List[Tuple[int, List[Dict[str, str]], Dict[str, typing.Any]]], urgent: bool = False):
+        """
+        Submit requests of (order, messages, keyword arguments of `create_chat_completion`). The longest ones
+        are scheduled first to minimize the makespan. Urgent requests (e.g. retries) are scheduled before all
+        the pending ones.
+        """
+        items = sorted(
+            [(order, messages, _estimate_tokens(messages), kwargs) for order, messages, kwargs in requests],
+            key=lambda x: x[2],
+            reverse=True,
+        )
+        if urgent:
+            self._pending.extendleft(reversed(items))
+        else:
+            self._pending.extend(items)
+        self._unfinished += len(items)
+
+        while self._num_running_workers < min(self.num_workers, len(self._pending)):
+            self._num_running_workers += 1
+            self._spawn(self._worker())
+
+    def run(self, order: int, coro: typing.Awaitable):
+        """Run a coroutine along with the requests, its result is yielded as the result of `order`."""
+        self._unfinished += 1
+        self._spawn(self._run(order, coro))
+
+    def _spawn(self, coro: typing.Coroutine):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _worker(self):
+        try:
+            while self._pending:
+                order, messages, estimated_tokens, kwargs = self._pending.popleft()
+                self._results.put_nowait(await create_chat_completion(order, messages, estimated_tokens, **kwargs))
+        finally:
+            self._num_running_workers -= 1
+
+    async def _run(self, order: int, coro: typing.Awaitable):
+        try:
+            result = await coro
+        except Exception as e:
+            logger.error(f"{coro} failed {type(e)}: {e}")
+            result = None
+        self._results.put_nowait((order, result))
+
+    async def results(self) -> AsyncIterator[Tuple[int, typing.Any]]:
+        while self._unfinished:
+            result = await self._results.get()
+            self._unfinished -= 1
+            yield result
+
+    def close(self):
+        for task in list(self._tasks):
+            task.cancel()
+
+
 def _fix_ordianl_numbers(src: str, tgt: str) -> str:
     """
     Filter ordinal numbers.
@@ -81,139 +387,576 @@ def _fix_ordianl_numbers(src: str, tgt: str) -> str:
     return tgt
 
 
-async def _chatgpt_translate(
-    origin: List[str],
-    target: List[str],
-    searched_tm: List[Dict[str, str]],
-    src_lang: str,
-    tgt_lang: str,
-    instructions="",
-    max_length=MAX_LENGTH,
-    **kwargs,
-) -> List[str]:
-    src_lang_name = langcodes.get(src_lang).display_name()
-    tgt_lang_name = langcodes.get(tgt_lang).display_name()
+def _strip_ordinals(segments: List[str]) -> Tuple[List[str], Dict[int, str]]:
+    """Strip the leading ordinal numbers (and tags) of the sentences, return the stripped sentences and the ordinals."""
+    ord_cache = {}
+    stripped = []
+    for j, s in enumerate(segments):
+        ord_matched = re.match(r"^(\s*<[0-9A-Za-z=#]+>\s*)*[\d\s.、]+", s)
+        if ord_matched:
+            ord_cache[j] = ord_matched.group(0)
+            s = s[ord_matched.end() :]
+        stripped.append(s)
+    return stripped, ord_cache
 
-    def chunk() -> Iterable[Tuple[List[str], List[str], List[Dict[str, str]]]]:
-        source_chunk = []
-        target_chunk = []
-        tm_chunk = []
-
-        cur_len = 0
-        for src, tgt, sts in zip(origin, target, searched_tm):
-            len_src = len(tokenizer.encode(src))
-            len_tgt = 0
-
-            source_chunk.append(src)
-            target_chunk.append(tgt)
-            tm_chunk.append(sts)
-            cur_len += len_src + len_tgt
-
-            if cur_len > max_length:
-                yield source_chunk, target_chunk, tm_chunk
-                source_chunk = []
-                target_chunk = []
-                tm_chunk = []
-                cur_len = 0
-
-        if source_chunk:
-            yield source_chunk, target_chunk, tm_chunk
-
-    tasks = []
-    chunked = list(chunk())
-    ord_cache_list = []
-    for i, (src, tgt, st) in enumerate(chunked):
-        ord_cache = {}
-        query = ""
-        for j, (s, _) in enumerate(zip(src, tgt)):
-            ord_matched = re.match(r"^(\s*<[0-9A-Za-z=#]+>\s*)*[\d\s.、]+", s)
-            if ord_matched:
-                ord_cache[j] = ord_matched.group(0)
-                s = s[ord_matched.end() :]
-            # replace all blank with space
-            query += s + "\n"
-
-        ord_cache_list.append(ord_cache)
 
-        merged_tm = {}
-        for d in st:
-            merged_tm.update(d)
+def _restore_ordinal(src: str, ordinal: str, translation: str) -> str:
+    return _fix_ordianl_numbers(src, ordinal.replace("、", ".") + " " + translation)
+
+
+def _format_query(segments: List[str], protocol: str = OUTPUT_PROTOCOL) -> str:
+    if protocol == "jsonl":
+        return "".join(json.dumps({"id": j + 1, "text": s}, ensure_ascii=False) + "\n" for j, s in enumerate(segments))
+    return "".join(s + "\n" for s in segments)
 
-        system_prompt = CHATGPT_DOC_TRANSLATE_PROMPT.format(tgt_lang=tgt_lang_name, instructions=instructions)
-        messages = [{"role": "system", "content": system_prompt}]
 
-        example_source = list(merged_tm.keys())
-        example_target = list(merged_tm.values())
+class _JsonLinesParser(object):
+    """
+    Incremental parser of the answers in the "jsonl" protocol. Lines are parsed as soon as they are complete,
+    lines that are not valid JSON objects of a known and not yet translated id are counted as invalid.
+    """
+
+    def __init__(self, num_segments: int):
+        self.translations: List[Optional[str]] = [None] * num_segments
+        self.num_invalid_lines = 0
+        self._buffer = ""
+
+    def feed(self, text: str):
+        self._buffer += text
+        *lines, self._buffer = self._buffer.split("\n")
+        for line in lines:
+            self._parse_line(line)
+
+    def close(self) -> List[Optional[str]]:
+        self._parse_line(self._buffer)
+        self._buffer = ""
+        return self.translations
+
+    def _parse_line(self, line: str):
+        line = line.strip().rstrip(",")
+        if not line or line.startswith("```"):
+            return
+        try:
+            obj = json.loads(line)
+            index = int(obj["id"]) - 1
+            translation = obj["translation"]
+        except (ValueError, KeyError, TypeError):
+            self.num_invalid_lines += 1
+            return
+        if not isinstance(translation, str) or not 0 <= index < len(self.translations):
+            self.num_invalid_lines += 1
+            return
+        if self.translations[index] is None:
+            self.translations[index] = translation.strip() or None
+
+
+def _parse_answer(src: List[str], answer: str, protocol: str = OUTPUT_PROTOCOL) -> List[Optional[str]]:
+    """Translations of the source sentences from the answer, None for those missing or not aligned."""
+    if protocol == "jsonl":
+        parser = _JsonLinesParser(len(src))
+        parser.feed(answer)
+        return parser.close()
+    return _align_translations(src, answer.strip().split("\n"))
+
+
+def _build_messages(
+    query: str,
+    merged_tm: Dict[str, str],
+    src_lang_name: str,
+    tgt_lang_name: str,
+    instructions: str = "",
+    protocol: str = OUTPUT_PROTOCOL,
+    examples: Optional[Dict[str, str]] = None,
+) -> List[Dict[str, str]]:
+    """
+    `merged_tm` are the TM terms the translations must follow, `examples` are the fuzzy TM hits given as
+    previous translations of similar sentences. Both are single-line, and are given as a turn of the chat.
+    """
+    prompt = CHATGPT_JSONL_TRANSLATE_PROMPT if protocol == "jsonl" else CHATGPT_DOC_TRANSLATE_PROMPT
+    system_prompt = prompt.format(tgt_lang=tgt_lang_name, instructions=instructions)
+    messages = [{"role": "system", "content": system_prompt}]
+
+    for pairs, pairs_prompt in [(examples or {}, CHATGPT_EXAMPLES_PROMPT), (merged_tm, CHATGPT_TERMS_PROMPT)]:
+        example_source = list(pairs.keys())
+        example_target = list(pairs.values())
         if example_source and example_target:
             messages.append(
                 {
                     "role": "user",
-                    "content": f"Please translate these terms. And all translations must follow these terms. {src_lang_name} Source: \n"
+                    "content": pairs_prompt.format(src_lang=src_lang_name)
                     + "\n".join(example_source)
                     + f"\n\n{tgt_lang_name} Translations: \n",
                 }
             )
             messages.append({"role": "assistant", "content": "\n".join(example_target)})
-            logger.debug(merged_tm)
 
-        messages.append(
-            {"role": "user", "content": f"{src_lang_name} Source: \n" + query + f"\n\n{tgt_lang_name} Translations: \n"}
+    messages.append(
+        {"role": "user", "content": f"{src_lang_name} Source: \n" + query + f"\n\n{tgt_lang_name} Translations: \n"}
+    )
+    return messages
+
+
+def _count_prompt_tokens(messages: List[Dict[str, str]]) -> int:
+    return sum(token_length(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+def _target_token_inflation(tgt_lang: str) -> float:
+    return TARGET_TOKEN_INFLATION.get(langcodes.get(tgt_lang).language, DEFAULT_TARGET_TOKEN_INFLATION)
+
+
+def _pack_chunks(
+    segment_tokens: List[int],
+    searched_tm: List[Dict[str, str]],
+    fixed_tokens: int,
+    terms_overhead_tokens: int,
+    inflation: float,
+    max_length: int = MAX_LENGTH,
+    context_size: int = CONTEXT_SIZE,
+    max_output_tokens: int = MAX_OUTPUT_TOKENS,
+) -> List[List[int]]:
+    """
+    Pack segments into chunks by the budget of the whole request: the fixed prompt, the merged TM terms,
+    the source sentences and the estimated translation. A chunk is closed before a segment would overflow
+    the source target `max_length`, the context size or the output limit, so chunks are filled close to
+    the target but never over it (unless a single segment is larger than the target).
+    Return the indices of the segments of each chunk.
+    """
+    budget = context_size - CONTEXT_SAFETY_MARGIN
+
+    chunks = []
+    chunk: List[int] = []
+    terms: set = set()
+    source_tokens = 0
+    prompt_terms_tokens = 0
+
+    def new_terms_tokens(i: int) -> int:
+        new_terms = [(k, v) for k, v in searched_tm[i].items() if k not in terms]
+        if not new_terms:
+            return 0
+        tokens = sum(token_length(k) + token_length(v) + 2 for k, v in new_terms)  # plus new lines
+        return tokens + (terms_overhead_tokens if not terms else 0)
+
+    for i, num_tokens in enumerate(segment_tokens):
+        cur_source_tokens = source_tokens + num_tokens + 1  # plus new line
+        cur_terms_tokens = prompt_terms_tokens + new_terms_tokens(i)
+        output_tokens = int(cur_source_tokens * inflation)
+        total_tokens = fixed_tokens + cur_terms_tokens + cur_source_tokens + output_tokens
+        if chunk and (cur_source_tokens > max_length or total_tokens > budget or output_tokens > max_output_tokens):
+            chunks.append(chunk)
+            chunk = []
+            terms = set()
+            source_tokens = 0
+            prompt_terms_tokens = 0
+            cur_source_tokens = num_tokens + 1
+            cur_terms_tokens = new_terms_tokens(i)
+
+        chunk.append(i)
+        terms.update(searched_tm[i].keys())
+        source_tokens = cur_source_tokens
+        prompt_terms_tokens = cur_terms_tokens
+
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _group_by_terms(searched_tm: List[Dict[str, str]]) -> List[int]:
+    """
+    Order the segments so that those sharing TM terms are next to each other. Segments are grouped by
+    their most frequent term in the batch, then by the next one and so on; segments without terms follow
+    in document order. Return the indices of the segments in the new order.
+    """
+    frequency = collections.Counter(term for terms in searched_tm for term in terms)
+
+    def key(i: int) -> List[Tuple[int, str]]:
+        return sorted((-frequency[term], term) for term in searched_tm[i])
+
+    with_terms = sorted((i for i, terms in enumerate(searched_tm) if terms), key=key)
+    without_terms = [i for i, terms in enumerate(searched_tm) if not terms]
+    return with_terms + without_terms
+
+
+def _is_plausible_pair(src: str, tgt: str, length_ratio: float) -> bool:
+    """Whether a line of the answer is likely to be the translation of the source sentence."""
+    if re.findall(r"\d+", src) != re.findall(r"\d+", tgt):
+        return False
+    if sorted(re.findall(r"\{\w*\}", src)) != sorted(re.findall(r"\{\w*\}", tgt)):
+        return False
+    # smoothed, so that short sentences are not judged by their length
+    expected = len(src) * length_ratio + 5
+    return 1 / LENGTH_RATIO_TOLERANCE < (len(tgt) + 5) / expected < LENGTH_RATIO_TOLERANCE
+
+
+def _align_translations(src: List[str], answer: List[str]) -> List[Optional[str]]:
+    """
+    Align the lines of the answer to the source sentences. Sentences that can't be aligned confidently are None.
+
+    If the line count matches, lines are assigned in order (a sentence may span several lines).
+    Otherwise blank lines are dropped, and for single-line sentences the answer is anchored from both ends
+    by numbers, placeholders and length ratio. The anchored lines are accepted only if the two runs meet, and
+    where they overlap the sentences are unaligned.
+    """
+    num_lines = [s.count("\n") + 1 for s in src]
+
+    def assign(lines: List[str]) -> List[Optional[str]]:
+        result = []
+        cur = 0
+        for n in num_lines:
+            translation = "\n".join(lines[cur : cur + n]).strip()
+            result.append(translation or None)
+            cur += n
+        return result
+
+    if sum(num_lines) == len(answer):
+        return assign(answer)
+
+    lines = [line for line in answer if line.strip()]
+    if sum(num_lines) == len(lines):
+        return assign(lines)
+
+    aligned: List[Optional[str]] = [None] * len(src)
+    if any(n > 1 for n in num_lines) or not lines:
+        return aligned
+
+    length_ratio = sum(len(line) for line in lines) / max(sum(len(s) for s in src), 1)
+    num_src, num_tgt = len(src), len(lines)
+
+    head = 0
+    while head < min(num_src, num_tgt) and _is_plausible_pair(src[head], lines[head], length_ratio):
+        head += 1
+
+    tail = 0
+    while tail < min(num_src, num_tgt) and _is_plausible_pair(
+        src[num_src - tail - 1], lines[num_tgt - tail - 1], length_ratio
+    ):
+        tail += 1
+
+    # the runs must meet across the missing lines, otherwise one of them stopped early and the divergence could be
+    # anywhere before it: the two anchorings assign different lines to every sentence, so none is accepted
+    if head + tail < min(num_src, num_tgt):
+        return aligned
+
+    # [num_src - tail, head) is claimed by both anchorings with different lines
+    for i in range(min(head, num_src - tail)):
+        aligned[i] = lines[i].strip()
+    for i in range(max(head, num_src - tail), num_src):
+        aligned[i] = lines[i - num_src + num_tgt].strip()
+    return aligned
+
+
+async def _chatgpt_translate_stream(
+    origin: List[str],
+    target: List[str],
+    searched_tm: List[Dict[str, str]],
+    src_lang: str,
+    tgt_lang: str,
+    instructions="",
+    max_length=MAX_LENGTH,
+    group_by_terms: bool = GROUP_BY_TERMS,
+    protocol: str = OUTPUT_PROTOCOL,
+    stream: bool = STREAM,
+    fallback: Optional[Callable[[List[int]], typing.Awaitable[List[str]]]] = None,
+    tier: Optional[str] = None,
+    max_bisect_depth: int = CHATGPT_MAX_BISECT_DEPTH,
+    examples: Optional[List[Dict[str, str]]] = None,
+    **kwargs,
+) -> AsyncIterator[Tuple[List[int], List[str]]]:
+    """
+    Translate by ChatGPT chunk by chunk. Yield (indices, translations) as soon as they are finished,
+    the indices are positions in `origin` and every index is yielded exactly once.
+    Sentences of a misaligned chunk are split in halves and retried, up to `max_bisect_depth` times. Sentences
+    failed on their own, beyond the depth, or of a request that errored or answered nothing are translated by
+    `fallback(indices)` concurrently, or yielded with their `target` if there is no fallback.
+    With `group_by_terms`, segments sharing TM terms are packed together instead of in document order.
+    `protocol` is the output protocol of the model, "lines" or "jsonl".
+    With `stream`, the completions are streamed and aborted as soon as the answers diverge.
+    `tier` is the model tier to translate with, the default one if None.
+    `examples` are the fuzzy TM hits of each sentence, given to the model as previous translations.
+    """
+    model_tier = get_model_tier(tier)
+    src_lang_name = langcodes.get(src_lang).display_name()
+    tgt_lang_name = langcodes.get(tgt_lang).display_name()
+    if examples is None:
+        examples = [{} for _ in origin]
+
+    # the prompt without any source sentence or term
+    fixed_tokens = _count_prompt_tokens(
+        _build_messages("", {}, src_lang_name, tgt_lang_name, instructions, protocol=protocol)
+    )
+    terms_tokens = _count_prompt_tokens(
+        _build_messages(
+            "",
+            {"": ""},
+            src_lang_name,
+            tgt_lang_name,
+            instructions,
+            protocol=protocol,
+            examples={"": ""} if any(examples) else None,
         )
-        chat_completion_resp = create_chat_completion(
-            order=i,
-            messages=messages,
+    )
+    segment_order = _group_by_terms(searched_tm) if group_by_terms else list(range(len(origin)))
+    segment_tokens = token_lengths(origin)
+    if protocol == "jsonl":
+        segment_tokens = [n + JSONL_SEGMENT_OVERHEAD_TOKENS for n in segment_tokens]
+    inflation = _target_token_inflation(tgt_lang)
+    # the examples take the prompt as the terms do
+    chunk_indices = _pack_chunks(
+        [segment_tokens[i] for i in segment_order],
+        [{**searched_tm[i], **examples[i]} for i in segment_order],
+        fixed_tokens=fixed_tokens,
+        terms_overhead_tokens=terms_tokens - fixed_tokens,
+        inflation=inflation,
+        max_length=max_length,
+        context_size=model_tier.context_size,
+        max_output_tokens=model_tier.max_output_tokens,
+    )
+    chunk_indices = [[segment_order[j] for j in indices] for indices in chunk_indices]
+    pool = _CompletionPool()
+    orders = itertools.count()
+    chunks: Dict[int, Tuple[List[int], List[str], Dict[int, str], int]] = {}
+    fallbacks: Dict[int, List[int]] = {}
+
+    def make_request(indices: List[int], depth: int = 0) -> Tuple[int, List[Dict[str, str]], Dict[str, typing.Any]]:
+        query_segments, ord_cache = _strip_ordinals([origin[i] for i in indices])
+
+        merged_tm = {}
+        merged_examples = {}
+        for i in indices:
+            merged_tm.update(searched_tm[i])
+            merged_examples.update(examples[i])
+        if merged_tm:
+            logger.debug(merged_tm)
+
+        order = next(orders)
+        chunks[order] = (indices, query_segments, ord_cache, depth)
+        query = _format_query(query_segments, protocol)
+        messages = _build_messages(
+            query, merged_tm, src_lang_name, tgt_lang_name, instructions, protocol=protocol, examples=merged_examples
         )
-        tasks.append(chat_completion_resp)
-
-    fixed = []
-    logger.debug(f"ChatGPT Translating {len(tasks)} chunks")
-
-    # in case that the number of tasks is too large, we split them into windows
-    for i, window in enumerate(windowed(tasks, 10, step=10)):
-        # filter None
-        window = [x for x in window if x is not None]
-        for future in asyncio.as_completed(window):
-            order, response = await future
-
-            logger.debug(f"ChatGPT finish {len(fixed) + 1}/{len(tasks)} chunks")
-            answer = response.strip().split("\n")
-
-            src, tgt, _ = chunked[order]
-            ord_cache = ord_cache_list[order]
-
-            # In case that there are multiple new lines in the source sentence
-            translations = []
-            cur = 0
-            for s in src:
-                num_new_lines = s.count("\n")
-                translations.append("\n".join(answer[cur : cur + num_new_lines + 1]))
-                cur += num_new_lines + 1
-
-            translations = [x.strip() for x in translations if x.strip()]
-            if len(translations) != len(tgt) or cur != len(answer):
+
+        options = {"tier": model_tier.name}
+        if stream:
+            expected_tokens = sum(segment_tokens[i] for i in indices) * inflation
+            max_tokens = int(expected_tokens * RUNAWAY_TOKEN_RATIO) + 64
+            options["max_tokens"] = min(model_tier.max_output_tokens, max_tokens)
+            options["monitor"] = functools.partial(_AnswerMonitor, query_segments, protocol)
+        return order, messages, options
+
+    pool.submit([make_request(indices) for indices in chunk_indices])
+    logger.debug(f"ChatGPT Translating {len(chunk_indices)} chunks")
+
+    finished = 0
+    try:
+        async for order, response in pool.results():
+            if order in fallbacks:
+                indices = fallbacks.pop(order)
+                yield indices, response if response is not None else [target[i] for i in indices]
+                continue
+
+            finished += 1
+            logger.debug(f"ChatGPT finish {finished}/{len(chunks) + finished - 1} chunks")
+            indices, query_segments, ord_cache, depth = chunks.pop(order)
+            aligned = _parse_answer(query_segments, response, protocol)
+            failed = [i for i, a in zip(indices, aligned) if a is None]
+            if failed:
                 logger.warning(
                     f"ChatGPT Doc Translate failed. Please check the following sentences: "
-                    # f"Source: {src} "
-                    # f"Target: {tgt} "
-                    # f"Answer: {translations} "
+                    f"{len(indices) - len(failed)}/{len(indices)} sentences are salvaged."
                 )
-                translations = tgt
-            else:
-                # restore ordinal numbers
-                translations = [ord_cache.get(i, "").replace('、', '.') + " " + t for i, t in enumerate(translations)]
 
-            fixed.append((order, translations))
-
-    fixed.sort(key=lambda x: x[0])
-    fixed = list(chain.from_iterable([x[1] for x in fixed]))
+            # Bisect the misaligned sentences and retry them right away. Retrying doesn't help if the request
+            # errored or the answer is empty (e.g. during an outage), so those go to the fallback directly.
+            retry = bool(response) and depth < max_bisect_depth
+            if retry and len(failed) > 1:
+                half = len(failed) // 2
+                pool.submit(
+                    [make_request(failed[:half], depth + 1), make_request(failed[half:], depth + 1)], urgent=True
+                )
+            elif retry and failed and len(indices) > 1:
+                pool.submit([make_request(failed, depth + 1)], urgent=True)
+            elif failed and fallback is not None:
+                fallback_order = next(orders)
+                fallbacks[fallback_order] = failed
+                pool.run(fallback_order, fallback(failed))
+            elif failed:
+                yield failed, [target[i] for i in failed]
+
+            # restore ordinal numbers
+            translations = [
+                (i, _restore_ordinal(origin[i], ord_cache.get(j, ""), a))
+                for j, (i, a) in enumerate(zip(indices, aligned))
+                if a is not None
+            ]
+            if translations:
+                yield [i for i, _ in translations], [t for _, t in translations]
+    finally:
+        pool.close()
 
-    # filter ordianl numbers
-    for i in range(len(fixed)):
-        fixed[i] = _fix_ordianl_numbers(origin[i], fixed[i])
 
+async def _chatgpt_translate(
+    origin: List[str],
+    target: List[str],
+    searched_tm: List[Dict[str, str]],
+    src_lang: str,
+    tgt_lang: str,
+    instructions="",
+    max_length=MAX_LENGTH,
+    **kwargs,
+) -> List[str]:
+    fixed = list(target)
+    async for indices, translations in _chatgpt_translate_stream(
+        origin, target, searched_tm, src_lang, tgt_lang, instructions=instructions, max_length=max_length, **kwargs
+    ):
+        for i, t in zip(indices, translations):
+            fixed[i] = t
     return fixed
 
 
+def _build_multi_messages(
+    query: str,
+    merged_tms: Dict[str, Dict[str, str]],
+    src_lang_name: str,
+    tgt_langs: List[str],
+    instructions: str = "",
+    protocol: str = OUTPUT_PROTOCOL,
+    examples: Optional[Dict[str, Dict[str, str]]] = None,
+) -> List[Dict[str, str]]:
+    system_prompt = CHATGPT_MULTI_TRANSLATE_PROMPT.format(
+        tgt_langs=", ".join(f"{lang} ({langcodes.get(lang).display_name()})" for lang in tgt_langs),
+        instructions=instructions,
+        input_format=MULTI_INPUT_FORMATS[protocol],
+        output_format=MULTI_OUTPUT_FORMATS[protocol],
+    )
+    messages = [{"role": "system", "content": system_prompt}]
+
+    for pairs_by_lang, pairs_prompt in [
+        (examples or {}, CHATGPT_MULTI_EXAMPLES_PROMPT),
+        (merged_tms, CHATGPT_MULTI_TERMS_PROMPT),
+    ]:
+        pairs = "".join(
+            f"### {lang}\n" + "".join(f"{k} => {v}\n" for k, v in merged_tm.items())
+            for lang, merged_tm in pairs_by_lang.items()
+            if merged_tm
+        )
+        if pairs:
+            messages.append({"role": "user", "content": pairs_prompt + pairs})
+
+    messages.append({"role": "user", "content": f"{src_lang_name} Source: \n" + query + "\n\nTranslations: \n"})
+    return messages
+
+
+def _split_language_blocks(answer: str, tgt_langs: List[str]) -> Dict[str, str]:
+    """Split the answer by the "### <language code>" headers. Lines before the first header are dropped."""
+    codes = {lang.lower().replace("_", "-"): lang for lang in tgt_langs}
+    blocks = collections.defaultdict(list)
+    current = None
+    for line in answer.split("\n"):
+        matched = re.match(r"^\s*#{2,}\s*([\w-]+)\s*$", line)
+        if matched and matched.group(1).lower().replace("_", "-") in codes:
+            current = codes[matched.group(1).lower().replace("_", "-")]
+        elif current is not None:
+            blocks[current].append(line)
+    return {lang: "\n".join(lines).strip() for lang, lines in blocks.items()}
+
+
+async def _chatgpt_translate_multi_stream(
+    origin: List[str],
+    searched_tms: Dict[str, List[Dict[str, str]]],
+    src_lang: str,
+    tgt_langs: List[str],
+    instructions="",
+    max_length=MAX_LENGTH,
+    protocol: str = OUTPUT_PROTOCOL,
+    tier: Optional[str] = None,
+    examples: Optional[Dict[str, List[Dict[str, str]]]] = None,
+    **kwargs,
+) -> AsyncIterator[Tuple[str, List[int], List[str]]]:
+    """
+    Translate into several target languages at once, a chunk is sent once with a block of output per language.
+    Yield (tgt_lang, indices, translations) of the aligned sentences as soon as a chunk is finished.
+    Failed sentences are not retried here, they are left to the single target translation.
+    `examples` are the fuzzy TM hits of each sentence by target language, given as previous translations.
+    """
+    model_tier = get_model_tier(tier)
+    src_lang_name = langcodes.get(src_lang).display_name()
+    examples = {lang: (examples or {}).get(lang) or [{} for _ in origin] for lang in tgt_langs}
+
+    fixed_tokens = _count_prompt_tokens(
+        _build_multi_messages("", {}, src_lang_name, tgt_langs, instructions, protocol=protocol)
+    )
+    terms_tokens = _count_prompt_tokens(
+        _build_multi_messages(
+            "",
+            {tgt_langs[0]: {"": ""}},
+            src_lang_name,
+            tgt_langs,
+            instructions,
+            protocol=protocol,
+            examples={tgt_langs[0]: {"": ""}} if any(any(x) for x in examples.values()) else None,
+        )
+    )
+    segment_tokens = token_lengths(origin)
+    if protocol == "jsonl":
+        segment_tokens = [n + JSONL_SEGMENT_OVERHEAD_TOKENS for n in segment_tokens]
+    # the terms and examples of all the targets, to estimate their tokens
+    pairs = {lang: [{**searched_tms[lang][i], **examples[lang][i]} for i in range(len(origin))] for lang in tgt_langs}
+    merged_terms = [
+        {k: " ".join(pairs[lang][i][k] for lang in tgt_langs if k in pairs[lang][i]) for k in keys}
+        for i, keys in enumerate([set().union(*(pairs[lang][i] for lang in tgt_langs)) for i in range(len(origin))])
+    ]
+    chunk_indices = _pack_chunks(
+        segment_tokens,
+        merged_terms,
+        fixed_tokens=fixed_tokens,
+        terms_overhead_tokens=terms_tokens - fixed_tokens,
+        inflation=sum(_target_token_inflation(lang) for lang in tgt_langs),
+        max_length=max_length,
+        context_size=model_tier.context_size,
+        max_output_tokens=model_tier.max_output_tokens,
+    )
+
+    chunks = []
+    requests = []
+    for order, indices in enumerate(chunk_indices):
+        query_segments, ord_cache = _strip_ordinals([origin[i] for i in indices])
+        merged_tms = {lang: {} for lang in tgt_langs}
+        merged_examples = {lang: {} for lang in tgt_langs}
+        for lang in tgt_langs:
+            for i in indices:
+                merged_tms[lang].update(searched_tms[lang][i])
+                merged_examples[lang].update(examples[lang][i])
+        chunks.append((indices, query_segments, ord_cache))
+        query = _format_query(query_segments, protocol)
+        messages = _build_multi_messages(
+            query, merged_tms, src_lang_name, tgt_langs, instructions, protocol=protocol, examples=merged_examples
+        )
+        requests.append((order, messages, {"tier": model_tier.name}))
+
+    logger.debug(f"ChatGPT Translating {len(requests)} chunks into {len(tgt_langs)} languages")
+    pool = _CompletionPool()
+    pool.submit(requests)
+    try:
+        async for order, response in pool.results():
+            indices, query_segments, ord_cache = chunks[order]
+            blocks = _split_language_blocks(response, tgt_langs)
+            for lang in tgt_langs:
+                aligned = _parse_answer(query_segments, blocks.get(lang, ""), protocol)
+                translations = [
+                    (i, _restore_ordinal(origin[i], ord_cache.get(j, ""), a))
+                    for j, (i, a) in enumerate(zip(indices, aligned))
+                    if a is not None
+                ]
+                if len(translations) < len(indices):
+                    logger.warning(
+                        f"ChatGPT multi target translate failed for {lang}: "
+                        f"{len(translations)}/{len(indices)} sentences are aligned."
+                    )
+                if translations:
+                    yield lang, [i for i, _ in translations], [t for _, t in translations]
+    finally:
+        pool.close()
+
+
 TRANSLATION_FAILURE = "<|Openai 翻译失败|>"
 
 
@@ -222,64 +965,320 @@ async def batch_translate_texts(
     source_language_code: str,
     target_language_code: str,
     tm: Optional["TranslationMemory"] = None,
+    progress_callback: Optional[Callable[[int, int], None]] = None,
     **kwargs,
 ) -> List[str]:
-    mock_target = [TRANSLATION_FAILURE] * len(texts)
-    translations = mock_target
+    translations = [TRANSLATION_FAILURE] * len(texts)
+    finished = 0
+    async for indices, cur_translations in stream_translate_texts(
+        texts, source_language_code, target_language_code, tm=tm, **kwargs
+    ):
+        for i, x in zip(indices, cur_translations):
+            translations[i] = x
+        finished += len(indices)
+        if progress_callback is not None:
+            progress_callback(finished, len(texts))
+    return translations
 
-    # search from TM
-    searched_tm = []
 
-    for i, text in enumerate(texts):
+async def stream_translate_texts(
+    texts: List[str],
+    source_language_code: str,
+    target_language_code: str,
+    tm: Optional["TranslationMemory"] = None,
+    searched_tm: Optional[List[Dict[str, str]]] = None,
+    sentence_matches: Optional[List[Optional[Tuple[str, str, float]]]] = None,
+    **kwargs,
+) -> AsyncIterator[Tuple[List[int], List[str]]]:
+    """
+    Streaming version of `batch_translate_texts`. Yield (indices, translations) as soon as they are ready,
+    every index of `texts` is yielded exactly once.
+    `searched_tm` and `sentence_matches` are the TM terms and sentence hits of the texts if the caller already
+    searched the TM, so they are not searched again.
+    """
+    # Identical segments (ignoring blanks) are translated only once
+    unique_texts, inverse = dedup_texts(texts)
+    if len(unique_texts) < len(texts):
+        logger.debug(f"Deduplicated {len(texts)} segments to {len(unique_texts)} unique segments")
+
+    occurrences = collections.defaultdict(list)
+    for i, j in enumerate(inverse):
+        occurrences[j].append(i)
+    if searched_tm is not None:
+        searched_tm = [searched_tm[occurrences[j][0]] for j in range(len(unique_texts))]
+    if sentence_matches is not None:
+        sentence_matches = [sentence_matches[occurrences[j][0]] for j in range(len(unique_texts))]
+
+    async for unique_indices, unique_translations in _stream_unique_texts(
+        unique_texts,
+        source_language_code,
+        target_language_code,
+        tm=tm,
+        searched_tm=searched_tm,
+        sentence_matches=sentence_matches,
+        **kwargs,
+    ):
+        indices = []
+        translations = []
+        for j, x in zip(unique_indices, unique_translations):
+            for i in occurrences[j]:
+                indices.append(i)
+                translations.append(x)
+        yield indices, translations
+
+
+async def _lookup_known_translations(
+    texts: List[str],
+    source_language_code: str,
+    target_language_code: str,
+    tm: Optional["TranslationMemory"] = None,
+    instructions: str = "",
+    tier: Optional[str] = None,
+    searched_tm: Optional[List[Dict[str, str]]] = None,
+    sentence_matches: Optional[List[Optional[Tuple[str, str, float]]]] = None,
+) -> Tuple[List[str], List[Dict[str, str]], List[Dict[str, str]], List[str]]:
+    """
+    Look up the translations from the TM (exact hits) and the cache. Return the translations (TRANSLATION_FAILURE
+    if not found), the TM terms and the fuzzy TM hits (as examples) of each text, and the cache keys.
+    The TM is searched unless the results are given by `searched_tm` and `sentence_matches`.
+    """
+    translations = [TRANSLATION_FAILURE] * len(texts)
+
+    # search from TM
+    if searched_tm is not None:
+        searched_tm = [dict(x) for x in searched_tm]
+    elif tm is None:
+        searched_tm = [{} for _ in texts]
+    else:
+        searched_tm = tm.search_tm_many(texts, source_language_code, target_language_code)
+    if sentence_matches is None:
         if tm is None:
-            searched_tm.append({})
+            sentence_matches = [None for _ in texts]
         else:
-            search_result = tm.search_tm(text, source_language_code, target_language_code)
-            if text in search_result:
-                translations[i] = search_result[text]
-            searched_tm.append(search_result)
-
-    max_length = MAX_LENGTH
-    prev_failures_indices = []
-    while TRANSLATION_FAILURE in translations and max_length > 20:
-        failure_indices = [i for i, x in enumerate(translations) if x == TRANSLATION_FAILURE]
-
-        # If prev_failures_indices is empty, it means that the first time to translate, don't need to log
-        if prev_failures_indices:
-            logger.debug(f"From {source_language_code} to {target_language_code}. Failed indices: {failure_indices}")
-
-        prev_failures_indices = failure_indices
-        cur_texts = [texts[i] for i in failure_indices]
-        cur_target = [mock_target[i] for i in failure_indices]
-        cur_tm = [searched_tm[i] for i in failure_indices]
-        cur_translations = await _chatgpt_translate(
-            cur_texts,
-            cur_target,
-            cur_tm,
+            sentence_matches = tm.search_sentences_many(texts, source_language_code, target_language_code)
+    examples = [{} for _ in texts]
+    for i, (text, search_result, match) in enumerate(zip(texts, searched_tm, sentence_matches)):
+        if text in search_result:
+            translations[i] = search_result[text]
+        elif match is not None:
+            source, target, score = match
+            if score >= 1:
+                translations[i] = target
+            elif "\n" not in source.strip() and "\n" not in target.strip():
+                # fuzzy hits are given to ChatGPT as previous translations, one per line
+                examples[i][source.strip()] = target.strip()
+
+    # search from cache
+    cache_keys = [
+        translation_cache.make_key(
+            "chatgpt",
+            get_model_tier(tier).deployment_id,
             source_language_code,
             target_language_code,
-            max_length=max_length,
-            **kwargs,
+            text,
+            instructions,
+            {**st, **ex},
         )
-        max_length = max_length // 2
-
-        for i, x in zip(failure_indices, cur_translations):
+        for text, st, ex in zip(texts, searched_tm, examples)
+    ]
+    pending_indices = [i for i, x in enumerate(translations) if x == TRANSLATION_FAILURE]
+    cached = await translation_cache.get_many([cache_keys[i] for i in pending_indices], engine="chatgpt")
+    for i, x in zip(pending_indices, cached):
+        if x is not None:
             translations[i] = x
+            translation_cache.record_saved_tokens("chatgpt", estimate_token_length(texts[i]))
+
+    return translations, searched_tm, examples, cache_keys
+
+
+def _approve_translations(texts: List[str], translations: List[str]) -> List[Tuple[str, str]]:
+    """The (source, translation) pairs that pass the sanity checks, to be saved to the TM."""
+    pairs = [(src, tgt) for src, tgt in zip(texts, translations) if tgt.strip() and tgt != TRANSLATION_FAILURE]
+    length_ratio = sum(len(tgt) for _, tgt in pairs) / max(sum(len(src) for src, _ in pairs), 1)
+    return [(src, tgt) for src, tgt in pairs if _is_plausible_pair(src, tgt, length_ratio)]
+
+
+async def _write_back(tm: "TranslationMemory", approved: Dict[str, List[Tuple[str, str]]], source_language_code: str):
+    """
+    Save the approved ChatGPT translations of each target language to the TM, once per job and in a worker thread,
+    since the TM may wait for the lock of another writer. Failures are logged, the translations are kept anyway.
+    """
+    approved = {lang: pairs for lang, pairs in approved.items() if pairs}
+    if not approved:
+        return
+    logger.debug(f"Write back {sum(len(pairs) for pairs in approved.values())} translations to the TM")
+    translations = {lang: ([src for src, _ in pairs], [tgt for _, tgt in pairs]) for lang, pairs in approved.items()}
+    try:
+        await asyncio.to_thread(tm.write_back_many, translations, source_language_code)
+    except Exception as e:
+        logger.error(f"Failed to write back the translations to the TM {type(e)}: {e}")
+
+
+async def _stream_unique_texts(
+    texts: List[str],
+    source_language_code: str,
+    target_language_code: str,
+    tm: Optional["TranslationMemory"] = None,
+    write_back: bool = False,
+    searched_tm: Optional[List[Dict[str, str]]] = None,
+    sentence_matches: Optional[List[Optional[Tuple[str, str, float]]]] = None,
+    approved: Optional[List[Tuple[str, str]]] = None,
+    **kwargs,
+) -> AsyncIterator[Tuple[List[int], List[str]]]:
+    """
+    With `write_back`, the ChatGPT translations passing the sanity checks are saved to the TM at the end.
+    With `approved`, they're appended to it instead, for the caller to save them along with others.
+    """
+    translations, searched_tm, examples, cache_keys = await _lookup_known_translations(
+        texts,
+        source_language_code,
+        target_language_code,
+        tm=tm,
+        instructions=kwargs.get("instructions", ""),
+        tier=kwargs.get("tier"),
+        searched_tm=searched_tm,
+        sentence_matches=sentence_matches,
+    )
 
-    # If still failed, use google translate
-    if TRANSLATION_FAILURE in translations:
-        failure_indices = [i for i, x in enumerate(translations) if x == TRANSLATION_FAILURE]
-        cur_texts = [texts[i] for i in failure_indices]
-        logger.warning(f"ChatGPT failed. Use Google Translate instead. {len(cur_texts)} sentences. {cur_texts}")
+    finished_indices = [i for i, x in enumerate(translations) if x != TRANSLATION_FAILURE]
+    if finished_indices:
+        yield finished_indices, [translations[i] for i in finished_indices]
+
+    pending_indices = [i for i, x in enumerate(translations) if x == TRANSLATION_FAILURE]
+    if not pending_indices:
+        return
+    cur_texts = [texts[i] for i in pending_indices]
+    cur_tm = [searched_tm[i] for i in pending_indices]
+    cur_examples = [examples[i] for i in pending_indices]
+    google_indices = set()
+    chatgpt_translations = {}
+
+    async def google_fallback(indices: List[int]) -> List[str]:
+        fallback_texts = [cur_texts[j] for j in indices]
+        logger.warning(
+            f"ChatGPT failed. Use Google Translate instead. {len(fallback_texts)} sentences. {fallback_texts}"
+        )
+        google_indices.update(indices)
         try:
-            cur_translations = await google_batch_translate_texts(cur_texts, source_language_code, target_language_code)
+            return await google_batch_translate_texts(fallback_texts, source_language_code, target_language_code)
         except Exception as e:
             logger.error(f"Google Translate failed: {e}")
-            cur_translations = [""] * len(cur_texts)
-        for i, x in zip(failure_indices, cur_translations):
-            translations[i] = x
+            return [""] * len(fallback_texts)
+
+    async for cur_indices, cur_translations in _chatgpt_translate_stream(
+        cur_texts,
+        [TRANSLATION_FAILURE] * len(cur_texts),
+        cur_tm,
+        source_language_code,
+        target_language_code,
+        fallback=google_fallback,
+        examples=cur_examples,
+        **kwargs,
+    ):
+        # Google translations are not cached as ChatGPT translations
+        await translation_cache.set_many(
+            {
+                cache_keys[pending_indices[j]]: x
+                for j, x in zip(cur_indices, cur_translations)
+                if j not in google_indices
+            }
+        )
+        chatgpt_translations.update({j: x for j, x in zip(cur_indices, cur_translations) if j not in google_indices})
+        yield [pending_indices[j] for j in cur_indices], cur_translations
 
-    return translations
+    if (write_back and tm is not None) or approved is not None:
+        pairs = _approve_translations([cur_texts[j] for j in chatgpt_translations], list(chatgpt_translations.values()))
+        if approved is not None:
+            approved.extend(pairs)
+        else:
+            await _write_back(tm, {target_language_code: pairs}, source_language_code)
+
+
+async def batch_translate_texts_multi(
+    texts: List[str],
+    source_language_code: str,
+    target_language_codes: List[str],
+    tm: Optional["TranslationMemory"] = None,
+    progress_callback: Optional[Callable[[int, int], None]] = None,
+    **kwargs,
+) -> Dict[str, List[str]]:
+    """
+    Translate the texts into several target languages. The source sentences, the prompt and the terms are sent
+    once for all the targets. Sentences failed in the multi target requests are translated one target at a time,
+    with the retries and the fallback of `batch_translate_texts`.
+    Return the translations of each target language.
+    """
+    unique_texts, inverse = dedup_texts(texts)
+    occurrences = collections.Counter(inverse)
+    instructions = kwargs.get("instructions", "")
+    write_back = kwargs.pop("write_back", False)
+
+    total = len(texts) * len(target_language_codes)
+    progress = {"finished": 0}
+
+    def report(unique_indices: Iterable[int]):
+        progress["finished"] += sum(occurrences[j] for j in unique_indices)
+        if progress_callback is not None:
+            progress_callback(progress["finished"], total)
+
+    results = {}
+    searched_tms = {}
+    examples = {}
+    cache_keys = {}
+    for lang in target_language_codes:
+        results[lang], searched_tms[lang], examples[lang], cache_keys[lang] = await _lookup_known_translations(
+            unique_texts, source_language_code, lang, tm=tm, instructions=instructions, tier=kwargs.get("tier")
+        )
+        report(j for j, x in enumerate(results[lang]) if x != TRANSLATION_FAILURE)
+
+    # the translations to save to the TM, written once at the end of the job
+    approved: Dict[str, List[Tuple[str, str]]] = {lang: [] for lang in target_language_codes}
+    pending = [j for j in range(len(unique_texts)) if any(x[j] == TRANSLATION_FAILURE for x in results.values())]
+    pending_langs = [
+        lang for lang in target_language_codes if any(results[lang][j] == TRANSLATION_FAILURE for j in pending)
+    ]
+    if len(pending_langs) > 1:
+        async for lang, indices, translations in _chatgpt_translate_multi_stream(
+            [unique_texts[j] for j in pending],
+            {lang: [searched_tms[lang][j] for j in pending] for lang in pending_langs},
+            source_language_code,
+            pending_langs,
+            examples={lang: [examples[lang][j] for j in pending] for lang in pending_langs},
+            **kwargs,
+        ):
+            finished = {
+                pending[k]: x for k, x in zip(indices, translations) if results[lang][pending[k]] == TRANSLATION_FAILURE
+            }
+            for j, x in finished.items():
+                results[lang][j] = x
+            await translation_cache.set_many({cache_keys[lang][j]: x for j, x in finished.items()})
+            if write_back and tm is not None:
+                pairs = _approve_translations([unique_texts[j] for j in finished], list(finished.values()))
+                approved[lang].extend(pairs)
+            report(finished.keys())
+
+    # the rest are translated by the single target path
+    async def translate_rest(lang: str):
+        rest = [j for j, x in enumerate(results[lang]) if x == TRANSLATION_FAILURE]
+        if not rest:
+            return
+        async for indices, translations in _stream_unique_texts(
+            [unique_texts[j] for j in rest],
+            source_language_code,
+            lang,
+            tm=tm,
+            approved=approved[lang] if write_back else None,
+            **kwargs,
+        ):
+            for k, x in zip(indices, translations):
+                results[lang][rest[k]] = x
+            report(rest[k] for k in indices)
+
+    await asyncio.gather(*[translate_rest(lang) for lang in target_language_codes])
+    if write_back and tm is not None:
+        await _write_back(tm, approved, source_language_code)
+
+    return {lang: [results[lang][j] for j in inverse] for lang in target_language_codes}
 
 
 async def translate_text(text, *args, **kwargs):
@@ -1,48 +1,204 @@
-import functools
+import asyncio
+import json
 import os
+import pathlib
 import re
-from typing import List
+import time
+from typing import Dict, List, Optional
 
 import httpx
 import langcodes
-from more_itertools import chunked
+from loguru import logger
+
+from ifuntrans.cache import translation_cache
+from ifuntrans.http_client import get_http_client
+from ifuntrans.languages import LANG_EN_TO_CODE
+from ifuntrans.ratelimit import TokenBucket
 
 GOOGLE_API_KEY = os.environ["GOOGLE_API_KEY"]
 URL = f"https://translation.googleapis.com/language/translate/v2?key={GOOGLE_API_KEY}"
 
+GOOGLE_MAX_SEGMENTS_PER_REQUEST = 128  # Google Translate API has a limit of 128 texts per request
+GOOGLE_MAX_CHARS_PER_REQUEST = int(os.environ.get("GOOGLE_MAX_CHARS_PER_REQUEST", 5000))  # recommended by Google
+GOOGLE_CONCURRENCY = int(os.environ.get("GOOGLE_CONCURRENCY", 8))
+GOOGLE_CHARS_PER_MINUTE = int(os.environ.get("GOOGLE_CHARS_PER_MINUTE", 6000000))  # default project quota
+GOOGLE_MAX_RETRIES = 3
 
-@functools.cache
-def get_supported_languages() -> List[str]:
-    # Get the supported languages from Google
-    url = "https://translation.googleapis.com/language/translate/v2/languages"
-    params = {"key": GOOGLE_API_KEY}
-    response = httpx.get(url, params=params)
-    data = response.json()
-    return [d["language"] for d in data["data"]["languages"]]
+google_quota = TokenBucket(GOOGLE_CHARS_PER_MINUTE, period=60)
+
+GOOGLE_LANGUAGES_URL = "https://translation.googleapis.com/language/translate/v2/languages"
+GOOGLE_LANGUAGES_SNAPSHOT = (pathlib.Path(__file__).parent / "google_languages.json").as_posix()
+GOOGLE_LANGUAGES_CACHE = os.environ.get(
+    "GOOGLE_LANGUAGES_CACHE", (pathlib.Path.home() / ".cache" / "ifuntrans" / "google_languages.json").as_posix()
+)
+GOOGLE_LANGUAGES_TTL = int(os.environ.get("GOOGLE_LANGUAGES_TTL", 24 * 60 * 60))  # seconds
+
+
+class SupportedLanguageRegistry(object):
+    """
+    Languages supported by Google Translate. Loaded from an on-disk snapshot (the refreshed cache,
+    or the one bundled with the package) and refreshed in the background once it's older than the TTL.
+    The closest supported match of every code in `LANG_EN_TO_CODE` is precomputed.
+    """
+
+    def __init__(
+        self,
+        snapshot_paths: Optional[List[str]] = None,
+        ttl: int = GOOGLE_LANGUAGES_TTL,
+    ):
+        self.snapshot_paths = snapshot_paths or [GOOGLE_LANGUAGES_CACHE, GOOGLE_LANGUAGES_SNAPSHOT]
+        self.ttl = ttl
+        self.languages: List[str] = []
+        self.updated_at = 0.0
+        self._matches: Dict[str, Optional[str]] = {}
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    @property
+    def is_stale(self) -> bool:
+        return time.time() - self.updated_at > self.ttl
+
+    def _set_languages(self, languages: List[str], updated_at: float):
+        self.languages = languages
+        self.updated_at = updated_at
+        self._matches = {lang: lang for lang in languages}
+        for code in LANG_EN_TO_CODE.values():
+            self.match(code)
+
+    def load_snapshot(self) -> bool:
+        for path in self.snapshot_paths:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            self._set_languages(snapshot["languages"], snapshot.get("updated_at", 0))
+            return True
+        return False
+
+    async def refresh(self):
+        """Fetch the supported languages from Google and persist them to the cache snapshot."""
+        response = await get_http_client("google").get(GOOGLE_LANGUAGES_URL, params={"key": GOOGLE_API_KEY})
+        data = response.json()
+        self._set_languages([d["language"] for d in data["data"]["languages"]], time.time())
+
+        try:
+            os.makedirs(os.path.dirname(self.snapshot_paths[0]), exist_ok=True)
+            tmp_path = f"{self.snapshot_paths[0]}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"updated_at": self.updated_at, "languages": self.languages}, f)
+            os.replace(tmp_path, self.snapshot_paths[0])
+        except OSError as e:
+            logger.warning(f"Failed to save Google supported languages snapshot: {e}")
+
+    async def _background_refresh(self):
+        try:
+            await self.refresh()
+        except Exception as e:
+            logger.warning(f"Failed to refresh Google supported languages {type(e)}: {e}")
+        finally:
+            self._refresh_task = None
+
+    async def ensure_loaded(self):
+        if not self.languages and not self.load_snapshot():
+            await self.refresh()
+        elif self.is_stale and self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._background_refresh())
+
+    def match(self, code: str) -> Optional[str]:
+        """Get the closest supported language code."""
+        if code not in self._matches:
+            self._matches[code] = langcodes.closest_supported_match(code, self.languages)
+        return self._matches[code]
+
+
+supported_languages = SupportedLanguageRegistry()
 
 
-async def batch_translate_texts(texts: List[str], source_language_code: str, target_language_code: str, **kwargs) -> List[str]:
-    supported_languages = get_supported_languages()
-    if target_language_code not in supported_languages:
-        target_language_code = langcodes.closest_supported_match(target_language_code, supported_languages)
-        if not target_language_code:
-            raise ValueError(f"Language code {target_language_code} is not supported by Google Translate.")
+async def warm_up():
+    await supported_languages.ensure_loaded()
 
-    if source_language_code not in supported_languages:
-        source_language_code = langcodes.closest_supported_match(source_language_code, supported_languages)
-        if not source_language_code:
-            raise ValueError(f"Language code {source_language_code} is not supported by Google Translate.")
+
+async def get_supported_languages() -> List[str]:
+    await supported_languages.ensure_loaded()
+    return supported_languages.languages
+
+
+def _pack_chunks(
+    texts: List[str],
+    max_segments: int = GOOGLE_MAX_SEGMENTS_PER_REQUEST,
+    max_chars: int = GOOGLE_MAX_CHARS_PER_REQUEST,
+) -> List[List[str]]:
+    """Pack texts into chunks by both the number of segments and the character payload."""
+    chunks = []
+    chunk = []
+    chunk_chars = 0
+    for text in texts:
+        if chunk and (len(chunk) >= max_segments or chunk_chars + len(text) > max_chars):
+            chunks.append(chunk)
+            chunk = []
+            chunk_chars = 0
+        chunk.append(text)
+        chunk_chars += len(text)
+
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+async def _translate_chunk(
+    client: httpx.AsyncClient, chunk: List[str], source_language_code: str, target_language_code: str
+) -> List[str]:
+    payload = {"q": chunk, "target": target_language_code, "source": source_language_code}
+    # the rejected requests are not charged by Google, so the characters are reserved once for the retries
+    await google_quota.acquire(sum(len(text) for text in chunk))
+    for attempt in range(GOOGLE_MAX_RETRIES):
+        response = await client.post(URL, json=payload)
+        # 403 is returned by Google when the rate limit quota is exceeded
+        if response.status_code in (403, 429) and attempt < GOOGLE_MAX_RETRIES - 1:
+            logger.warning(f"Google Translate rate limited ({response.status_code}). Retry in {2 ** attempt}s")
+            await asyncio.sleep(2**attempt)
+            continue
+        break
+
+    response.raise_for_status()
+    data = response.json()
+    return [d["translatedText"] for d in data["data"]["translations"]]
+
+
+async def batch_translate_texts(
+    texts: List[str], source_language_code: str, target_language_code: str, **kwargs
+) -> List[str]:
+    await supported_languages.ensure_loaded()
+    for code in (target_language_code, source_language_code):
+        if not supported_languages.match(code):
+            raise ValueError(f"Language code {code} is not supported by Google Translate.")
+    target_language_code = supported_languages.match(target_language_code)
+    source_language_code = supported_languages.match(source_language_code)
 
     if source_language_code == target_language_code:
         return texts
 
-    translations = []
-    for chunk in chunked(texts, 128):  # Google Translate API has a limit of 128 texts per request
-        payload = {"q": chunk, "target": target_language_code, "source": source_language_code}
-        async with httpx.AsyncClient() as client:
-            response = await client.post(URL, json=payload)
-            data = response.json()
-            translations.extend([d["translatedText"] for d in data["data"]["translations"]])
+    cache_keys = [
+        translation_cache.make_key("google", "v2", source_language_code, target_language_code, text) for text in texts
+    ]
+    translations = await translation_cache.get_many(cache_keys, engine="google")
+    missing_indices = [i for i, x in enumerate(translations) if x is None]
+    missing_texts = [texts[i] for i in missing_indices]
+
+    client = get_http_client("google")
+    semaphore = asyncio.Semaphore(GOOGLE_CONCURRENCY)
+
+    async def translate_chunk(chunk: List[str]) -> List[str]:
+        async with semaphore:
+            return await _translate_chunk(client, chunk, source_language_code, target_language_code)
+
+    # gather keeps the order of the chunks
+    chunk_translations = await asyncio.gather(*[translate_chunk(chunk) for chunk in _pack_chunks(missing_texts)])
+    missing_translations = [x for chunk in chunk_translations for x in chunk]
+
+    for i, x in zip(missing_indices, missing_translations):
+        translations[i] = x
+    await translation_cache.set_many({cache_keys[i]: translations[i] for i in missing_indices})
 
     return translations
 
@@ -0,0 +1,171 @@
+"""Segment level translation cache. A bounded in-process LRU in front of redis."""
+import hashlib
+import json
+import os
+import time
+import zlib
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+
+from ifuntrans.placeholder import canonicalize_text
+
+CACHE_ENABLED = os.environ.get("IFUNTRANS_CACHE", "1") not in ("0", "false", "False", "")
+CACHE_SIZE = int(os.environ.get("IFUNTRANS_CACHE_SIZE", 100000))
+CACHE_TTL = int(os.environ.get("IFUNTRANS_CACHE_TTL", 30 * 24 * 60 * 60))  # seconds, 0 means never expire
+CACHE_COMPRESS_THRESHOLD = 256  # bytes
+
+KEY_PREFIX = "ifuntrans:tr:"
+
+
+class LRUCache(object):
+    """A bounded LRU cache with optional per-item expiration."""
+
+    def __init__(self, maxsize: int = CACHE_SIZE, ttl: int = 0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return default
+
+        expire_at, value = item
+        if expire_at and expire_at < time.monotonic():
+            del self._data[key]
+            return default
+
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Any, value: Any):
+        expire_at = time.monotonic() + self.ttl if self.ttl else 0
+        self._data[key] = (expire_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key: Any) -> bool:
+        return self.get(key, None) is not None
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def _encode_value(value: str) -> bytes:
+    data = value.encode("utf-8")
+    if len(data) >= CACHE_COMPRESS_THRESHOLD:
+        return b"z" + zlib.compress(data)
+    return b"r" + data
+
+
+def _decode_value(data: bytes) -> str:
+    if data[:1] == b"z":
+        return zlib.decompress(data[1:]).decode("utf-8")
+    return data[1:].decode("utf-8")
+
+
+class TranslationCache(object):
+    """
+    Two tiers translation cache. Lookups hit the in-process LRU first, then redis (if configured).
+    Redis errors are logged and the cache degrades to the in-process tier.
+    """
+
+    def __init__(self, maxsize: int = CACHE_SIZE, ttl: int = CACHE_TTL, enabled: bool = CACHE_ENABLED):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.local = LRUCache(maxsize, ttl)
+        self.redis = None
+        self.counters: Dict[str, Dict[str, int]] = defaultdict(lambda: {"hits": 0, "misses": 0, "saved_tokens": 0})
+
+    def set_redis(self, redis_client):
+        """Set the redis client. The client must not decode responses, values are stored as bytes."""
+        self.redis = redis_client
+
+    @staticmethod
+    def make_key(
+        engine: str,
+        model: str,
+        source_lang: str,
+        target_lang: str,
+        text: str,
+        instructions: str = "",
+        terms: Optional[Dict[str, str]] = None,
+    ) -> str:
+        """Build the cache key of a segment."""
+        instructions_hash = hashlib.sha1(instructions.strip().encode("utf-8")).hexdigest() if instructions else ""
+        terms_hash = (
+            hashlib.sha1(json.dumps(terms, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+            if terms
+            else ""
+        )
+        payload = "\x1f".join(
+            [engine, model, source_lang, target_lang, canonicalize_text(text), instructions_hash, terms_hash]
+        )
+        return KEY_PREFIX + hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    async def get_many(self, keys: List[str], engine: str = "default") -> List[Optional[str]]:
+        """Get the cached translations of the keys. Missing keys are None."""
+        if not self.enabled:
+            return [None] * len(keys)
+
+        results = [self.local.get(key) for key in keys]
+        missing = [i for i, r in enumerate(results) if r is None]
+
+        if missing and self.redis is not None:
+            try:
+                values = await self.redis.mget([keys[i] for i in missing])
+            except Exception as e:
+                logger.warning(f"Translation cache redis mget failed {type(e)}: {e}")
+                values = [None] * len(missing)
+
+            for i, value in zip(missing, values):
+                if value is not None:
+                    results[i] = _decode_value(value)
+                    self.local.set(keys[i], results[i])
+
+        counter = self.counters[engine]
+        hits = sum(r is not None for r in results)
+        counter["hits"] += hits
+        counter["misses"] += len(results) - hits
+        return results
+
+    async def set_many(self, mapping: Dict[str, str]):
+        """Write translations into both tiers. Redis writes are pipelined."""
+        if not self.enabled or not mapping:
+            return
+
+        for key, value in mapping.items():
+            self.local.set(key, value)
+
+        if self.redis is not None:
+            try:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for key, value in mapping.items():
+                        pipe.set(key, _encode_value(value), ex=self.ttl or None)
+                    await pipe.execute()
+            except Exception as e:
+                logger.warning(f"Translation cache redis pipeline failed {type(e)}: {e}")
+
+    def record_saved_tokens(self, engine: str, num_tokens: int):
+        self.counters[engine]["saved_tokens"] += num_tokens
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "local_size": len(self.local),
+            "redis": self.redis is not None,
+            "engines": {engine: dict(counter) for engine, counter in self.counters.items()},
+        }
+
+    def clear(self):
+        self.local.clear()
+        self.counters.clear()
+
+
+translation_cache = TranslationCache()
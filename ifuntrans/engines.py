@@ -0,0 +1,119 @@
+"""Registry of the translation engines, selected per call"""
+import asyncio
+import importlib
+import os
+from typing import Any, Dict, List, Optional, Union
+
+from loguru import logger
+
+DEFAULT_ENGINE = os.environ.get("IFUNTRANS_ENGINE", "chatgpt")
+# Number of batch translation jobs each engine runs at the same time, the others wait in their own queue
+ENGINE_MAX_JOBS = int(os.environ.get("IFUNTRANS_ENGINE_MAX_JOBS", 16))
+
+
+class Engine(object):
+    """
+    A translation engine. The implementation is a module (or any object) with `batch_translate_texts` and
+    `translate_text`, and optionally `warm_up`. It's imported on first use, so engines that are not used
+    don't need to be configured. Each engine owns its pool of concurrent jobs, so the backlog of one engine
+    doesn't hold back the others.
+    """
+
+    def __init__(self, name: str, target: Union[str, Any], description: str = "", max_jobs: int = ENGINE_MAX_JOBS):
+        self.name = name
+        self.description = description or name
+        self.max_jobs = max_jobs
+        self._target = target
+        self._module = None if isinstance(target, str) else target
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._semaphore_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def module(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._target)
+        return self._module
+
+    def supports(self, name: str) -> bool:
+        """Whether the engine implements the optional function, e.g. `batch_translate_texts_multi`."""
+        return hasattr(self.module, name)
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_jobs)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    async def _run(self, func_name: str, *args, **kwargs):
+        async with self._get_semaphore():
+            return await getattr(self.module, func_name)(*args, **kwargs)
+
+    async def batch_translate_texts(
+        self, texts: List[str], source_language_code: str, target_language_code: str, **kwargs
+    ):
+        return await self._run("batch_translate_texts", texts, source_language_code, target_language_code, **kwargs)
+
+    async def batch_translate_texts_multi(
+        self, texts: List[str], source_language_code: str, target_language_codes: List[str], **kwargs
+    ):
+        return await self._run(
+            "batch_translate_texts_multi", texts, source_language_code, target_language_codes, **kwargs
+        )
+
+    async def translate_text(self, text: str, source_language_code: str, target_language_code: str):
+        return await self._run("translate_text", text, source_language_code, target_language_code)
+
+    async def warm_up(self):
+        """Import the engine and prepare it, e.g. load the supported languages."""
+        if self.supports("warm_up"):
+            await self.module.warm_up()
+
+
+class EngineRegistry(object):
+    """Engines by name"""
+
+    def __init__(self):
+        self._engines: Dict[str, Engine] = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._engines
+
+    def __iter__(self):
+        return iter(self._engines.values())
+
+    def register(self, name: str, target: Union[str, Any], description: str = "", **kwargs) -> Engine:
+        """
+        Register an engine by the import path of its module, or by the implementation itself.
+        An engine of the same name is replaced.
+        """
+        engine = Engine(name, target, description, **kwargs)
+        self._engines[name] = engine
+        return engine
+
+    def unregister(self, name: str):
+        self._engines.pop(name, None)
+
+    def get(self, name: Optional[str] = None) -> Engine:
+        """Get the engine by name, default to IFUNTRANS_ENGINE."""
+        name = name or DEFAULT_ENGINE
+        if name not in self._engines:
+            raise ValueError(f"Unknown engine {name}")
+        return self._engines[name]
+
+    def descriptions(self) -> Dict[str, str]:
+        return {engine.name: engine.description for engine in self}
+
+    async def warm_up(self, names: Optional[List[str]] = None):
+        for engine in self:
+            if names is None or engine.name in names:
+                logger.info(f"Warm up engine {engine.name}")
+                await engine.warm_up()
+
+
+engine_registry = EngineRegistry()
+engine_registry.register("google", "ifuntrans.async_translators.google", "Google翻译")
+engine_registry.register("chatgpt", "ifuntrans.async_translators.chatgpt", "ChatGPT")
+
+register_engine = engine_registry.register
+get_engine = engine_registry.get
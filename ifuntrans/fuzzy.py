@@ -0,0 +1,147 @@
+"""Sentence level TM matching: exact hits by the normalized text, fuzzy hits by n-grams and edit distance"""
+import collections
+import os
+import pickle
+import unicodedata
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import regex
+
+NGRAM_SIZE = 3
+MAX_CANDIDATES = 5
+# n-grams shared by more sentences than this are too common to find candidates by
+MAX_POSTINGS = 2000
+
+
+def normalize(text: str) -> str:
+    """The key of exact hits: NFKC, with the whitespaces collapsed."""
+    return regex.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def ngrams(text: str, n: int = NGRAM_SIZE) -> List[str]:
+    text = text.lower()
+    if len(text) <= n:
+        return [text] if text else []
+    return [text[i : i + n] for i in range(len(text) - n + 1)]
+
+
+def levenshtein(a: str, b: str) -> int:
+    """Edit distance by the bit-parallel algorithm of Myers/Hyyrö, linear in the length of the longer text."""
+    if len(a) < len(b):
+        a, b = b, a
+    m = len(b)
+    if m == 0:
+        return len(a)
+
+    peq: Dict[str, int] = {}
+    for i, char in enumerate(b):
+        peq[char] = peq.get(char, 0) | (1 << i)
+
+    full = (1 << m) - 1
+    last = 1 << (m - 1)
+    pv, mv, score = full, 0, m
+    for char in a:
+        eq = peq.get(char, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = (mv | ~(xh | pv)) & full
+        mh = pv & xh
+        if ph & last:
+            score += 1
+        elif mh & last:
+            score -= 1
+        ph = ((ph << 1) | 1) & full
+        mh = (mh << 1) & full
+        pv = (mh | ~(xv | ph)) & full
+        mv = ph & xv
+    return score
+
+
+def similarity(a: str, b: str) -> float:
+    if not a and not b:
+        return 1.0
+    return 1 - levenshtein(a, b) / max(len(a), len(b))
+
+
+class SentenceIndex(object):
+    """
+    Index of the TM sentences in a language. Exact hits are looked up by the normalized text in O(1).
+    Fuzzy candidates are the sentences sharing the most character n-grams, and are scored by the edit distance.
+    """
+
+    def __init__(self, sentences: Iterable[str]):
+        # sentence id -> the normalized sentence, and the positions of the sentence in `sentences`
+        self.sentences: List[str] = []
+        self.rows: List[List[int]] = []
+        self.num_rows = 0
+        self._ids: Dict[str, int] = {}
+        self._postings: Dict[str, List[int]] = {}
+        self._num_ngrams: List[int] = []
+        self.add(sentences)
+
+    def add(self, sentences: Iterable[str]):
+        """Add the sentences of the rows following the existing ones."""
+        for sentence in sentences:
+            row = self.num_rows
+            self.num_rows += 1
+            key = normalize(sentence)
+            if not key:
+                continue
+            if key not in self._ids:
+                sentence_id = len(self.sentences)
+                self._ids[key] = sentence_id
+                self.sentences.append(key)
+                self.rows.append([])
+                grams = set(ngrams(key))
+                self._num_ngrams.append(len(grams))
+                for gram in grams:
+                    postings = self._postings.get(gram)
+                    if postings is None:
+                        self._postings[gram] = [sentence_id]
+                    else:
+                        postings.append(sentence_id)
+            self.rows[self._ids[key]].append(row)
+
+    def __len__(self) -> int:
+        return len(self.sentences)
+
+    def exact(self, text: str) -> Optional[int]:
+        return self._ids.get(normalize(text))
+
+    def fuzzy(self, text: str, threshold: float, max_candidates: int = MAX_CANDIDATES) -> List[Tuple[int, float]]:
+        """Sentences similar to the text by at least the threshold, as (sentence id, similarity), best first."""
+        key = normalize(text)
+        grams = set(ngrams(key))
+        if not grams:
+            return []
+
+        shared = collections.Counter()
+        for gram in grams:
+            postings = self._postings.get(gram)
+            if postings is not None and len(postings) <= MAX_POSTINGS:
+                shared.update(postings)
+
+        # rank the candidates by the dice coefficient of the n-grams, and skip those can't reach the threshold
+        # because of the difference of the lengths
+        candidates = []
+        for sentence_id, count in shared.items():
+            length = len(self.sentences[sentence_id])
+            if min(length, len(key)) / max(length, len(key)) < threshold:
+                continue
+            candidates.append((2 * count / (len(grams) + self._num_ngrams[sentence_id]), sentence_id))
+        candidates = sorted(candidates, reverse=True)[:max_candidates]
+
+        matches = [(sentence_id, similarity(key, self.sentences[sentence_id])) for _, sentence_id in candidates]
+        return sorted([x for x in matches if x[1] >= threshold], key=lambda x: -x[1])
+
+    def save(self, path: str):
+        """Save the built index. The file is replaced atomically."""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str) -> "SentenceIndex":
+        with open(path, "rb") as f:
+            return pickle.load(f)
@@ -0,0 +1,163 @@
+"""Find glossary terms in texts by an Aho-Corasick automaton"""
+import os
+import pickle
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import regex
+
+# "longest": leftmost longest terms that don't overlap, "overlap": every term found in the text
+POLICY_LONGEST = "longest"
+POLICY_OVERLAP = "overlap"
+
+# A letter or digit of a script that separates words by spaces. Terms starting or ending with one only match whole
+# words, e.g. "Art" is not found in "Start". Terms in CJK, Thai etc. are matched as substrings.
+_SPACED_WORD_CHAR = regex.compile(r"[^\W\p{Han}\p{Hiragana}\p{Katakana}\p{Hangul}\p{Thai}\p{Lao}\p{Khmer}\p{Myanmar}]")
+
+
+class GlossaryMatcher(object):
+    """
+    Multi-pattern matcher of the glossary terms, case insensitive. The automaton is built once, and finds all the
+    terms in a text in a single pass over it, no matter how many terms there are. Terms of space-delimited scripts
+    only match at word boundaries.
+    """
+
+    def __init__(self, terms: Iterable[str]):
+        # pattern id -> the term as first seen, and the positions of the term in `terms`
+        self.terms: List[str] = []
+        self.rows: List[List[int]] = []
+        self.num_rows = 0
+        self._pattern_ids: Dict[str, int] = {}
+        # terms added after the automaton is built are matched by a small automaton of their own
+        self._added: Optional["GlossaryMatcher"] = None
+        self._added_ids: List[int] = []
+        for term in terms:
+            self._add_term(term)
+
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[int] = [-1]  # the pattern ending at the node
+        self._output_link: List[int] = [-1]  # the nearest node on the fail chain that has an output
+        self._lengths: List[int] = [len(term.lower()) for term in self.terms]
+        # whether the term must start / end at a word boundary
+        self._bounded: List[Tuple[bool, bool]] = [
+            (bool(_SPACED_WORD_CHAR.match(term.lower()[0])), bool(_SPACED_WORD_CHAR.match(term.lower()[-1])))
+            for term in self.terms
+        ]
+
+        for pattern_id, term in enumerate(self.terms):
+            node = 0
+            for char in term.lower():
+                child = self._goto[node].get(char)
+                if child is None:
+                    child = len(self._goto)
+                    self._goto[node][char] = child
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(-1)
+                    self._output_link.append(-1)
+                node = child
+            self._output[node] = pattern_id
+        self._build_links()
+
+    def _add_term(self, term: str) -> Optional[int]:
+        """Add the term of the next row, return its pattern id if it's a new one."""
+        row = self.num_rows
+        self.num_rows += 1
+        key = term.strip().lower()
+        if not key:
+            return None
+        pattern_id = self._pattern_ids.get(key)
+        if pattern_id is not None:
+            self.rows[pattern_id].append(row)
+            return None
+        pattern_id = self._pattern_ids[key] = len(self.terms)
+        self.terms.append(term.strip())
+        self.rows.append([row])
+        return pattern_id
+
+    def add(self, terms: Iterable[str]):
+        """
+        Add the terms of the rows following the existing ones. The automaton is not rebuilt, the new terms are
+        matched by a separate one over the added terms only.
+        """
+        new_ids = [pattern_id for pattern_id in map(self._add_term, terms) if pattern_id is not None]
+        if new_ids:
+            added_ids = self._added_ids + new_ids
+            added = GlossaryMatcher(self.terms[pattern_id] for pattern_id in added_ids)
+            self._added, self._added_ids = added, added_ids
+
+    def _build_links(self):
+        queue = list(self._goto[0].values())
+        for node in queue:
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[child] = fail
+                self._output_link[child] = fail if self._output[fail] != -1 else self._output_link[fail]
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    def find_all(self, text: str) -> List[Tuple[int, int, int]]:
+        """All the occurrences of the terms as (start, end, pattern id), overlapping ones included."""
+        goto, fail, output, output_link = self._goto, self._fail, self._output, self._output_link
+        lengths, bounded = self._lengths, self._bounded
+        text = text.lower()
+
+        def is_word_char(position: int) -> bool:
+            return 0 <= position < len(text) and _SPACED_WORD_CHAR.match(text[position]) is not None
+
+        matches = []
+        node = 0
+        for end, char in enumerate(text, 1):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+
+            found = node if output[node] != -1 else output_link[node]
+            while found != -1:
+                pattern_id = output[found]
+                start = end - lengths[pattern_id]
+                bounded_start, bounded_end = bounded[pattern_id]
+                if not (bounded_start and is_word_char(start - 1)) and not (bounded_end and is_word_char(end)):
+                    matches.append((start, end, pattern_id))
+                found = output_link[found]
+
+        if self._added is not None:
+            matches.extend((start, end, self._added_ids[k]) for start, end, k in self._added.find_all(text))
+        return matches
+
+    def match(self, text: str, policy: str = POLICY_OVERLAP) -> List[Tuple[int, int, int]]:
+        """Occurrences of the terms by the policy, as (start, end, pattern id) in the order of the text."""
+        matches = sorted(self.find_all(text), key=lambda x: (x[0], x[0] - x[1]))
+        if policy == POLICY_OVERLAP:
+            return matches
+        if policy != POLICY_LONGEST:
+            raise ValueError(f"Unknown glossary match policy {policy}")
+
+        selected = []
+        last_end = 0
+        for start, end, pattern_id in matches:
+            if start >= last_end:
+                selected.append((start, end, pattern_id))
+                last_end = end
+        return selected
+
+    def find_terms(self, text: str, policy: str = POLICY_OVERLAP) -> List[str]:
+        """The distinct terms found in the text."""
+        return [self.terms[pattern_id] for pattern_id in dict.fromkeys(x[2] for x in self.match(text, policy))]
+
+    def save(self, path: str):
+        """Save the built automaton. The file is replaced atomically."""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str) -> "GlossaryMatcher":
+        with open(path, "rb") as f:
+            return pickle.load(f)
@@ -0,0 +1,93 @@
+"""Shared, long-lived HTTP client pool"""
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import Dict, Tuple
+
+import httpx
+from loguru import logger
+
+HTTP2 = os.environ.get("IFUNTRANS_HTTP2", "0") not in ("0", "false", "False", "")
+HTTP_MAX_CONNECTIONS = int(os.environ.get("IFUNTRANS_HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("IFUNTRANS_HTTP_MAX_KEEPALIVE_CONNECTIONS", 20))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("IFUNTRANS_HTTP_KEEPALIVE_EXPIRY", 60))
+HTTP_TIMEOUT = float(os.environ.get("IFUNTRANS_HTTP_TIMEOUT", 30))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("IFUNTRANS_HTTP_CONNECT_TIMEOUT", 10))
+
+DEFAULT_CLIENT = "default"
+
+# Named clients, so that each engine owns its connection pool. Each one is bound to the event loop it's created in.
+_clients: Dict[str, Tuple[httpx.AsyncClient, asyncio.AbstractEventLoop]] = {}
+
+
+def _create_client() -> httpx.AsyncClient:
+    http2 = HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("IFUNTRANS_HTTP2 is set but h2 is not installed. Fallback to HTTP/1.1")
+            http2 = False
+
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+    )
+
+
+def _discard_client(name: str, client: httpx.AsyncClient, client_loop: asyncio.AbstractEventLoop):
+    """
+    Drop a client bound to another event loop. Its connections can only be closed on that loop, so it's closed there
+    if the loop is still running, otherwise the pool is released with the client.
+    """
+    _clients.pop(name, None)
+    if client.is_closed:
+        return
+    if client_loop.is_running() and not client_loop.is_closed():
+        asyncio.run_coroutine_threadsafe(client.aclose(), client_loop)
+    else:
+        logger.debug(f"Drop the HTTP client {name} of a stopped event loop")
+
+
+def get_http_client(name: str = DEFAULT_CLIENT) -> httpx.AsyncClient:
+    """
+    Get the shared HTTP client of the name. It is created lazily if it hasn't been initialized,
+    or if the current event loop is not the one the client was created in.
+    """
+    loop = asyncio.get_running_loop()
+    client, client_loop = _clients.get(name, (None, None))
+    if client is None or client.is_closed or client_loop is not loop:
+        if client is not None:
+            _discard_client(name, client, client_loop)
+        client = _create_client()
+        _clients[name] = (client, loop)
+    return client
+
+
+async def init_http_client() -> httpx.AsyncClient:
+    """Create the shared HTTP client. Called at the startup of the server and CLI."""
+    return get_http_client()
+
+
+async def close_http_client():
+    """Close all the shared HTTP clients and release all the pooled connections."""
+    loop = asyncio.get_running_loop()
+    for client, client_loop in list(_clients.values()):
+        if not client.is_closed and client_loop is loop:
+            await client.aclose()
+    _clients.clear()
+
+
+@asynccontextmanager
+async def http_client_lifespan():
+    """Keep the shared HTTP client alive within the context."""
+    client = await init_http_client()
+    try:
+        yield client
+    finally:
+        await close_http_client()
@@ -1,18 +1,122 @@
+import hashlib
 import os
-
-import httpx
 import re
+from collections import Counter
+from typing import Optional
+
+import regex
+from opencc import OpenCC
+
+from ifuntrans.cache import LRUCache
+from ifuntrans.http_client import get_http_client
 
 GOOGLE_API_KEY = os.environ["GOOGLE_API_KEY"]
 URL = f"https://translation.googleapis.com/language/translate/v2/detect"
 
+DETECTION_CACHE_SIZE = int(os.environ.get("IFUNTRANS_DETECTION_CACHE_SIZE", 10000))
+MIN_SCRIPT_RATIO = 0.6  # the dominant script must cover at least this ratio of the letters
+# Han text without kana could also be Japanese (e.g. "設定", "東京"), unless it's at least this long
+MIN_HAN_LENGTH = 8
+
+# scripts that are (practically) used by a single language, in the form of Google language codes
+SINGLE_LANGUAGE_SCRIPTS = {
+    "Hangul": "ko",
+    "Thai": "th",
+    "Greek": "el",
+    "Hebrew": "iw",
+    "Georgian": "ka",
+    "Armenian": "hy",
+    "Khmer": "km",
+    "Lao": "lo",
+    "Myanmar": "my",
+}
+SCRIPTS = ["Han", "Hiragana", "Katakana", "Cyrillic", "Latin", "Arabic", "Devanagari"] + list(SINGLE_LANGUAGE_SCRIPTS)
+SCRIPT_REGEXES = {script: regex.compile(rf"\p{{{script}}}") for script in SCRIPTS}
+
+RUSSIAN_LETTERS = set("абвгдеёжзийклмнопрстуфхцчшщъыьэюя")
+
+t2s = OpenCC("t2s.json")
+s2t = OpenCC("s2t.json")
+t2jp = OpenCC("t2jp.json")
+_detection_cache = LRUCache(DETECTION_CACHE_SIZE)
+
+
+def _script_of(char: str) -> Optional[str]:
+    for script, pattern in SCRIPT_REGEXES.items():
+        if pattern.match(char):
+            return script
+    return None
+
+
+def _detect_cyrillic(letters: str) -> Optional[str]:
+    letters = set(letters.lower())
+    if letters & set("ґєії") and not letters & set("ыэё"):
+        return "uk"
+    if letters - RUSSIAN_LETTERS:
+        # Belarusian, Serbian, Kazakh, Mongolian etc. use letters out of the Russian alphabet
+        return None
+    if letters & set("ыэё"):
+        return "ru"
+    # Russian alphabet without the distinctive letters could also be Bulgarian
+    return None
+
+
+def _is_simplified_only(char: str) -> bool:
+    """Simplified Chinese character that is not the Japanese form too, e.g. "这" but not "国"."""
+    traditional = s2t.convert(char)
+    return traditional != char and t2jp.convert(traditional) != char
+
+
+def _detect_han(han: str) -> Optional[str]:
+    if any(_is_simplified_only(char) for char in set(han)):
+        return "zh-CN"
+    if len(han) < MIN_HAN_LENGTH:
+        return None
+    return "zh-CN" if t2s.convert(han) == han else "zh-TW"
+
+
+def local_detection(text: str) -> Optional[str]:
+    """
+    Detect the language by script statistics. Return None if the result is ambiguous.
+    """
+    letters = regex.findall(r"\p{L}", text)
+    if len(letters) < 2:
+        return None
+
+    counter = Counter(_script_of(char) for char in letters)
+    kana = counter["Hiragana"] + counter["Katakana"]
+    if kana and (kana + counter["Han"]) / len(letters) >= MIN_SCRIPT_RATIO:
+        return "ja"
+
+    script, count = counter.most_common(1)[0]
+    if count / len(letters) < MIN_SCRIPT_RATIO:
+        return None
+
+    if script in SINGLE_LANGUAGE_SCRIPTS:
+        return SINGLE_LANGUAGE_SCRIPTS[script]
+    if script == "Han":
+        return _detect_han("".join(char for char in letters if SCRIPT_REGEXES["Han"].match(char)))
+    if script == "Cyrillic":
+        return _detect_cyrillic("".join(char for char in letters if SCRIPT_REGEXES["Cyrillic"].match(char)))
+    return None
+
+
+async def remote_detection(text: str) -> str:
+    """Detect the language by Google Translate API."""
+    params = {"q": text, "key": GOOGLE_API_KEY}
+    response = await get_http_client().get(URL, params=params)
+    data = response.json()
+    return data["data"]["detections"][0][0]["language"]
+
 
 async def single_detection(text):
-    re.sub(r"\s+", " ", text)
+    text = re.sub(r"\s+", " ", text)
     if len(text) > 500:
         text = text[:500]
-    params = {"q": text, "key": GOOGLE_API_KEY}
-    async with httpx.AsyncClient() as client:
-        response = await client.get(URL, params=params)
-        data = response.json()
-        return data["data"]["detections"][0][0]["language"]
+
+    key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+    lang = _detection_cache.get(key)
+    if lang is None:
+        lang = local_detection(text) or await remote_detection(text)
+        _detection_cache.set(key, lang)
+    return lang
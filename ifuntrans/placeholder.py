@@ -1,5 +1,6 @@
 import re
-from typing import List
+import unicodedata
+from typing import List, Tuple
 
 
 def _split_text_help_func(match_obj: re.Match):
@@ -19,11 +20,50 @@ def split_text(text: str):
     text = text.replace(r"\n", "\n")
     # 这里只对较短的文本做换行符合并处理，过长的内容处理会出问题
     if len(text.split()) < 5:
-      text = re.sub(r"[A-Za-z](\s*[\n|\r]+\s*)[A-Za-z]", _split_text_help_func, text)
+        text = re.sub(r"[A-Za-z](\s*[\n|\r]+\s*)[A-Za-z]", _split_text_help_func, text)
     sents = re.split(r"([\n\r]+)", text)
     return sents
 
 
+def canonicalize_text(text: str) -> str:
+    """
+    Canonicalize text for comparison. Normalize unicode and collapse the blanks in each line, line breaks are kept
+    since they are part of the translation.
+
+    Args:
+        text (str): the text to be canonicalized
+
+    Returns:
+        str: the canonical text
+    """
+    text = unicodedata.normalize("NFC", text).replace("\r\n", "\n").replace("\r", "\n")
+    text = re.sub(r"[^\S\n]+", " ", text)
+    return re.sub(r" ?\n ?", "\n", text).strip()
+
+
+def dedup_texts(texts: List[str]) -> Tuple[List[str], List[int]]:
+    """
+    Collapse the texts which are equal after canonicalization. The case is kept, e.g. "US" and "us" or "Confirm" and
+    "confirm" may need different translations.
+
+    Args:
+        texts (List[str]): the texts to be deduplicated
+
+    Returns:
+        Tuple[List[str], List[int]]: the unique texts (first occurrence) and the index of the unique text for each text
+    """
+    unique_texts = []
+    inverse = []
+    seen = {}
+    for text in texts:
+        key = canonicalize_text(text)
+        if key not in seen:
+            seen[key] = len(unique_texts)
+            unique_texts.append(text)
+        inverse.append(seen[key])
+    return unique_texts, inverse
+
+
 def normalize_case(text: str) -> str:
     if text.isupper():
         if len(text.split()) < 4:
@@ -0,0 +1,191 @@
+"""Client side rate limiting for upstream translation APIs"""
+import asyncio
+import collections
+import time
+from typing import Deque, Mapping, Optional
+
+
+class TokenBucket(object):
+    """
+    Async token bucket. `rate` tokens are refilled every `period` seconds, up to `capacity`.
+
+    Acquiring is lock free: the tokens are reserved immediately (the bucket may go into debt),
+    and the caller sleeps until the debt is paid off. So waiters are served in arrival order.
+    """
+
+    def __init__(self, rate: float, period: float = 60.0, capacity: Optional[float] = None):
+        self.rate = rate
+        self.period = period
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.rate / self.period
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.tokens_per_second)
+        self._updated_at = now
+
+    def reserve(self, amount: float) -> float:
+        """Reserve tokens, return the seconds to wait before the tokens are available."""
+        # A request larger than the bucket could never be satisfied, so it is charged as a full bucket
+        amount = min(amount, self.capacity)
+        self._refill()
+        self._tokens -= amount
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens / self.tokens_per_second
+
+    async def acquire(self, amount: float = 1):
+        delay = self.reserve(amount)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def refund(self, amount: float):
+        """Give back tokens that were reserved but not used."""
+        self._refill()
+        self._tokens = min(self.capacity, self._tokens + amount)
+
+    def clamp(self, amount: float):
+        """Lower the available tokens to `amount`, e.g. the remaining quota reported by the API."""
+        self._refill()
+        self._tokens = min(self._tokens, amount)
+
+
+def _get_header(headers: Mapping[str, str], name: str) -> Optional[str]:
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+def parse_retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """Parse the seconds to wait from `retry-after-ms` or `retry-after` headers."""
+    value = _get_header(headers, "retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+
+    value = _get_header(headers, "retry-after")
+    if value is not None:
+        try:
+            return float(value)
+        except ValueError:  # http-date is not supported
+            pass
+    return None
+
+
+class AdaptiveRateLimiter(object):
+    """
+    Shared controller for calls to a rate limited API. It keeps the requests-per-minute and
+    tokens-per-minute budgets, and adjusts the number of concurrent calls AIMD-style:
+    the concurrency grows by one per window of successful calls, and is halved on rate limit errors.
+    When the API asks to retry after a while, all the calls are paused until then.
+    """
+
+    def __init__(
+        self,
+        rpm: int = 0,
+        tpm: int = 0,
+        max_concurrency: int = 10,
+        min_concurrency: int = 1,
+        default_retry_after: float = 10.0,
+    ):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.default_retry_after = default_retry_after
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._waiters: Deque[asyncio.Future] = collections.deque()
+
+    @property
+    def limit(self) -> int:
+        return max(self.min_concurrency, int(self.concurrency))
+
+    def _wake_up(self):
+        available = self.limit - self.in_flight
+        for waiter in list(self._waiters):
+            if available <= 0:
+                break
+            if not waiter.done():
+                waiter.set_result(None)
+                available -= 1
+            self._waiters.remove(waiter)
+
+    async def acquire(self, tokens: int = 0):
+        """Wait for a concurrency slot, and then for the request and token budgets."""
+        while True:
+            delay = self._paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            if self.in_flight < self.limit:
+                break
+
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                elif waiter.done() and not waiter.cancelled():
+                    # cancelled after being woken up, pass the wake-up on so that it's not lost
+                    self._wake_up()
+                raise
+
+        self.in_flight += 1
+        try:
+            if self.requests is not None:
+                await self.requests.acquire(1)
+            if self.tokens is not None and tokens:
+                await self.tokens.acquire(tokens)
+        except BaseException:
+            self.release()
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake_up()
+
+    def on_success(self, estimated_tokens: int = 0, used_tokens: Optional[int] = None):
+        """Additive increase. Also correct the token budget with the actual usage."""
+        self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.limit)
+        if self.tokens is not None and used_tokens is not None:
+            if used_tokens < estimated_tokens:
+                self.tokens.refund(estimated_tokens - used_tokens)
+            else:
+                self.tokens.reserve(used_tokens - estimated_tokens)
+        self._wake_up()
+
+    def on_rate_limited(self, headers: Optional[Mapping[str, str]] = None):
+        """Multiplicative decrease, and pause all the calls until the API is ready again."""
+        headers = headers or {}
+        now = time.monotonic()
+
+        # the calls in flight are rejected together, only decrease once for them
+        if now - self._last_decrease > 1.0:
+            self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+            self._last_decrease = now
+
+        retry_after = parse_retry_after(headers)
+        if retry_after is None:
+            retry_after = self.default_retry_after
+        self._paused_until = max(self._paused_until, now + retry_after)
+
+        for bucket, header in [
+            (self.requests, "x-ratelimit-remaining-requests"),
+            (self.tokens, "x-ratelimit-remaining-tokens"),
+        ]:
+            remaining = _get_header(headers, header)
+            if bucket is not None and remaining is not None and remaining.isdigit():
+                bucket.clamp(float(remaining))
@@ -0,0 +1,108 @@
+"""Route segments to the cheapest adequate translation tier"""
+import collections
+import os
+from typing import Dict, Iterable, Optional
+
+import langcodes
+import regex
+
+from ifuntrans.tokenizer import token_length
+
+# Routes from the cheapest to the most expensive
+ROUTE_TM = "tm"
+ROUTE_OPENCC = "opencc"
+ROUTE_GOOGLE = "google"
+ROUTE_GPT35 = "gpt-3.5"
+ROUTE_GPT4 = "gpt-4"
+ROUTES = [ROUTE_TM, ROUTE_OPENCC, ROUTE_GOOGLE, ROUTE_GPT35, ROUTE_GPT4]
+
+ROUTER_ENABLED = os.environ.get("IFUNTRANS_ROUTER", "0") not in ("0", "false", "False", "")
+# Segments up to this number of tokens are short labels
+ROUTER_SHORT_TOKENS = int(os.environ.get("IFUNTRANS_ROUTER_SHORT_TOKENS", 6))
+# Segments over this number of tokens need the strongest model
+ROUTER_LONG_TOKENS = int(os.environ.get("IFUNTRANS_ROUTER_LONG_TOKENS", 60))
+# Language pairs (e.g. "en-fr") that Google translates well enough, comma separated
+ROUTER_GOOGLE_PAIRS = {
+    pair.strip() for pair in os.environ.get("IFUNTRANS_ROUTER_GOOGLE_PAIRS", "").split(",") if pair.strip()
+}
+# Target languages that need the strongest model for sentences, comma separated
+ROUTER_PREMIUM_LANGUAGES = {
+    lang.strip()
+    for lang in os.environ.get("IFUNTRANS_ROUTER_PREMIUM_LANGUAGES", "ja,ko,th,ar").split(",")
+    if lang.strip()
+}
+
+
+class RouteCounters(object):
+    """Number of segments and characters sent to each route"""
+
+    def __init__(self):
+        self.segments = collections.Counter()
+        self.characters = collections.Counter()
+
+    def record(self, route: str, text: str):
+        self.segments[route] += 1
+        self.characters[route] += len(text)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {route: {"segments": self.segments[route], "characters": self.characters[route]} for route in ROUTES}
+
+    def clear(self):
+        self.segments.clear()
+        self.characters.clear()
+
+
+route_counters = RouteCounters()
+
+
+def is_numeric(text: str) -> bool:
+    """Numbers, optionally with a short unit, e.g. "100", "5%", "30 km", "Lv.10"."""
+    if not regex.search(r"\p{N}", text):
+        return False
+    words = regex.findall(r"\p{L}+", text)
+    return len(words) <= 1 and all(len(word) <= 3 for word in words)
+
+
+def is_covered_by_terms(text: str, terms: Dict[str, str]) -> bool:
+    """Whether all the words of the text are TM terms."""
+    rest = text.lower()
+    for term in sorted(terms, key=len, reverse=True):
+        rest = rest.replace(term.lower(), " ")
+    return not regex.search(r"\p{L}", rest)
+
+
+def route_segment(
+    text: str,
+    from_lang: str,
+    to_lang: str,
+    terms: Optional[Dict[str, str]] = None,
+    available: Iterable[str] = ROUTES,
+) -> str:
+    """
+    Pick the cheapest adequate route of the segment by its length, content and the language pair.
+    `terms` are the TM search results of the segment, `available` are the routes that can be used.
+    """
+    terms = terms or {}
+    available = set(available)
+    from_language = langcodes.get(from_lang).language
+    to_language = langcodes.get(to_lang).language
+
+    if text in terms:
+        return ROUTE_TM
+    if from_language == "zh" and to_language == "zh":
+        return ROUTE_OPENCC
+    if ROUTE_GOOGLE in available and (is_numeric(text) or f"{from_language}-{to_language}" in ROUTER_GOOGLE_PAIRS):
+        return ROUTE_GOOGLE
+
+    num_tokens = token_length(text)
+    if num_tokens <= ROUTER_SHORT_TOKENS or (terms and is_covered_by_terms(text, terms)):
+        route = ROUTE_GPT35
+    elif num_tokens > ROUTER_LONG_TOKENS or to_language in ROUTER_PREMIUM_LANGUAGES:
+        route = ROUTE_GPT4
+    else:
+        route = ROUTE_GPT35
+
+    # fallback to the other model tier if it's not configured
+    if route not in available:
+        route = ROUTE_GPT4 if route == ROUTE_GPT35 else ROUTE_GPT35
+    return route
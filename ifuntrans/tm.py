@@ -1,21 +1,52 @@
 """Translation Memory"""
+import contextlib
+import glob
+import hashlib
+import json
+import os
 import pathlib
+import pickle
 import re
-from typing import Dict
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Set, Tuple
 
 import jieba
 import langcodes
 import pandas
-from whoosh.fields import ID, TEXT, Schema
-from whoosh.filedb.filestore import RamStorage
-from whoosh.qparser import OrGroup, QueryParser
+import regex
+from loguru import logger
 from whoosh.analysis import StandardAnalyzer
+from whoosh.fields import ID, STORED, TEXT, Schema
+from whoosh.filedb.filestore import RamStorage
+from whoosh.query import Or, Term
 
 from ifuntrans.async_translators.chatgpt import normalize_language_code_as_iso639
-from ifuntrans.tokenizer import tokenize
+from ifuntrans.cache import LRUCache
+from ifuntrans.fuzzy import SentenceIndex, normalize
+from ifuntrans.glossary import GlossaryMatcher
 
 DEFAULT_TM_PATH = (pathlib.Path(__file__).parent.parent / "assets" / "tm.xlsx").resolve().as_posix()
 
+# "memory": build a whoosh index in memory for every run. "sqlite": persist the TM to a SQLite FTS5 file
+TM_BACKEND = os.environ.get("IFUNTRANS_TM_BACKEND", "memory")
+TM_CACHE_DIR = os.environ.get(
+    "IFUNTRANS_TM_CACHE_DIR", (pathlib.Path.home() / ".cache" / "ifuntrans" / "tm").as_posix()
+)
+# Bumped when the layout of the SQLite file, the analyzer or the saved indexes change, so the old files are not used
+SQLITE_TM_VERSION = 4
+SQLITE_WRITE_TIMEOUT = 30  # seconds to wait for the other writers
+# Rows added or updated in one commit
+TM_WRITE_BATCH_SIZE = int(os.environ.get("IFUNTRANS_TM_WRITE_BATCH_SIZE", 1000))
+# How the glossary terms are matched in term mode, "overlap" or "longest", see `ifuntrans.glossary`
+TM_TERM_POLICY = os.environ.get("IFUNTRANS_TM_TERM_POLICY", "overlap")
+# TM sentences similar to the text by at least this ratio are fuzzy hits, set it over 1 to disable fuzzy matching
+TM_FUZZY_THRESHOLD = float(os.environ.get("IFUNTRANS_TM_FUZZY_THRESHOLD", 0.8))
+TM_FUZZY_MIN_LENGTH = 8
+TM_ANALYZER_CACHE_SIZE = int(os.environ.get("IFUNTRANS_TM_ANALYZER_CACHE_SIZE", 100000))
+
+_analyzer_cache = LRUCache(TM_ANALYZER_CACHE_SIZE)
+
 
 def analyzer(x):
     x = x.lower()
@@ -24,20 +55,36 @@ def analyzer(x):
     return x
 
 
-class TranslationMemory(object):
-    @property
-    def index_path(self):
-        # return (pathlib.Path(__file__).parent.parent / ".index").resolve().as_posix()
-        return ":memory:"
+def analyze_many(texts: List[str]) -> List[str]:
+    """Analyze the texts for the full-text search, memoized."""
+    analyzed = [_analyzer_cache.get(text) for text in texts]
+    missing = list(dict.fromkeys(text for text, x in zip(texts, analyzed) if x is None))
+    if not missing:
+        return analyzed
+
+    computed = {text: analyzer(text) for text in missing}
+    for text, x in computed.items():
+        _analyzer_cache.set(text, x)
+    return [computed[text] if x is None else x for text, x in zip(texts, analyzed)]
+
+
+class WhooshStorage(object):
+    """TM storage built in memory by whoosh"""
+
+    path = ":memory:"
 
     def __init__(self, tm_df: pandas.DataFrame):
+        self.revision = 0
+        # (revision, row position, all the texts of the row, the changed languages) of every update
+        self._log: List[Tuple[int, int, Dict[str, str], List[str]]] = []
         langs = tm_df.columns.tolist()
         self.langs = [lang for lang in langs if lang != "und"]
 
         columns = {lang: TEXT(stored=True, analyzer=StandardAnalyzer(stoplist=None)) for lang in self.langs}
         origin_columns = {f"{lang}_origin": TEXT(stored=True) for lang in self.langs}
         schema = Schema(
-            STR_ID=ID(stored=True),
+            STR_ID=ID(stored=True, unique=True),
+            ROW=STORED,
             **columns,
             **origin_columns,
         )
@@ -48,6 +95,7 @@ class TranslationMemory(object):
         )
 
         writer = self.ix.writer()
+        self.num_rows = 0
         for _, row in tm_df.iterrows():
             docs = {}
             for lang in self.langs:
@@ -58,45 +106,489 @@ class TranslationMemory(object):
             # tokenized data
             writer.add_document(
                 STR_ID=str(row.iloc[0]),
+                ROW=self.num_rows,
                 **docs,
             )
+            self.num_rows += 1
         writer.commit()
 
-    def add(self, str_id: str, source: str, target: str, source_lang: str, target_lang: str):
-        # if str_id in ix, update, else add
+    def update_many(self, rows: Dict[str, Dict[str, str]]):
+        """
+        Add or update the rows by STR_ID in one commit. Languages not given are kept, and new rows are appended.
+        Rows keep their positions, which are the ROW of the documents.
+        """
+        with self.ix.searcher() as searcher:
+            existing = {str_id: [dict(fields) for fields in searcher.documents(STR_ID=str_id)] for str_id in rows}
+
+        changes = []
         with self.ix.writer() as writer:
-            writer.update_document(
-                STR_ID=str_id,
-                **{source_lang: tokenize(source), target_lang: tokenize(target)},
+            for str_id, texts in rows.items():
+                texts = {lang: text for lang, text in texts.items() if lang in self.langs}
+                fields_list = existing[str_id]
+                if not fields_list:
+                    fields_list = [{"ROW": self.num_rows}]
+                    self.num_rows += 1
+                    changed = list(self.langs)
+                else:
+                    changed = [
+                        lang
+                        for lang, text in texts.items()
+                        if any(fields.get(f"{lang}_origin", "") != text for fields in fields_list)
+                    ]
+                    if not changed:
+                        continue
+                    writer.delete_by_term("STR_ID", str_id)
+
+                for fields in fields_list:
+                    docs = {}
+                    for lang in self.langs:
+                        string = texts.get(lang, fields.get(f"{lang}_origin", ""))
+                        docs[lang] = analyzer(string)
+                        docs[f"{lang}_origin"] = string
+                    writer.add_document(STR_ID=str_id, ROW=fields["ROW"], **docs)
+                    changes.append((fields["ROW"], {lang: docs[f"{lang}_origin"] for lang in self.langs}, changed))
+        if changes:
+            self.revision += 1
+            self._log.extend((self.revision, *change) for change in changes)
+
+    def changes(self, revision: int) -> List[Tuple[int, Dict[str, str], List[str]]]:
+        """The rows changed after the revision as (row position, texts, changed languages), in the order of updates."""
+        return [change[1:] for change in self._log if change[0] > revision]
+
+    def column(self, lang: str) -> List[str]:
+        with self.ix.searcher() as searcher:
+            fields_list = sorted(searcher.all_stored_fields(), key=lambda fields: fields["ROW"])
+            return [fields[f"{lang}_origin"] for fields in fields_list]
+
+    def cache_path(self, lang: str, kind: str, revision: Optional[int] = None) -> Optional[str]:
+        return None
+
+    def saved_indexes(self, lang: str, kind: str) -> List[Tuple[int, str]]:
+        return []
+
+    def search_many(
+        self, tokens_list: List[str], source_lang: str, target_lang: str, limit: int
+    ) -> List[List[Tuple[str, str]]]:
+        field_analyzer = self.ix.schema[source_lang].analyzer
+        results_list = []
+        with self.ix.searcher() as searcher:
+            for tokens in tokens_list:
+                terms = list(dict.fromkeys(token.text for token in field_analyzer(tokens)))
+                if not terms:
+                    results_list.append([])
+                    continue
+                results = searcher.search(Or([Term(source_lang, term) for term in terms]), limit=limit)
+                results_list.append(
+                    [(result[f"{source_lang}_origin"], result[f"{target_lang}_origin"]) for result in results]
+                )
+        return results_list
+
+
+class SqliteStorage(object):
+    """
+    TM storage persisted to a single SQLite file, searched by FTS5. The file is built once and then opened
+    read-only, so it can be shared by many processes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        self.langs = json.loads(self.conn.execute("SELECT value FROM meta WHERE key = 'langs'").fetchone()[0])
+
+    @staticmethod
+    def build(tm_df: pandas.DataFrame, path: str):
+        """Build the SQLite file from the TM dataframe. The file is replaced atomically when it's done."""
+        tm_df = tm_df.loc[:, ~tm_df.columns.duplicated()]
+        langs = [lang for lang in tm_df.columns.tolist() if lang != "und"]
+        columns = ", ".join(_quote(lang) for lang in langs)
+        placeholders = ", ".join("?" for _ in langs)
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        with contextlib.closing(sqlite3.connect(tmp_path)) as conn:
+            conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("INSERT INTO meta VALUES ('langs', ?)", (json.dumps(langs),))
+            conn.execute("INSERT INTO meta VALUES ('revision', '0')")
+            # rows are never deleted, so the position of a row is its id - 1
+            conn.execute(f"CREATE TABLE tm (id INTEGER PRIMARY KEY, str_id TEXT, {columns})")
+            conn.execute("CREATE INDEX tm_str_id ON tm (str_id)")
+            # the changed languages of the rows updated by each revision
+            conn.execute("CREATE TABLE log (revision INTEGER, id INTEGER, langs TEXT)")
+            conn.execute("CREATE INDEX log_revision ON log (revision)")
+            conn.execute(f"CREATE VIRTUAL TABLE tm_fts USING fts5({columns}, tokenize='unicode61 remove_diacritics 0')")
+
+            rows = [(str(row[0]), *row[1:]) for row in tm_df[[tm_df.columns[0], *langs]].itertuples(index=False)]
+            conn.executemany(f"INSERT INTO tm VALUES (NULL, ?, {placeholders})", rows)
+            conn.executemany(
+                f"INSERT INTO tm_fts (rowid, {columns}) VALUES (?, {placeholders})",
+                ((i + 1, *[analyzer(string) for string in row[1:]]) for i, row in enumerate(rows)),
             )
+            conn.commit()
+        os.replace(tmp_path, path)
 
-    def search_tm(self, text: str, source_lang: str, target_lang: str, limit=5, term_mode=True) -> Dict[str, str]:
-        """Search terminology"""
+    @property
+    def revision(self) -> int:
+        """Bumped by every commit of updates, so the readers in the other processes know the TM has changed."""
+        return int(self.conn.execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0])
+
+    def update_many(self, rows: Dict[str, Dict[str, str]]):
+        """
+        Add or update the rows by STR_ID in one transaction. Languages not given are kept, and new rows are
+        appended. The file is written by a separate connection, and the changed rows are logged by the revision.
+        """
+        columns = ", ".join(_quote(lang) for lang in self.langs)
+        placeholders = ", ".join("?" for _ in self.langs)
+        with contextlib.closing(sqlite3.connect(self.path, timeout=SQLITE_WRITE_TIMEOUT)) as conn:
+            # take the write lock first, so the revision is not bumped by another writer meanwhile
+            conn.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'revision'")
+            revision = int(conn.execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0])
+            num_changes = 0
+            for str_id, texts in rows.items():
+                texts = {lang: text for lang, text in texts.items() if lang in self.langs}
+                existing = list(conn.execute(f"SELECT id, {columns} FROM tm WHERE str_id = ?", (str_id,)))
+                if not existing:
+                    values = [texts.get(lang, "") for lang in self.langs]
+                    cursor = conn.execute(f"INSERT INTO tm VALUES (NULL, ?, {placeholders})", (str_id, *values))
+                    conn.execute(
+                        f"INSERT INTO tm_fts (rowid, {columns}) VALUES (?, {placeholders})",
+                        (cursor.lastrowid, *[analyzer(value) for value in values]),
+                    )
+                    conn.execute(
+                        "INSERT INTO log VALUES (?, ?, ?)", (revision, cursor.lastrowid, json.dumps(self.langs))
+                    )
+                    num_changes += 1
+                    continue
+
+                for row_id, *values in existing:
+                    current = dict(zip(self.langs, values))
+                    changed = {lang: text for lang, text in texts.items() if current[lang] != text}
+                    if not changed:
+                        continue
+                    assignments = ", ".join(f"{_quote(lang)} = ?" for lang in changed)
+                    conn.execute(f"UPDATE tm SET {assignments} WHERE id = ?", (*changed.values(), row_id))
+                    conn.execute(
+                        f"UPDATE tm_fts SET {assignments} WHERE rowid = ?",
+                        (*[analyzer(text) for text in changed.values()], row_id),
+                    )
+                    conn.execute("INSERT INTO log VALUES (?, ?, ?)", (revision, row_id, json.dumps(list(changed))))
+                    num_changes += 1
+            # nothing changed, keep the revision so the readers don't look for changes
+            if num_changes:
+                conn.commit()
+            else:
+                conn.rollback()
+
+    def changes(self, revision: int) -> List[Tuple[int, Dict[str, str], List[str]]]:
+        """The rows changed after the revision as (row position, texts, changed languages), in the order of updates."""
+        columns = ", ".join(f"tm.{_quote(lang)}" for lang in self.langs)
+        cursor = self.conn.execute(
+            f"SELECT log.id, log.langs, {columns} FROM log JOIN tm ON tm.id = log.id "
+            "WHERE log.revision > ? ORDER BY log.revision",
+            (revision,),
+        )
+        return [(row_id - 1, dict(zip(self.langs, values)), json.loads(langs)) for row_id, langs, *values in cursor]
+
+    def column(self, lang: str) -> List[str]:
+        return [row[0] for row in self.conn.execute(f"SELECT {_quote(lang)} FROM tm ORDER BY id")]
+
+    def cache_path(self, lang: str, kind: str, revision: Optional[int] = None) -> Optional[str]:
+        """The indexes built from the TM (e.g. the glossary matcher) are saved next to the SQLite file."""
+        name = regex.sub(r"[^\w-]", "_", lang)
+        return f"{self.path}.{name}.{self.revision if revision is None else revision}.{kind}"
+
+    def saved_indexes(self, lang: str, kind: str) -> List[Tuple[int, str]]:
+        """The saved indexes of the language as (revision, path), the newest first."""
+        name = regex.sub(r"[^\w-]", "_", lang)
+        saved = []
+        for path in glob.glob(f"{glob.escape(self.path)}.{glob.escape(name)}.*.{kind}"):
+            revision = path[: -len(kind) - 1].rsplit(".", 1)[-1]
+            if revision.isdigit():
+                saved.append((int(revision), path))
+        return sorted(saved, reverse=True)
+
+    def search_many(
+        self, tokens_list: List[str], source_lang: str, target_lang: str, limit: int
+    ) -> List[List[Tuple[str, str]]]:
+        # only the source column counts in the ranking
+        weights = ", ".join("1.0" if lang == source_lang else "0.0" for lang in self.langs)
+        sql = (
+            f"SELECT tm.{_quote(source_lang)}, tm.{_quote(target_lang)} FROM tm_fts JOIN tm ON tm.id = tm_fts.rowid "
+            f"WHERE tm_fts.{_quote(source_lang)} MATCH ? ORDER BY bm25(tm_fts, {weights}) LIMIT ?"
+        )
+        results_list = []
+        for tokens in tokens_list:
+            words = regex.findall(r"\w+", tokens)
+            if not words:
+                results_list.append([])
+                continue
+            query = " OR ".join(_quote(word) for word in dict.fromkeys(words))
+            results_list.append(self.conn.execute(sql, (query, limit)).fetchall())
+        return results_list
+
+    def close(self):
+        self.conn.close()
+
+
+def _quote(identifier: str) -> str:
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+class TranslationMemory(object):
+    @property
+    def index_path(self):
+        return self.storage.path
+
+    def __init__(self, tm_df: Optional[pandas.DataFrame] = None, storage=None):
+        self.storage = storage if storage is not None else WhooshStorage(tm_df)
+        self.langs = self.storage.langs
+        self._columns: Dict[str, List[str]] = {}
+        self._matchers: Dict[str, GlossaryMatcher] = {}
+        self._sentence_indexes: Dict[str, SentenceIndex] = {}
+        self._revision = self.storage.revision
+        # the columns and indexes are updated by the writes in the worker threads too
+        self._lock = threading.RLock()
+
+    def _collect_changes(self, revision: int) -> List[Tuple[int, Dict[str, str], Set[str]]]:
+        """The rows changed after the revision as (row position, latest texts, changed languages), by position."""
+        changes: Dict[int, Tuple[Dict[str, str], Set[str]]] = {}
+        for row, texts, langs in self.storage.changes(revision):
+            changes[row] = (texts, changes[row][1] | set(langs) if row in changes else set(langs))
+        return [(row, texts, langs) for row, (texts, langs) in sorted(changes.items())]
+
+    @staticmethod
+    def _update_index(index, lang: str, changes: List[Tuple[int, Dict[str, str], Set[str]]]):
+        """
+        Add the appended rows to the index in place. Return None if the text of an indexed row has changed,
+        the index has to be rebuilt then.
+        """
+        appended = []
+        for row, texts, langs in changes:
+            if row < index.num_rows:
+                if lang in langs:
+                    return None
+            elif row == index.num_rows + len(appended):
+                appended.append(texts[lang])
+            else:
+                return None
+        index.add(appended)
+        return index
+
+    def _check_revision(self):
+        """
+        Bring the loaded columns and indexes up to date with the TM, which may be updated by the other processes.
+        Only the rows changed since the loaded revision are read, and the new rows are added to the indexes in place.
+        """
+        if self.storage.revision == self._revision:
+            return
+        with self._lock:
+            revision = self.storage.revision
+            if revision == self._revision:
+                return
+            changes = self._collect_changes(self._revision)
+            for lang, column in list(self._columns.items()):
+                for row, texts, _ in changes:
+                    if row < len(column):
+                        column[row] = texts[lang]
+                    elif row == len(column):
+                        column.append(texts[lang])
+                    else:
+                        del self._columns[lang]
+                        break
+            for indexes in (self._matchers, self._sentence_indexes):
+                for lang, index in list(indexes.items()):
+                    if self._update_index(index, lang, changes) is None:
+                        del indexes[lang]
+            self._revision = revision
+
+    def add(self, str_id: str, source: str, target: str, source_lang: str, target_lang: str):
+        self.update_many({str_id: {source_lang: source, target_lang: target}})
+
+    def update_many(self, rows: Dict[str, Dict[str, str]], batch_size: int = TM_WRITE_BATCH_SIZE):
+        """
+        Add or update the rows of the TM keyed by STR_ID, e.g. {"1001": {"zh": "射手", "en": "Archer"}}.
+        Languages not given are kept, and languages not in the TM are ignored. Committed every `batch_size` rows.
+        """
+        resolved = {}
+        for str_id, texts in rows.items():
+            resolved[str(str_id)] = {}
+            for lang, text in texts.items():
+                lang = lang if lang in self.langs else langcodes.closest_supported_match(lang, self.langs)
+                if lang:
+                    resolved[str(str_id)][lang] = text
+
+        items = list(resolved.items())
+        for start in range(0, len(items), batch_size):
+            self.storage.update_many(dict(items[start : start + batch_size]))
+        self._check_revision()
+
+    def write_back(self, texts: List[str], translations: List[str], source_lang: str, target_lang: str):
+        """
+        Save the translations to the TM, so they're exact hits the next time. The rows are keyed by the hash of the
+        normalized source text, so a text has one row for all the target languages.
+        """
+        self.write_back_many({target_lang: (texts, translations)}, source_lang)
+
+    def write_back_many(self, translations: Dict[str, Tuple[List[str], List[str]]], source_lang: str):
+        """`write_back` of the (texts, translations) of several target languages at once."""
+        rows = {}
+        for target_lang, (texts, targets) in translations.items():
+            for text, translation in zip(texts, targets):
+                key = f"{langcodes.standardize_tag(source_lang)}:{normalize(text)}"
+                str_id = f"auto-{hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()}"
+                rows.setdefault(str_id, {source_lang: text})[target_lang] = translation
+        self.update_many(rows)
+
+    def _get_column(self, lang: str) -> List[str]:
+        if lang not in self._columns:
+            self._columns[lang] = self.storage.column(lang)
+        return self._columns[lang]
+
+    def _load_index(self, index_class, lang: str, kind: str):
+        """Load the newest index saved by the storage, brought up to date by the changes since it was saved."""
+        for revision, path in self.storage.saved_indexes(lang, kind):
+            if revision > self._revision:
+                continue
+            try:
+                index = index_class.load(path)
+            except (OSError, EOFError, pickle.UnpicklingError) as e:  # e.g. removed by another process meanwhile
+                logger.warning(f"Failed to load the {kind} index from {path}: {e}")
+                return None, False
+            if revision == self._revision:
+                return index, True
+            return self._update_index(index, lang, self._collect_changes(revision)), False
+        return None, False
+
+    def _get_index(self, indexes: dict, index_class, lang: str, kind: str):
+        """
+        Load the index of the language saved by the storage, or build it from the column. An index is saved for
+        the current revision, and replaces the ones saved for the older revisions.
+        """
+        if lang in indexes:
+            return indexes[lang]
+        with self._lock:
+            if lang in indexes:
+                return indexes[lang]
+            index, is_current = self._load_index(index_class, lang, kind)
+            if index is None:
+                index = index_class(self._get_column(lang))
+            path = self.storage.cache_path(lang, kind, self._revision)
+            if path is not None and not is_current:
+                try:
+                    index.save(path)
+                except OSError as e:
+                    logger.warning(f"Failed to save the {kind} index to {path}: {e}")
+                for revision, old_path in self.storage.saved_indexes(lang, kind):
+                    if revision < self._revision:
+                        with contextlib.suppress(OSError):
+                            os.remove(old_path)
+            indexes[lang] = index
+        return index
+
+    def get_matcher(self, lang: str) -> GlossaryMatcher:
+        """The glossary matcher of the terms in the language, built on first use."""
+        self._check_revision()
+        return self._get_index(self._matchers, GlossaryMatcher, lang, "glossary")
+
+    def get_sentence_index(self, lang: str) -> SentenceIndex:
+        """The index of the sentences in the language, built on first use."""
+        self._check_revision()
+        return self._get_index(self._sentence_indexes, SentenceIndex, lang, "sentences")
+
+    def _resolve_langs(self, source_lang: str, target_lang: str) -> Tuple[Optional[str], Optional[str]]:
         if source_lang not in self.langs:
             source_lang = langcodes.closest_supported_match(source_lang, self.langs)
         if target_lang not in self.langs:
             target_lang = langcodes.closest_supported_match(target_lang, self.langs)
+        return source_lang, target_lang
 
-        if not source_lang or not target_lang:
-            return {}
+    def _search_terms(self, texts: List[str], source_lang: str, target_lang: str, policy: str) -> List[Dict[str, str]]:
+        matcher = self.get_matcher(source_lang)
+        targets = self._get_column(target_lang)
+        searched = []
+        for text in texts:
+            result = {}
+            for pattern_id in dict.fromkeys(x[2] for x in matcher.match(text, policy)):
+                target = next((targets[row] for row in matcher.rows[pattern_id] if targets[row]), "")
+                if target:
+                    result[matcher.terms[pattern_id]] = target
+            searched.append(result)
+        return searched
 
-        with self.ix.searcher() as searcher:
-            tokens = analyzer(text)
-            query = QueryParser(source_lang, self.ix.schema, group=OrGroup).parse(tokens)
-            results = searcher.search(query, limit=limit)
-            if len(results) == 0:
-                return {}
+    def search_tm(
+        self, text: str, source_lang: str, target_lang: str, limit=5, term_mode=True, term_policy=None
+    ) -> Dict[str, str]:
+        """Search terminology"""
+        return self.search_tm_many([text], source_lang, target_lang, limit, term_mode, term_policy)[0]
 
-            result = {result[f"{source_lang}_origin"]: result[f"{target_lang}_origin"] for result in results}
+    def search_tm_many(
+        self, texts: List[str], source_lang: str, target_lang: str, limit=5, term_mode=True, term_policy=None
+    ) -> List[Dict[str, str]]:
+        """
+        Search terminology of many texts in one pass. The languages are resolved once.
+        In term mode, every glossary term found in the text is returned (`limit` doesn't apply),
+        matched by `term_policy` (default to IFUNTRANS_TM_TERM_POLICY). Otherwise it's a full-text search of the
+        storage, returning the `limit` best scored rows even if they are not in the text.
+        """
+        source_lang, target_lang = self._resolve_langs(source_lang, target_lang)
+        if not source_lang or not target_lang:
+            return [{} for _ in texts]
 
         if term_mode:
             # 术语模式, 只返回包含原文的结果
-            # TODO: 这里需要改进
-            result = {k: v for k, v in result.items() if k.lower() in text.lower()}
-        return result
+            return self._search_terms(texts, source_lang, target_lang, term_policy or TM_TERM_POLICY)
 
+        results_list = self.storage.search_many(analyze_many(texts), source_lang, target_lang, limit)
+        return [dict(results) for results in results_list]
 
-async def create_tm_from_excel(tm_path: str) -> TranslationMemory:
+    def search_sentences_many(
+        self, texts: List[str], source_lang: str, target_lang: str, threshold: Optional[float] = None
+    ) -> List[Optional[Tuple[str, str, float]]]:
+        """
+        Search the TM sentences of the texts. Return (source, target, similarity) of the best match of each text,
+        or None. Exact hits of the normalized text have the similarity 1. Fuzzy hits are searched for the texts
+        of at least TM_FUZZY_MIN_LENGTH characters, with the similarity of at least `threshold`
+        (default to IFUNTRANS_TM_FUZZY_THRESHOLD).
+        """
+        threshold = TM_FUZZY_THRESHOLD if threshold is None else threshold
+        source_lang, target_lang = self._resolve_langs(source_lang, target_lang)
+        if not source_lang or not target_lang:
+            return [None for _ in texts]
+
+        index = self.get_sentence_index(source_lang)
+        sources = self._get_column(source_lang)
+        targets = self._get_column(target_lang)
+
+        def translated_row(sentence_id: int) -> Optional[int]:
+            return next((row for row in index.rows[sentence_id] if targets[row]), None)
+
+        matches = []
+        for text in texts:
+            match = None
+            sentence_id = index.exact(text)
+            if sentence_id is not None and translated_row(sentence_id) is not None:
+                row = translated_row(sentence_id)
+                match = (sources[row], targets[row], 1.0)
+            elif threshold <= 1 and len(text) >= TM_FUZZY_MIN_LENGTH:
+                for sentence_id, score in index.fuzzy(text, threshold):
+                    row = translated_row(sentence_id)
+                    if row is not None:
+                        match = (sources[row], targets[row], score)
+                        break
+            matches.append(match)
+        return matches
+
+
+def _file_hash(path: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+async def _read_tm_excel(tm_path: str) -> pandas.DataFrame:
     tm_df = (
         pandas.read_excel(tm_path, engine="openpyxl")
         .fillna("")
@@ -109,6 +601,21 @@ async def create_tm_from_excel(tm_path: str) -> TranslationMemory:
     # 第一列应该是id,这里强制设置为und
     langs[0] = "und"
     tm_df.columns = langs
+    return tm_df
+
+
+async def create_tm_from_excel(tm_path: str, backend: str = TM_BACKEND) -> TranslationMemory:
+    """
+    Create the TM from the excel file. With the sqlite backend, the TM is persisted in IFUNTRANS_TM_CACHE_DIR,
+    keyed by the content hash of the file, and only built when the file changes.
+    """
+    if backend == "memory":
+        return TranslationMemory(await _read_tm_excel(tm_path))
+    if backend != "sqlite":
+        raise ValueError(f"Unknown TM backend {backend}")
 
-    tm = TranslationMemory(tm_df)
-    return tm
+    path = os.path.join(TM_CACHE_DIR, f"{_file_hash(tm_path)}.v{SQLITE_TM_VERSION}.sqlite")
+    if not os.path.exists(path):
+        logger.info(f"Build the TM {tm_path} into {path}")
+        SqliteStorage.build(await _read_tm_excel(tm_path), path)
+    return TranslationMemory(storage=SqliteStorage(path))
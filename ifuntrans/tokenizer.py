@@ -1,7 +1,57 @@
+import hashlib
+import os
+from typing import List
+
+import regex
 import tiktoken
 
+from ifuntrans.cache import LRUCache
+
 tokenizer = tiktoken.encoding_for_model("gpt-4")
 
+TOKENIZER_THREADS = int(os.environ.get("IFUNTRANS_TOKENIZER_THREADS", 8))
+TOKEN_LENGTH_CACHE_SIZE = int(os.environ.get("IFUNTRANS_TOKEN_LENGTH_CACHE_SIZE", 200000))
+
+_token_length_cache = LRUCache(TOKEN_LENGTH_CACHE_SIZE)
+
+
+def _text_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def token_length(text: str) -> int:
+    """Number of tokens of the text, memoized."""
+    return token_lengths([text])[0]
+
+
+def token_lengths(texts: List[str], num_threads: int = TOKENIZER_THREADS) -> List[int]:
+    """Number of tokens of each text. Texts not in the cache are encoded in one multithreaded batch."""
+    keys = [_text_key(text) for text in texts]
+    lengths = [_token_length_cache.get(key) for key in keys]
+
+    missing = {}
+    for key, text, length in zip(keys, texts, lengths):
+        if length is None:
+            missing[key] = text
+
+    if missing:
+        if len(missing) == 1:
+            encoded = [tokenizer.encode_ordinary(next(iter(missing.values())))]
+        else:
+            encoded = tokenizer.encode_ordinary_batch(list(missing.values()), num_threads=num_threads)
+        computed = {key: len(tokens) for key, tokens in zip(missing.keys(), encoded)}
+        for key, length in computed.items():
+            _token_length_cache.set(key, length)
+        lengths = [computed[key] if length is None else length for key, length in zip(keys, lengths)]
+
+    return lengths
+
+
+def estimate_token_length(text: str) -> int:
+    """Cheap estimation of the number of tokens, for paths where accuracy doesn't matter."""
+    num_cjk = len(regex.findall(r"[\p{Han}\p{Hiragana}\p{Katakana}\p{Hangul}]", text))
+    return num_cjk + (len(text) - num_cjk + 3) // 4
+
 
 def tokenize(string: str) -> str:
     tokens = tokenizer.encode(string)
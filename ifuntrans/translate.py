@@ -1,18 +1,26 @@
 """
 Translate all in one.
 """
+import asyncio
+import collections
 import os
+import typing
+from functools import partial
 from itertools import chain
-from typing import Iterable, List
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
 import langcodes
+from loguru import logger
 from opencc import OpenCC
 
-import ifuntrans.async_translators.chatgpt as chatgpt
-import ifuntrans.async_translators.google as google
 from ifuntrans.characters import get_need_translate_func
+from ifuntrans.engines import get_engine
 from ifuntrans.pe import post_edit
 from ifuntrans.placeholder import split_text
+from ifuntrans.router import ROUTE_GOOGLE, ROUTE_OPENCC, ROUTE_TM, ROUTER_ENABLED, route_counters, route_segment
+
+if typing.TYPE_CHECKING:
+    from ifuntrans.tm import TranslationMemory
 
 opencc_mapping = {
     "s2hk": OpenCC("s2hk.json"),
@@ -23,14 +31,17 @@ opencc_mapping = {
     "t2s": OpenCC("t2s.json"),
 }
 
-ENGEIN = os.environ.get("IFUNTRANS_ENGINE", "chatgpt")
+# Save the ChatGPT translations to the TM given to `translate`, so they're TM hits the next time
+TM_WRITE_BACK = os.environ.get("IFUNTRANS_TM_WRITE_BACK", "0") not in ("0", "false", "False", "")
 
-if ENGEIN == "chatgpt":
-    batch_translate_texts = chatgpt.batch_translate_texts
-elif ENGEIN == "google":
-    batch_translate_texts = google.batch_translate_texts
-else:
-    raise ValueError(f"Unknown engine {ENGEIN}")
+# Chinese targets are derived from one translated Chinese variant by OpenCC, instead of being translated one by one.
+# Languages in IFUNTRANS_OPENCC_DERIVE_EXCLUDE (comma separated) are always translated.
+OPENCC_DERIVE = os.environ.get("IFUNTRANS_OPENCC_DERIVE", "1") not in ("0", "false", "False", "")
+OPENCC_DERIVE_EXCLUDE = {
+    langcodes.standardize_tag(lang.strip())
+    for lang in os.environ.get("IFUNTRANS_OPENCC_DERIVE_EXCLUDE", "").split(",")
+    if lang.strip()
+}
 
 
 def opencc_convert(text, lang_from, lang_to):
@@ -69,18 +80,27 @@ def opencc_convert(text, lang_from, lang_to):
     return result
 
 
-async def translate(texts: Iterable[str], from_lang: str, to_lang: str, **kwargs) -> List[str]:
+def can_derive_by_opencc(lang: str, exclude: Optional[Iterable[str]] = None) -> bool:
+    """Whether the target language can be derived from another Chinese variant by OpenCC."""
+    if exclude is None:
+        exclude = OPENCC_DERIVE_EXCLUDE
+    else:
+        exclude = {langcodes.standardize_tag(x) for x in exclude}
+    return OPENCC_DERIVE and langcodes.get(lang).language == "zh" and langcodes.standardize_tag(lang) not in exclude
+
+
+def _is_simplified_chinese(lang: str) -> bool:
+    lang_code = langcodes.get(lang)
+    if lang_code.script:
+        return lang_code.script == "Hans"
+    return lang_code.territory in (None, "CN", "SG")
+
+
+def _split_texts(texts: Iterable[str], from_lang: str) -> Tuple[List[str], List[int], List[bool]]:
     """
-    Translate the given dataframe to the given languages.
-    :param texts: The texts to translate.
-    :param to_langs: The languages to translate to.
-    :return: The translated dataframe.
+    Split the texts into segments, return the segments, the number of segments of each text,
+    and whether each segment needs to be translated.
     """
-    from_lang_code = langcodes.get(from_lang)
-    to_lang_code = langcodes.get(to_lang)
-    if from_lang_code.language == "zh" and to_lang_code.language == "zh":
-        return [opencc_convert(text, from_lang_code, to_lang_code) for text in texts]
-
     # split the texts by '\n'. In case of '\\n', replace it with '\n' first
     splited_texts = [split_text(text) for text in texts]
     splited_texts_len = [len(text) for text in splited_texts]
@@ -88,11 +108,13 @@ async def translate(texts: Iterable[str], from_lang: str, to_lang: str, **kwargs
 
     need_translate_func = get_need_translate_func(from_lang)
     need_translate_mask = [need_translate_func(text) for text in texts]
-    need_translate_texts = [t for t, m in zip(texts, need_translate_mask) if m]
-    translation = await batch_translate_texts(need_translate_texts, from_lang, to_lang, **kwargs)
-    # TODO: Temporarily disabled post-editing, because it's error-prone
-    # translation = await post_edit(need_translate_texts, translation, from_lang, to_lang)
+    return texts, splited_texts_len, need_translate_mask
+
 
+def _merge_texts(
+    texts: List[str], splited_texts_len: List[int], need_translate_mask: List[bool], translation: List[str]
+) -> List[str]:
+    """Merge the translated segments back into texts, the inverse of `_split_texts`."""
     result = []
     j = 0
     for i in range(len(texts)):
@@ -105,8 +127,160 @@ async def translate(texts: Iterable[str], from_lang: str, to_lang: str, **kwargs
     # merge the splited texts
     final_result = []
     cur = 0
-    for i in range(len(splited_texts)):
+    for i in range(len(splited_texts_len)):
         final_result.append("".join(result[cur : cur + splited_texts_len[i]]).strip())
         cur += splited_texts_len[i]
 
     return final_result
+
+
+async def _routed_translate(
+    texts: List[str],
+    from_lang: str,
+    to_lang: str,
+    tm: Optional["TranslationMemory"] = None,
+    progress_callback: Optional[Callable[[int, int], None]] = None,
+    **kwargs,
+) -> List[str]:
+    """Translate each segment by the cheapest adequate route, the routes run concurrently."""
+    chatgpt = get_engine("chatgpt")
+    google = get_engine("google")
+    available = [ROUTE_TM, ROUTE_OPENCC, ROUTE_GOOGLE] + list(chatgpt.module.MODEL_TIERS)
+    searched_tm = [{} for _ in texts]
+    sentence_matches = [None for _ in texts]
+    if tm is not None:
+        searched_tm = tm.search_tm_many(texts, from_lang, to_lang)
+        sentence_matches = tm.search_sentences_many(texts, from_lang, to_lang)
+        # exact sentence hits are routed to the TM
+        for text, terms, match in zip(texts, searched_tm, sentence_matches):
+            if match is not None and match[2] >= 1:
+                terms[text] = match[1]
+    routes = collections.defaultdict(list)
+    for i, (text, terms) in enumerate(zip(texts, searched_tm)):
+        route = route_segment(text, from_lang, to_lang, terms, available)
+        route_counters.record(route, text)
+        routes[route].append(i)
+    logger.debug(f"Routes: { {route: len(indices) for route, indices in routes.items()} }")
+
+    translations = [""] * len(texts)
+    progress = {}
+
+    def report(route: str, finished: int, total: Optional[int] = None):
+        progress[route] = finished
+        if progress_callback is not None:
+            progress_callback(sum(progress.values()), len(texts))
+
+    def translate_by_chatgpt(indices: List[int], **options) -> typing.Awaitable[List[str]]:
+        # the TM is already searched, ChatGPT is given the results instead of searching again
+        return chatgpt.batch_translate_texts(
+            [texts[i] for i in indices],
+            from_lang,
+            to_lang,
+            tm=tm,
+            searched_tm=[searched_tm[i] for i in indices],
+            sentence_matches=[sentence_matches[i] for i in indices],
+            **options,
+            **kwargs,
+        )
+
+    async def translate_route(route: str, indices: List[int]):
+        cur_texts = [texts[i] for i in indices]
+        if route == ROUTE_TM:
+            cur_translations = [searched_tm[i][texts[i]] for i in indices]
+        elif route == ROUTE_OPENCC:
+            from_lang_code, to_lang_code = langcodes.get(from_lang), langcodes.get(to_lang)
+            cur_translations = [opencc_convert(text, from_lang_code, to_lang_code) for text in cur_texts]
+        elif route == ROUTE_GOOGLE:
+            try:
+                cur_translations = await google.batch_translate_texts(cur_texts, from_lang, to_lang)
+            except Exception as e:  # e.g. the language is not supported by Google, or the request failed
+                logger.warning(
+                    f"Google Translate failed {type(e)}: {e}. Route to {chatgpt.module.DEFAULT_TIER} instead."
+                )
+                cur_translations = await translate_by_chatgpt(indices)
+        else:
+            cur_translations = await translate_by_chatgpt(indices, tier=route, progress_callback=partial(report, route))
+        for i, x in zip(indices, cur_translations):
+            translations[i] = x
+        report(route, len(indices))
+
+    await asyncio.gather(*[translate_route(route, indices) for route, indices in routes.items()])
+    return translations
+
+
+async def translate(texts: Iterable[str], from_lang: str, to_lang: str, **kwargs) -> List[str]:
+    """
+    Translate the given dataframe to the given languages.
+    :param texts: The texts to translate.
+    :param to_langs: The languages to translate to.
+    :param engine: The name of the registered engine, default to IFUNTRANS_ENGINE.
+    :param write_back: Save the translations to the TM (`tm`), default to IFUNTRANS_TM_WRITE_BACK.
+    :return: The translated dataframe.
+    """
+    engine = get_engine(kwargs.pop("engine", None))
+    kwargs.setdefault("write_back", TM_WRITE_BACK)
+    from_lang_code = langcodes.get(from_lang)
+    to_lang_code = langcodes.get(to_lang)
+    if from_lang_code.language == "zh" and to_lang_code.language == "zh":
+        texts = list(texts)
+        for text in texts:
+            route_counters.record(ROUTE_OPENCC, text)
+        return [opencc_convert(text, from_lang_code, to_lang_code) for text in texts]
+
+    texts, splited_texts_len, need_translate_mask = _split_texts(texts, from_lang)
+    need_translate_texts = [t for t, m in zip(texts, need_translate_mask) if m]
+    if ROUTER_ENABLED and engine.name == "chatgpt":
+        translation = await _routed_translate(need_translate_texts, from_lang, to_lang, **kwargs)
+    else:
+        translation = await engine.batch_translate_texts(need_translate_texts, from_lang, to_lang, **kwargs)
+    # TODO: Temporarily disabled post-editing, because it's error-prone
+    # translation = await post_edit(need_translate_texts, translation, from_lang, to_lang)
+
+    return _merge_texts(texts, splited_texts_len, need_translate_mask, translation)
+
+
+async def translate_multi(texts: Iterable[str], from_lang: str, to_langs: List[str], **kwargs) -> Dict[str, List[str]]:
+    """
+    Translate the given texts to several languages.
+    With an engine supporting it (ChatGPT), the texts are sent once for all the target languages instead of once
+    per language.
+    Several Chinese targets are derived from one of them (Simplified Chinese) by OpenCC, except those in
+    `derive_exclude` (default to IFUNTRANS_OPENCC_DERIVE_EXCLUDE).
+    :return: The translations of each target language.
+    """
+    derive_exclude = kwargs.pop("derive_exclude", None)
+    engine = get_engine(kwargs.get("engine"))
+    kwargs.setdefault("write_back", TM_WRITE_BACK)
+    texts = list(texts)
+    results = {}
+    llm_langs = []
+    for to_lang in to_langs:
+        if langcodes.get(from_lang).language == "zh" and langcodes.get(to_lang).language == "zh":
+            results[to_lang] = await translate(texts, from_lang, to_lang, **kwargs)
+        else:
+            llm_langs.append(to_lang)
+
+    derived_langs = [lang for lang in llm_langs if can_derive_by_opencc(lang, derive_exclude)]
+    if len(derived_langs) > 1:
+        base_lang = next((lang for lang in derived_langs if _is_simplified_chinese(lang)), "zh-CN")
+        llm_langs = [lang for lang in llm_langs if lang not in derived_langs] + [base_lang]
+        base_results = await translate_multi(texts, from_lang, llm_langs, derive_exclude=derive_exclude, **kwargs)
+        for lang in derived_langs:
+            results[lang] = await translate(base_results[base_lang], base_lang, lang, **kwargs)
+        for lang in llm_langs:
+            if lang in to_langs:
+                results[lang] = base_results[lang]
+        return {lang: results[lang] for lang in to_langs}
+
+    if not engine.supports("batch_translate_texts_multi") or len(llm_langs) < 2:
+        for to_lang in llm_langs:
+            results[to_lang] = await translate(texts, from_lang, to_lang, **kwargs)
+        return results
+
+    texts, splited_texts_len, need_translate_mask = _split_texts(texts, from_lang)
+    need_translate_texts = [t for t, m in zip(texts, need_translate_mask) if m]
+    kwargs.pop("engine", None)
+    translations = await engine.batch_translate_texts_multi(need_translate_texts, from_lang, llm_langs, **kwargs)
+    for to_lang, translation in translations.items():
+        results[to_lang] = _merge_texts(texts, splited_texts_len, need_translate_mask, translation)
+    return results
@@ -7,11 +7,13 @@ import openpyxl
 import pandas as pd
 from loguru import logger
 from openpyxl.styles import Font
+from tqdm import tqdm
 
 from ifuntrans.api.localization import normalize_case
 from ifuntrans.async_translators.chatgpt import normalize_language_code_as_iso639
+from ifuntrans.http_client import http_client_lifespan
 from ifuntrans.tm import create_tm_from_excel
-from ifuntrans.translate import translate
+from ifuntrans.translate import can_derive_by_opencc, translate_multi
 
 
 async def translate_group(
@@ -40,41 +42,62 @@ async def translate_group(
         en_column = "en"
         columns_2_langcodes["en"] = "en"
 
-    async def translate_column(
-        source_column: str,
-        target_column: str,
-    ):
+    async def translate_columns(source_column: str, target_columns: List[str]):
+        target_columns = [column for column in target_columns if column != source_column]
+        if not target_columns:
+            return
         from_lang = columns_2_langcodes[source_column]
-        to_lang = columns_2_langcodes[target_column]
+        to_langs = [columns_2_langcodes[column] for column in target_columns]
 
-        # select rows that target_column is empty and source_column is not empty
-        # these rows will be translated from 'from_lang' to 'to_lang'
-        target_empty_rows = dataframe[dataframe[target_column].isnull() & dataframe[source_column].notnull()]
+        # select rows that any target column is empty and source_column is not empty
+        # these rows will be translated from 'from_lang' to all the 'to_langs' at once
+        target_empty_rows = dataframe[
+            dataframe[target_columns].isnull().any(axis=1) & dataframe[source_column].notnull()
+        ]
         # group by "source_column"
         # if there are multiple rows with the same "source_column", we translate them together
         # this will save the translation cost
-        dedup_group = target_empty_rows.groupby(source_column)
-        translation: List[str] = await translate(
-            dedup_group.groups.keys(),
+        sources = list(target_empty_rows.groupby(source_column).groups.keys())
+        progress_bar = tqdm(desc=f"{source_column} -> {', '.join(target_columns)}", unit="seg")
+
+        def update_progress(finished: int, total: int):
+            progress_bar.total = total
+            progress_bar.n = finished
+            progress_bar.refresh()
+
+        translations = await translate_multi(
+            sources,
             from_lang=from_lang,
-            to_lang=to_lang,
+            to_langs=to_langs,
             tm=tm,
             instructions=instructions,
+            progress_callback=update_progress,
         )
-        # update the group
-        dataframe.loc[target_empty_rows.index, target_column] = dedup_group[target_column].transform(
-            lambda _: translation.pop(0)
-        )
-
-    for column in columns_2_langcodes.keys():
-        lang_code = columns_2_langcodes[column]
-
-        if langcodes.get(lang_code).language in ["zh", "ja", "ko"]:
-            await translate_column(en_column, zh_column)
-            await translate_column(zh_column, column)
+        progress_bar.close()
+        # only fill the empty cells
+        for target_column, to_lang in zip(target_columns, to_langs):
+            source_2_translation = dict(zip(sources, translations[to_lang]))
+            empty_rows = target_empty_rows[target_empty_rows[target_column].isnull()]
+            dataframe.loc[empty_rows.index, target_column] = empty_rows[source_column].map(source_2_translation)
+
+    # translate the pivot languages to each other first
+    await translate_columns(en_column, [zh_column])
+    await translate_columns(zh_column, [en_column])
+
+    # "zh", "ja", "ko" are translated from zh, the others from en, all the targets of a pivot in one go.
+    # Chinese variants are converted from zh by OpenCC, unless they are opted out to be translated from en
+    cjk_columns = []
+    other_columns = []
+    for column, lang_code in columns_2_langcodes.items():
+        language = langcodes.get(lang_code).language
+        if language == "zh" and column != zh_column and not can_derive_by_opencc(lang_code):
+            other_columns.append(column)
+        elif language in ["zh", "ja", "ko"]:
+            cjk_columns.append(column)
         else:
-            await translate_column(zh_column, en_column)
-            await translate_column(en_column, column)
+            other_columns.append(column)
+    await translate_columns(zh_column, cjk_columns)
+    await translate_columns(en_column, other_columns)
 
 
 async def main():
@@ -171,5 +194,10 @@ async def main():
                 dataframe.to_excel(writer, sheet_name=sheet_name, index=False)
 
 
+async def cli():
+    async with http_client_lifespan():
+        await main()
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(cli())
@@ -4,7 +4,14 @@ import langcodes
 import pytest
 
 from ifuntrans.async_translators.chatgpt import (
+    _align_translations,
+    _AnswerMonitor,
     _fix_ordianl_numbers,
+    _group_by_terms,
+    _JsonLinesParser,
+    _lookup_known_translations,
+    _pack_chunks,
+    _split_language_blocks,
     batch_translate_texts,
     normalize_language_code_as_iso639,
     translate_text,
@@ -42,6 +49,27 @@ def test_fix_ordianl_numbers(src: str, tgt: str, expected: str):
     assert result == expected
 
 
+SOURCE = ["Attack {0} enemies", "Defend the castle", "Level 3 reward", "Open chest", "Close"]
+TARGET = ["攻击{0}个敌人", "保卫城堡", "等级3奖励", "打开宝箱", "关闭"]
+
+
+@pytest.mark.parametrize(
+    "src, answer, expected",
+    [
+        (SOURCE, TARGET, TARGET),
+        (SOURCE, TARGET[:2] + [""] + TARGET[2:], TARGET),
+        (SOURCE, ["Here are the translations:"] + TARGET, TARGET),
+        (SOURCE, TARGET[:2] + TARGET[3:], TARGET[:2] + [None] + TARGET[3:]),
+        # the tail run stops at the mistranslated last line, so the extra line can't be located
+        (SOURCE[1:2] + SOURCE[3:] + SOURCE[2:3], ["保卫城堡", "多出来的一行", "打开宝箱", "关闭", "等级4奖励"], [None] * 4),
+        (["Hello\nWorld", "Bye"], ["你好", "世界", "再见"], ["你好\n世界", "再见"]),
+        (["Hello\nWorld", "Bye"], ["你好", "再见"], [None, None]),
+    ],
+)
+def test_align_translations(src, answer, expected):
+    assert _align_translations(src, answer) == expected
+
+
 @pytest.mark.parametrize(
     "lang, expected",
     [
@@ -162,3 +190,75 @@ async def test_normalize_language_code_as_iso639(lang: List[str], expected: List
 
     for code, expected_code in zip(iso_codes, expected):
         assert langcodes.closest_supported_match(code, expected) == expected_code
+
+
+def test_pack_chunks():
+    tm = [{}] * 5
+    # limited by the source target
+    assert _pack_chunks([10] * 5, tm, fixed_tokens=0, terms_overhead_tokens=0, inflation=1.0, max_length=25) == [
+        [0, 1],
+        [2, 3],
+        [4],
+    ]
+    # limited by the context size, with the translation estimation
+    chunks = _pack_chunks(
+        [10] * 5, tm, fixed_tokens=300, terms_overhead_tokens=0, inflation=2.0, max_length=500, context_size=650
+    )
+    assert chunks == [[0, 1], [2, 3], [4]]
+    # a segment larger than the budget gets a chunk of its own
+    assert _pack_chunks([1000, 1], tm[:2], fixed_tokens=0, terms_overhead_tokens=0, inflation=1.0, max_length=10) == [
+        [0],
+        [1],
+    ]
+
+
+def test_group_by_terms():
+    searched_tm = [{"A": "a"}, {}, {"B": "b"}, {"A": "a", "B": "b"}, {"A": "a"}, {}]
+    assert _group_by_terms(searched_tm) == [0, 4, 3, 2, 1, 5]
+
+
+def test_json_lines_parser():
+    parser = _JsonLinesParser(3)
+    parser.feed('{"id": 2, "translation": "第二行\\n换行"}\n{"id": 1, "trans')
+    assert parser.translations == [None, "第二行\n换行", None]
+    parser.feed('lation": "第一行"}\nSure!\n{"id": 9, "translation": "越界"}')
+    assert parser.close() == ["第一行", "第二行\n换行", None]
+    assert parser.num_invalid_lines == 2
+
+
+def test_answer_monitor():
+    monitor = _AnswerMonitor(["Hello", "World"])
+    assert monitor.feed("Here are the translations:\n") is None
+    assert monitor.feed("你好\n世") is None
+    assert monitor.feed("界\n") is None
+    assert monitor.feed("Note: this is") is None
+    assert monitor.feed(" a greeting\n") is None
+    assert monitor.feed("Hope it helps.\n") is None
+    assert monitor.feed("Bye.\n") == "more lines than sentences"
+
+    monitor = _AnswerMonitor(["Hello", "World"], protocol="jsonl")
+    assert monitor.feed('{"id": 1, "translation": "你好"}\n') is None
+    assert monitor.feed("Sure!\n") is None
+    assert monitor.feed("```\nOK\nI\nwill\n") == "invalid JSON lines"
+
+
+@pytest.mark.asyncio
+async def test_lookup_known_translations():
+    texts = ["Defeat the dragon", "Open the chest", "Hello\nWorld"]
+    matches = [
+        ("Defeat the dragon", "击败巨龙", 1.0),
+        ("Open the big chest", "打开大宝箱", 0.85),
+        ("Hello\nWorld!", "你好\n世界！", 0.9),
+    ]
+    translations, searched_tm, examples, _ = await _lookup_known_translations(
+        texts, "en", "zh", searched_tm=[{}, {"chest": "宝箱"}, {}], sentence_matches=matches
+    )
+    assert translations[0] == "击败巨龙"
+    # fuzzy hits are examples instead of terms, and multi-line ones are skipped
+    assert searched_tm[1:] == [{"chest": "宝箱"}, {}]
+    assert examples[1:] == [{"Open the big chest": "打开大宝箱"}, {}]
+
+
+def test_split_language_blocks():
+    answer = "Sure.\n### zh-TW\n你好\n世界\n\n### JA\nこんにちは\n世界\n### de\nHallo"
+    assert _split_language_blocks(answer, ["zh-TW", "ja"]) == {"zh-TW": "你好\n世界", "ja": "こんにちは\n世界\n### de\nHallo"}
@@ -1,6 +1,15 @@
+import httpx
 import pytest
 
-from ifuntrans.async_translators.google import batch_translate_texts, translate_text
+from ifuntrans.async_translators import google
+from ifuntrans.async_translators.google import (
+    GOOGLE_LANGUAGES_SNAPSHOT,
+    SupportedLanguageRegistry,
+    _pack_chunks,
+    _translate_chunk,
+    batch_translate_texts,
+    translate_text,
+)
 
 
 @pytest.mark.asyncio
@@ -18,3 +27,52 @@ async def test_batch_translate_texts():
 
     for r in result:
         assert "测试" in r or "。" in r
+
+
+def test_pack_chunks():
+    texts = ["a" * 10] * 300 + ["b" * 40, "c" * 5]
+    chunks = _pack_chunks(texts, max_segments=128, max_chars=50)
+
+    assert [x for chunk in chunks for x in chunk] == texts
+    assert all(len(chunk) <= 128 and sum(map(len, chunk)) <= 50 for chunk in chunks)
+    assert _pack_chunks(["a" * 100], max_chars=50) == [["a" * 100]]
+
+
+def test_supported_language_registry(tmp_path):
+    registry = SupportedLanguageRegistry([(tmp_path / "missing.json").as_posix(), GOOGLE_LANGUAGES_SNAPSHOT])
+    assert registry.load_snapshot()
+
+    assert registry.match("en") == "en"
+    assert registry.match("zh-Hant") == "zh-TW"
+    assert registry.match("en-US") == "en"
+
+
+@pytest.mark.asyncio
+async def test_translate_chunk_retry(mocker):
+    mocker.patch.object(google.asyncio, "sleep", mocker.AsyncMock())
+    acquire = mocker.patch.object(google.google_quota, "acquire", mocker.AsyncMock())
+    statuses = iter([429, 403, 200])
+
+    def handler(request):
+        status = next(statuses)
+        if status != 200:
+            return httpx.Response(status, json={"error": {"message": "rate limited"}})
+        return httpx.Response(200, json={"data": {"translations": [{"translatedText": "a"}, {"translatedText": "b"}]}})
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        assert await _translate_chunk(client, ["ab", "cde"], "en", "de") == ["a", "b"]
+    # the characters are only charged once for the retries
+    acquire.assert_awaited_once_with(5)
+
+
+@pytest.mark.asyncio
+async def test_translate_chunk_error(mocker):
+    mocker.patch.object(google.asyncio, "sleep", mocker.AsyncMock())
+    mocker.patch.object(google.google_quota, "acquire", mocker.AsyncMock())
+
+    def handler(request):
+        return httpx.Response(403, json={"error": {"message": "quota exceeded"}})
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        with pytest.raises(httpx.HTTPStatusError):
+            await _translate_chunk(client, ["ab"], "en", "de")
@@ -0,0 +1,46 @@
+import pytest
+
+from ifuntrans.cache import LRUCache, TranslationCache, _decode_value, _encode_value
+
+
+def test_lru_cache_eviction():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+@pytest.mark.parametrize("value", ["你好", "Hello " * 100])
+def test_encode_value(value):
+    assert _decode_value(_encode_value(value)) == value
+
+
+def test_make_key():
+    key = TranslationCache.make_key("chatgpt", "gpt", "zh", "en", "你好  世界")
+    assert key == TranslationCache.make_key("chatgpt", "gpt", "zh", "en", " 你好 世界 ")
+    assert key != TranslationCache.make_key("chatgpt", "gpt", "zh", "en", "你好\n世界")
+    assert TranslationCache.make_key("chatgpt", "gpt", "zh", "en", "你好 \r\n世界") == TranslationCache.make_key(
+        "chatgpt", "gpt", "zh", "en", "你好\n世界"
+    )
+    assert key != TranslationCache.make_key("google", "v2", "zh", "en", "你好 世界")
+    assert key != TranslationCache.make_key("chatgpt", "gpt", "zh", "en", "你好 世界", instructions="Be formal.")
+    assert key != TranslationCache.make_key("chatgpt", "gpt", "zh", "en", "你好 世界", terms={"世界": "World"})
+
+
+@pytest.mark.asyncio
+async def test_translation_cache():
+    cache = TranslationCache(maxsize=10, ttl=0)
+    keys = [cache.make_key("google", "v2", "zh", "en", text) for text in ["你好", "世界"]]
+
+    assert await cache.get_many(keys, engine="google") == [None, None]
+    await cache.set_many({keys[0]: "Hello"})
+    assert await cache.get_many(keys, engine="google") == ["Hello", None]
+
+    stats = cache.stats()["engines"]["google"]
+    assert stats["hits"] == 1
+    assert stats["misses"] == 3
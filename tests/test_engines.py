@@ -0,0 +1,39 @@
+import asyncio
+import types
+
+import pytest
+
+from ifuntrans.engines import EngineRegistry
+
+
+@pytest.mark.asyncio
+async def test_engine_registry():
+    registry = EngineRegistry()
+    # engines are imported on first use
+    registry.register("missing", "ifuntrans.async_translators.missing")
+    assert "missing" in registry
+    with pytest.raises(ValueError):
+        registry.get("unknown")
+    with pytest.raises(ImportError):
+        await registry.get("missing").batch_translate_texts(["Hello"], "en", "fr")
+
+
+@pytest.mark.asyncio
+async def test_engine_max_jobs():
+    running = []
+    max_running = []
+
+    async def batch_translate_texts(texts, source_language_code, target_language_code, **kwargs):
+        running.append(texts)
+        max_running.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(texts)
+        return [f"{target_language_code}:{text}" for text in texts]
+
+    registry = EngineRegistry()
+    engine = registry.register("local", types.SimpleNamespace(batch_translate_texts=batch_translate_texts), max_jobs=2)
+    results = await asyncio.gather(*[engine.batch_translate_texts([str(i)], "en", "fr") for i in range(5)])
+
+    assert results == [[f"fr:{i}"] for i in range(5)]
+    assert max(max_running) == 2
+    assert not engine.supports("batch_translate_texts_multi")
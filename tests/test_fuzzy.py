@@ -0,0 +1,29 @@
+import pytest
+
+from ifuntrans.fuzzy import SentenceIndex, levenshtein, normalize
+
+
+@pytest.mark.parametrize(
+    "a, b, expected",
+    [("", "", 0), ("abc", "", 3), ("kitten", "sitting", 3), ("射手克制硬汉", "硬汉克制射手", 4), ("a" * 100, "a" * 99 + "b", 1)],
+)
+def test_levenshtein(a, b, expected):
+    assert levenshtein(a, b) == expected
+    assert levenshtein(b, a) == expected
+
+
+def test_sentence_index(tmp_path):
+    sentences = ["Defeat the dragon", "Defeat  the dragon", "", "Collect 10 coins every day"]
+    index = SentenceIndex(sentences)
+    assert normalize(" Defeat\tthe  dragon ") == "Defeat the dragon"
+    assert index.sentences == ["Defeat the dragon", "Collect 10 coins every day"]
+    assert index.rows == [[0, 1], [3]]
+
+    assert index.exact("Defeat the  dragon") == 0
+    assert index.exact("Defeat the dragons") is None
+    assert [x[0] for x in index.fuzzy("Collect 20 coins every day", 0.8)] == [1]
+    assert index.fuzzy("Collect 20 coins every week", 0.9) == []
+
+    path = (tmp_path / "sentences").as_posix()
+    index.save(path)
+    assert SentenceIndex.load(path).exact("Defeat the dragon") == 0
@@ -0,0 +1,35 @@
+import pytest
+
+from ifuntrans.glossary import GlossaryMatcher
+
+
+def test_glossary_matcher():
+    matcher = GlossaryMatcher(["射手", "神射手", "Fire", "fire sword", "", "射手"])
+    assert matcher.terms == ["射手", "神射手", "Fire", "fire sword"]
+    assert matcher.rows == [[0, 5], [1], [2], [3]]
+
+    text = "神射手拿着Fire Sword"
+    assert matcher.match(text, "overlap") == [(0, 3, 1), (1, 3, 0), (5, 15, 3), (5, 9, 2)]
+    assert matcher.find_terms(text, "overlap") == ["神射手", "射手", "fire sword", "Fire"]
+    assert matcher.find_terms(text, "longest") == ["神射手", "fire sword"]
+    assert matcher.find_terms("骑手") == []
+    with pytest.raises(ValueError):
+        matcher.match(text, "shortest")
+
+
+def test_glossary_matcher_word_boundary():
+    matcher = GlossaryMatcher(["Art", "Ring", "Ace", "剑"])
+    assert matcher.find_terms("Start the party during spring") == []
+    assert matcher.find_terms("Place the ace") == ["Ace"]
+    assert matcher.find_terms("Art: the Ring, 剑ace") == ["Art", "Ring", "剑", "Ace"]
+    assert matcher.find_terms("宝剑ring") == ["剑", "Ring"]
+
+
+def test_glossary_matcher_save(tmp_path):
+    terms = [f"term{i}" for i in range(100)]
+    path = (tmp_path / "terms.glossary").as_posix()
+    GlossaryMatcher(terms).save(path)
+
+    matcher = GlossaryMatcher.load(path)
+    # all the hits are found, not only the top ones
+    assert matcher.find_terms(" ".join(terms), "longest") == terms
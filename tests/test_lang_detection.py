@@ -0,0 +1,27 @@
+import pytest
+
+from ifuntrans.lang_detection import local_detection
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("这是一封测试邮件", "zh-CN"),
+        ("這是一封測試郵件", "zh-TW"),
+        ("设定", "zh-CN"),
+        ("設定", None),
+        ("東京", None),
+        ("攻撃力", None),
+        ("これはテストメールです", "ja"),
+        ("이것은 테스트 이메일입니다", "ko"),
+        ("Это тестовое письмо", "ru"),
+        ("Привіт, світ", "uk"),
+        ("Це тестовий лист", None),
+        ("นี่คืออีเมลทดสอบ", "th"),
+        ("This is a test email", None),
+        ("Bonjour le monde", None),
+        ("123 !!", None),
+    ],
+)
+def test_local_detection(text, expected):
+    assert local_detection(text) == expected
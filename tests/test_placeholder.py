@@ -0,0 +1,18 @@
+from ifuntrans.placeholder import dedup_texts
+
+
+def test_dedup_texts():
+    texts = ["Confirm", "{0} Gold", "Confirm ", "Confirm", "{0}  Gold", "Cancel"]
+    unique_texts, inverse = dedup_texts(texts)
+
+    assert unique_texts == ["Confirm", "{0} Gold", "Cancel"]
+    assert inverse == [0, 1, 0, 0, 1, 2]
+
+
+def test_dedup_texts_keep_case():
+    # an acronym and a word, or a capitalized noun, are not the same segment
+    texts = ["US", "us", "Confirm", "confirm", "CONFIRM"]
+    unique_texts, inverse = dedup_texts(texts)
+
+    assert unique_texts == texts
+    assert inverse == [0, 1, 2, 3, 4]
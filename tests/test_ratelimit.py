@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+from ifuntrans.ratelimit import AdaptiveRateLimiter, TokenBucket, parse_retry_after
+
+
+def test_token_bucket_reserve():
+    bucket = TokenBucket(60, period=60)  # 1 token per second
+
+    assert bucket.reserve(60) == 0
+    assert bucket.reserve(2) == pytest.approx(2, abs=0.1)
+    bucket.refund(2)
+    assert bucket.reserve(1000) == pytest.approx(60, abs=0.1)
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_acquire():
+    bucket = TokenBucket(600, period=60)  # 10 tokens per second
+    await bucket.acquire(600)
+    await bucket.acquire(1)
+    assert bucket.reserve(0) == pytest.approx(0, abs=0.05)
+
+
+@pytest.mark.parametrize(
+    "headers, expected",
+    [
+        ({"Retry-After": "3"}, 3),
+        ({"retry-after-ms": "1500", "retry-after": "2"}, 1.5),
+        ({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}, None),
+        ({}, None),
+    ],
+)
+def test_parse_retry_after(headers, expected):
+    assert parse_retry_after(headers) == expected
+
+
+@pytest.mark.asyncio
+async def test_adaptive_rate_limiter():
+    limiter = AdaptiveRateLimiter(max_concurrency=4, default_retry_after=0)
+    assert limiter.limit == 4
+
+    limiter.on_rate_limited({"x-ratelimit-remaining-tokens": "0"})
+    assert limiter.limit == 2
+    # rejections of the calls in flight only decrease once
+    limiter.on_rate_limited()
+    assert limiter.limit == 2
+
+    await limiter.acquire()
+    await limiter.acquire()
+    waiter = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+    assert not waiter.done()
+
+    limiter.release()
+    await asyncio.sleep(0)
+    assert waiter.done()
+
+    for _ in range(10):
+        limiter.on_success()
+    assert limiter.limit == 4
+
+
+@pytest.mark.asyncio
+async def test_adaptive_rate_limiter_cancel_after_wake_up():
+    limiter = AdaptiveRateLimiter(max_concurrency=1)
+    await limiter.acquire()
+    waiter_a = asyncio.ensure_future(limiter.acquire())
+    waiter_b = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+
+    # A is woken up, but cancelled before it runs
+    limiter.release()
+    waiter_a.cancel()
+    await asyncio.wait_for(waiter_b, 1)
+    assert waiter_a.cancelled()
+    assert limiter.in_flight == 1
@@ -0,0 +1,47 @@
+import pytest
+
+from ifuntrans.router import (
+    ROUTE_GOOGLE,
+    ROUTE_GPT4,
+    ROUTE_GPT35,
+    ROUTE_OPENCC,
+    ROUTE_TM,
+    RouteCounters,
+    is_covered_by_terms,
+    is_numeric,
+    route_segment,
+)
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [("100", True), ("5%", True), ("30 km", True), ("Lv.10", True), ("Level", False), ("Get 10 coins", False)],
+)
+def test_is_numeric(text, expected):
+    assert is_numeric(text) == expected
+
+
+def test_is_covered_by_terms():
+    assert is_covered_by_terms("Fire Sword", {"fire": "火", "sword": "剑"})
+    assert not is_covered_by_terms("Fire Sword of Doom", {"fire": "火", "sword": "剑"})
+
+
+def test_route_segment():
+    long_text = "The quick brown fox jumps over the lazy dog. " * 10
+    assert route_segment("你好", "zh-CN", "en", {"你好": "Hello"}) == ROUTE_TM
+    assert route_segment("你好", "zh-CN", "zh-TW") == ROUTE_OPENCC
+    assert route_segment("100%", "en", "fr") == ROUTE_GOOGLE
+    assert route_segment("Start", "en", "ja") == ROUTE_GPT35
+    assert route_segment(long_text, "en", "fr") == ROUTE_GPT4
+    assert route_segment("Defeat the dragon to unlock the next chapter of the story.", "en", "ja") == ROUTE_GPT4
+    assert route_segment("Defeat the dragon to unlock the next chapter of the story.", "en", "fr") == ROUTE_GPT35
+    # fallback to the configured tier
+    assert route_segment(long_text, "en", "fr", available=[ROUTE_GPT35]) == ROUTE_GPT35
+
+
+def test_route_counters():
+    counters = RouteCounters()
+    counters.record(ROUTE_GOOGLE, "100")
+    counters.record(ROUTE_GOOGLE, "5%")
+    assert counters.stats()[ROUTE_GOOGLE] == {"segments": 2, "characters": 5}
+    assert counters.stats()[ROUTE_GPT4] == {"segments": 0, "characters": 0}
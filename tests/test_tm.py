@@ -1,8 +1,10 @@
 import os
 
+import pandas
 import pytest
 
-from ifuntrans.tm import create_tm_from_excel
+import ifuntrans.tm as tm_module
+from ifuntrans.tm import SqliteStorage, TranslationMemory, create_tm_from_excel
 
 test_file = os.path.join(os.path.dirname(__file__), "assets/terms.xlsx")
 
@@ -17,3 +19,100 @@ async def test_tm():
     assert "骑手" in result
     assert "运输者" in result
     assert "硬汉" in result
+
+
+def _create_tm_df():
+    tm_df = pandas.read_excel(test_file, engine="openpyxl").fillna("").astype(str)
+    tm_df.columns = ["und", "zh", "en"] + tm_df.columns.tolist()[3:]
+    return tm_df[["und", "zh", "en"]]
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_tm_storage(backend, tmp_path):
+    tm_df = _create_tm_df()
+    if backend == "sqlite":
+        path = (tmp_path / "tm.sqlite").as_posix()
+        SqliteStorage.build(tm_df, path)
+        tm = TranslationMemory(storage=SqliteStorage(path))
+        assert tm.index_path == path
+        assert tm.get_matcher("zh") is not None
+        assert os.path.exists(tm.storage.cache_path("zh", "glossary"))
+    else:
+        tm = TranslationMemory(tm_df)
+
+    assert tm.langs == ["zh", "en"]
+    result = tm.search_tm("射手会克制硬汉，硬汉克制骑手", "zh-CN", "en")
+    assert result == {"射手": "Archer", "硬汉": tm_df.set_index("zh")["en"]["硬汉"], "骑手": "Cavalry"}
+    assert tm.search_tm("射手", "zh", "fr") == {}
+
+
+@pytest.mark.parametrize("term_mode", [True, False])
+def test_search_tm_many(term_mode):
+    tm_module._analyzer_cache.clear()
+
+    tm = TranslationMemory(_create_tm_df())
+    texts = ["射手会克制硬汉", "骑手", "", "Hello"]
+    expected = [tm.search_tm(text, "zh", "en", term_mode=term_mode) for text in texts]
+    tm_module._analyzer_cache.clear()
+
+    assert tm.search_tm_many(texts, "zh", "en", term_mode=term_mode) == expected
+    tm_module._analyzer_cache.clear()
+    assert tm_module.analyze_many(texts) == [tm_module.analyzer(text) for text in texts]
+    assert tm.search_tm_many(texts, "zh", "fr", term_mode=term_mode) == [{}, {}, {}, {}]
+
+
+def test_search_sentences_many():
+    tm_df = pandas.DataFrame(
+        {
+            "und": ["1", "2", "3"],
+            "zh": ["击败巨龙，解锁下一章的剧情。", "射手", "每天登录可以领取奖励"],
+            "en": ["Defeat the dragon to unlock the next chapter.", "Archer", ""],
+        }
+    )
+    tm = TranslationMemory(tm_df)
+    texts = ["击败巨龙，解锁下一章的剧情。 ", "击败巨龙，解锁第二章的剧情。", "每天登录可以领取奖励", "骑手"]
+    matches = tm.search_sentences_many(texts, "zh", "en")
+
+    assert matches[0] == ("击败巨龙，解锁下一章的剧情。", "Defeat the dragon to unlock the next chapter.", 1.0)
+    assert matches[1][:2] == ("击败巨龙，解锁下一章的剧情。", "Defeat the dragon to unlock the next chapter.")
+    assert 0.8 <= matches[1][2] < 1
+    # no translation in the target language
+    assert matches[2] is None
+    assert matches[3] is None
+    assert tm.search_sentences_many(texts[1:2], "zh", "en", threshold=0.9) == [None]
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_update_many(backend, tmp_path):
+    tm_df = _create_tm_df()
+    if backend == "sqlite":
+        path = (tmp_path / "tm.sqlite").as_posix()
+        SqliteStorage.build(tm_df, path)
+        tm = TranslationMemory(storage=SqliteStorage(path))
+        # another process sharing the file
+        other = TranslationMemory(storage=SqliteStorage(path))
+    else:
+        tm = other = TranslationMemory(tm_df)
+    assert tm.search_tm("射手", "zh", "en") == {"射手": "Archer"}
+    assert other.search_sentences_many(["每天登录可以领取奖励"], "zh", "en") == [None]
+    matcher, sentence_index = other.get_matcher("zh"), other.get_sentence_index("zh")
+
+    tm.update_many({"1": {"en": "Bowman"}, "new": {"zh-CN": "每天登录可以领取奖励", "en": "Log in daily for rewards"}})
+    assert other.search_tm("射手", "zh", "en") == {"射手": "Bowman"}
+    assert other.search_sentences_many(["每天登录可以领取奖励"], "zh", "en")[0][1] == "Log in daily for rewards"
+    tm.update_many({"new-term": {"zh": "巨龙", "en": "Dragon"}})
+    assert other.search_tm("击败巨龙", "zh", "en") == {"巨龙": "Dragon"}
+    # the indexes are updated in place instead of being rebuilt
+    assert other.get_matcher("zh") is matcher
+    assert other.get_sentence_index("zh") is sentence_index
+
+    tm.write_back(["击败巨龙，解锁下一章的剧情。"], ["Defeat the dragon to unlock the next chapter."], "zh", "en")
+    tm.write_back(["击败巨龙，解锁下一章的剧情。"], ["Defeat the dragon to unlock the next chapter."], "zh", "en")
+    assert other.search_sentences_many(["击败巨龙，解锁下一章的剧情。"], "zh", "en")[0][2] == 1.0
+    assert other._get_column("zh").count("击败巨龙，解锁下一章的剧情。") == 1
+
+    if backend == "sqlite":
+        # a new process loads the index saved for an older revision, and adds the rows since then
+        new = TranslationMemory(storage=SqliteStorage(path))
+        assert new.search_tm("击败巨龙", "zh", "en") == {"巨龙": "Dragon"}
+        assert [x[0] for x in new.storage.saved_indexes("zh", "glossary")] == [new.storage.revision]
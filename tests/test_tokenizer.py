@@ -0,0 +1,15 @@
+from ifuntrans.tokenizer import estimate_token_length, token_length, token_lengths, tokenizer
+
+
+def test_token_lengths():
+    texts = ["Hello world!", "你好，世界！", "Hello world!", "<|endoftext|>"]
+    lengths = token_lengths(texts)
+
+    assert lengths == [len(tokenizer.encode_ordinary(text)) for text in texts]
+    assert token_length("Hello world!") == lengths[0]
+
+
+def test_estimate_token_length():
+    assert estimate_token_length("") == 0
+    assert estimate_token_length("你好") == 2
+    assert estimate_token_length("Hello world!") == 3
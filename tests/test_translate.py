@@ -0,0 +1,67 @@
+import types
+
+import httpx
+import pytest
+
+from ifuntrans.engines import Engine, engine_registry
+from ifuntrans.translate import _routed_translate, can_derive_by_opencc, translate_multi
+
+
+def test_can_derive_by_opencc():
+    assert can_derive_by_opencc("zh-TW")
+    assert can_derive_by_opencc("zh-HK", exclude=["zh-TW"])
+    assert not can_derive_by_opencc("zh-HK", exclude=["zh_hk"])
+    assert not can_derive_by_opencc("ja")
+
+
+@pytest.mark.asyncio
+async def test_translate_multi_derive_chinese():
+    requested = []
+
+    async def batch_translate_texts_multi(texts, from_lang, to_langs, **kwargs):
+        requested.append(to_langs)
+        return {lang: ["软件" if lang == "zh-CN" else f"{lang}:{text}" for text in texts] for lang in to_langs}
+
+    engine_registry.register("fake", types.SimpleNamespace(batch_translate_texts_multi=batch_translate_texts_multi))
+    try:
+        result = await translate_multi(["Software"], "en", ["zh-TW", "zh-HK", "ja"], engine="fake")
+    finally:
+        engine_registry.unregister("fake")
+    assert requested == [["ja", "zh-CN"]]
+    assert result == {"zh-TW": ["軟體"], "zh-HK": ["軟件"], "ja": ["ja:Software"]}
+
+
+@pytest.mark.asyncio
+async def test_routed_translate_google_failure(monkeypatch):
+    requested = []
+
+    async def google_translate(texts, from_lang, to_lang, **kwargs):
+        raise httpx.ConnectError("Connection refused")
+
+    async def chatgpt_translate(texts, from_lang, to_lang, **kwargs):
+        requested.append((texts, kwargs["searched_tm"]))
+        return [f"GPT:{text}" for text in texts]
+
+    google = types.SimpleNamespace(batch_translate_texts=google_translate)
+    chatgpt = types.SimpleNamespace(
+        batch_translate_texts=chatgpt_translate, MODEL_TIERS={"gpt-3.5": None}, DEFAULT_TIER="gpt-3.5"
+    )
+    monkeypatch.setitem(engine_registry._engines, "google", Engine("google", google))
+    monkeypatch.setitem(engine_registry._engines, "chatgpt", Engine("chatgpt", chatgpt))
+
+    # numbers are routed to Google, and re-routed to ChatGPT when Google fails
+    assert await _routed_translate(["100%"], "en", "ja") == ["GPT:100%"]
+    assert requested == [(["100%"], [{}])]
+
+
+@pytest.mark.asyncio
+async def test_routed_translate_opencc(monkeypatch):
+    async def chatgpt_translate(texts, from_lang, to_lang, **kwargs):
+        raise AssertionError("Chinese variants are converted by OpenCC")
+
+    chatgpt = types.SimpleNamespace(
+        batch_translate_texts=chatgpt_translate, MODEL_TIERS={"gpt-3.5": None}, DEFAULT_TIER="gpt-3.5"
+    )
+    monkeypatch.setitem(engine_registry._engines, "chatgpt", Engine("chatgpt", chatgpt))
+
+    assert await _routed_translate(["软件"], "zh-CN", "zh-TW") == ["軟體"]
@@ -1,11 +1,13 @@
 import argparse
 import asyncio
 import re
+from typing import List
 
 from docx import Document
-from ifuntrans.translate import translate
-from typing import List
+
+from ifuntrans.http_client import http_client_lifespan
 from ifuntrans.tm import create_tm_from_excel
+from ifuntrans.translate import translate
 
 
 async def main():
@@ -23,48 +25,50 @@ async def main():
         tm = await create_tm_from_excel(args.translate_memory_file)
     else:
         tm = None
-    
+
     # TODO Semple merge paragraphs, only CJK works. Use mBert to merge paragraphs more accurately
-    # merge the neighboring paragraphs if they have the same style and 
+    # merge the neighboring paragraphs if they have the same style and
     # final character in the first paragraph is CJK and the first character in the second paragraph is CJK
     for i in range(len(document.paragraphs) - 1):
         if document.paragraphs[i].text == "" or document.paragraphs[i + 1].text == "":
             continue
         if document.paragraphs[i].style == document.paragraphs[i + 1].style:
-            if re.match(r"[\u4e00-\u9fa5]", document.paragraphs[i].text[-1]) and re.match(r"[\u4e00-\u9fa5]", document.paragraphs[i + 1].text[0]):
+            if re.match(r"[\u4e00-\u9fa5]", document.paragraphs[i].text[-1]) and re.match(
+                r"[\u4e00-\u9fa5]", document.paragraphs[i + 1].text[0]
+            ):
                 document.paragraphs[i].text += " " + document.paragraphs[i + 1].text
                 document.paragraphs[i + 1].text = ""
-    
+
     texts = []
     for paragraph in document.paragraphs:
         texts.append(paragraph.text)
 
     translation: List[str] = await translate(
-            texts,
-            from_lang=args.from_lang,
-            to_lang=args.to_lang,
-            tm=tm,
-            instructions=args.instructions,
-        )
+        texts,
+        from_lang=args.from_lang,
+        to_lang=args.to_lang,
+        tm=tm,
+        instructions=args.instructions,
+    )
 
     for i, paragraph in enumerate(document.paragraphs):
         paragraph.text = translation[i]
-        
+
     # translate table text
     table_texts = []
     for table in document.tables:
         for row in table.rows:
             for cell in row.cells:
                 table_texts.append(cell.text)
-                
+
     translation: List[str] = await translate(
-            table_texts,
-            from_lang=args.from_lang,
-            to_lang=args.to_lang,
-            tm=tm,
-            instructions=args.instructions,
-        )
-    
+        table_texts,
+        from_lang=args.from_lang,
+        to_lang=args.to_lang,
+        tm=tm,
+        instructions=args.instructions,
+    )
+
     for i, table in enumerate(document.tables):
         for j, row in enumerate(table.rows):
             for k, cell in enumerate(row.cells):
@@ -77,5 +81,10 @@ async def main():
     document.save(args.output)
 
 
+async def cli():
+    async with http_client_lifespan():
+        await main()
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(cli())